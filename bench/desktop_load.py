@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""CRI desktop catalog benchmark
+
+Generates a directory of synthetic .desktop files and times how long it takes to read
+all of them with the old per key regex scans and with the desktop.py parser
+
+Usage: python bench/desktop_load.py [file count] [rounds]
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from os.path import dirname, realpath, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from timeit import default_timer
+import sys
+import re
+
+sys.path.insert(0, join(dirname(dirname(realpath(__file__))), "serve-chroot"))
+import desktop
+
+# Configs
+default_files = 5000
+default_rounds = 3
+locale = "de"
+
+# Real desktop files carry dozens of translations and a few action groups
+translations = ["ar", "bg", "ca", "cs", "da", "de", "el", "en_GB", "es", "et", "eu", "fa", "fi",
+        "fr", "gl", "he", "hr", "hu", "id", "it", "ja", "ko", "lt", "nb", "nl", "pl", "pt",
+        "pt_BR", "ro", "ru", "sk", "sl", "sr", "sv", "th", "tr", "uk", "vi", "zh_CN", "zh_TW"]
+actions = ["new-window", "new-private-window"]
+
+
+def make_tree(count):
+    path = mkdtemp(prefix="cri-bench-")
+    for i in range(0, count):
+        lines = ["[Desktop Entry]\n", "Version=1.0\n", "Type=Application\n",
+                "Name=Application %d\n" % i, "GenericName=Generic tool %d\n" % i,
+                "Comment=Does useful thing number %d\n" % i]
+        for key in ("Name", "GenericName", "Comment", "Keywords"):
+            lines += ["%s[%s]=%s %s %d\n" % (key, l, key, l, i) for l in translations]
+        lines += ["Exec=app%d %%U\n" % i, "TryExec=app%d\n" % i, "Icon=app%d\n" % i,
+                "Terminal=false\n", "Categories=Utility;\n", "Actions=%s;\n" % ";".join(actions)]
+        for a in actions:
+            lines += ["\n", "[Desktop Action %s]\n" % a, "Name=%s\n" % a, "Exec=app%d --%s\n" % (i, a)]
+            lines += ["Name[%s]=%s %s\n" % (l, a, l) for l in translations]
+        with open(join(path, "app%d.desktop" % i), "w") as f:
+            f.writelines(lines)
+    return path
+
+
+def _g_prop(c, to_get, default=None):
+    # The per key lookup Application used before desktop.py
+    if ("%s=" % to_get) not in c:
+        return default
+    filtered = list(filter(None, re.findall(r"%s=(.*?)\n" % to_get, c, re.DOTALL)))
+    if len(filtered) == 0:
+        return None
+    return filtered[0]
+
+
+def load_regex(path):
+    with open(path, 'r') as d:
+        dc = d.read()
+        return (_g_prop(dc, "Name"), _g_prop(dc, "Icon", "exec"), _g_prop(dc, "Exec"),
+                _g_prop(dc, "TryExec"), _g_prop(dc, "Comment"), _g_prop(dc, "Version"))
+
+
+def load_parser(path):
+    return desktop.parse(path, desktop.locale_names(locale))
+
+
+def run(loader, files, rounds):
+    best = None
+    for r in range(0, rounds):
+        start = default_timer()
+        for f in files:
+            loader(f)
+        took = default_timer() - start
+        best = took if best is None else min(best, took)
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else default_files
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else default_rounds
+    path = make_tree(count)
+    try:
+        files = [join(path, "app%d.desktop" % i) for i in range(0, count)]
+        print("Loading %d desktop files (best of %d rounds)" % (count, rounds))
+        regex = run(load_regex, files, rounds)
+        parser = run(load_parser, files, rounds)
+        print("regex scans: %8.1f ms (%.1f us/file)" % (regex * 1000, regex * 1e6 / count))
+        print("desktop.py:  %8.1f ms (%.1f us/file)" % (parser * 1000, parser * 1e6 / count))
+        print("speedup:     %8.2fx" % (regex / parser))
+    finally:
+        rmtree(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Fake Xvnc for the CRI benchmarks
+
+Listens on the rfb port, greets every connection with an RFB banner and then echoes
+whatever the client sends so the vnc proxy has something to carry
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from os import environ
+from time import sleep
+import select
+import signal
+import socket
+import sys
+
+# Configs
+start_seconds = float(environ.get("CRI_BENCH_VNC_SECONDS", "0.2"))
+banner = b"RFB 003.008\n"
+
+
+def main(port):
+    signal.signal(signal.SIGTERM, lambda s, f: sys.exit(0))
+    sleep(start_seconds)
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", port))
+    server.listen(64)
+    clients = []
+    while True:
+        ready = select.select([server] + clients, [], [])[0]
+        for s in ready:
+            if s is server:
+                c = server.accept()[0]
+                c.sendall(banner)
+                clients.append(c)
+                continue
+            try:
+                data = s.recv(65536)
+                if data:
+                    s.sendall(data)
+                    continue
+            except socket.error:
+                pass
+            clients.remove(s)
+            s.close()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]))
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""Fake python-apt for the CRI benchmarks
+
+Only the parts of python-apt CRI uses. The cache holds a configurable number of synthetic
+packages and commits take a configurable time while reporting progress like the real one
+
+Developed By: David Smerkous and Eli Smith
+"""
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Fake apt.cache
+
+Set up with environment variables so the benchmark can shape it:
+CRI_BENCH_PACKAGES      synthetic packages in the cache (pkg0, pkg1, ...)
+CRI_BENCH_CACHE_SECONDS time it takes to open the cache
+CRI_BENCH_COMMIT_SECONDS time a commit takes (half fetching, half installing)
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from os import environ
+from time import sleep
+
+# Configs
+packages = int(environ.get("CRI_BENCH_PACKAGES", "2000"))
+cache_seconds = float(environ.get("CRI_BENCH_CACHE_SECONDS", "0"))
+commit_seconds = float(environ.get("CRI_BENCH_COMMIT_SECONDS", "1"))
+progress_steps = 20 # Progress reports per half of a commit
+
+words = ["editor", "browser", "player", "viewer", "terminal", "office", "game", "library",
+        "tools", "manager", "client", "server", "utility", "toolkit", "font"]
+
+
+class Version(object):
+    def __init__(self, i):
+        self.summary = "A synthetic %s for benchmarking (%d)" % (words[i % len(words)], i)
+        self.version = "1.%d" % i
+        self.size = 1024 * (i % 997 + 1)
+        self.downloadable = True
+
+
+class Package(object):
+    def __init__(self, cache, i):
+        self._cache = cache
+        self.name = "pkg%d" % i
+        self.shortname = self.name
+        self.candidate = Version(i)
+        self.essential = False
+        self.is_installed = False
+        self.is_upgradable = False
+        self.marked_install = False
+        self.marked_delete = False
+
+    def mark_install(self, auto_fix=True, auto_inst=True, from_user=True):
+        self.marked_install = True
+
+    def mark_delete(self, auto_fix=True, purge=False):
+        self.marked_delete = True
+
+
+class Cache(object):
+    broken_count = 0
+
+    def __init__(self, progress=None):
+        sleep(cache_seconds)
+        self._packages = {}
+        for i in range(0, packages):
+            p = Package(self, i)
+            self._packages[p.name] = p
+
+    def __iter__(self):
+        return iter(list(self._packages.values()))
+
+    def __contains__(self, name):
+        return name in self._packages
+
+    def __getitem__(self, name):
+        return self._packages[name]
+
+    def __len__(self):
+        return len(self._packages)
+
+    def open(self, progress=None):
+        sleep(cache_seconds)
+
+    def clear(self):
+        for p in self._packages.values():
+            p.marked_install = False
+            p.marked_delete = False
+
+    def commit(self, fetch_progress, install_progress):
+        marked = [p for p in self._packages.values() if p.marked_install or p.marked_delete]
+        step = commit_seconds / 2.0 / progress_steps
+        fetch_progress.total_items = progress_steps
+        for i in range(0, progress_steps):
+            fetch_progress.current_items = i + 1
+            fetch_progress.pulse(None)
+            sleep(step)
+        install_progress.start_update()
+        for i in range(0, progress_steps):
+            for p in marked:
+                install_progress.status_change(p.name, 100.0 * (i + 1) / progress_steps, "Installing %s" % p.name)
+            sleep(step)
+        install_progress.finish_update()
+        for p in marked:
+            p.is_installed = p.marked_install
+        self.clear()
+        return True
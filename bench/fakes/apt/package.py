@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+"""Fake apt.package, the package classes live in apt.cache
+
+Developed By: David Smerkous and Eli Smith
+"""
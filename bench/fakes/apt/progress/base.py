@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""Fake apt.progress.base
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+
+class AcquireProgress(object):
+    current_items = 0
+    total_items = 0
+    fetched_bytes = 0
+    total_bytes = 0
+    current_cps = 0
+
+    def fail(self, item):
+        pass
+
+    def pulse(self, owner):
+        return True
+
+
+class InstallProgress(object):
+    def error(self, pkg, errormsg):
+        pass
+
+    def start_update(self):
+        pass
+
+    def finish_update(self):
+        pass
+
+    def status_change(self, pkg, percent, status):
+        pass
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""Fake gtk for the CRI benchmarks
+
+The icon theme finds <name>.png in CRI_BENCH_ICONS
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from os import environ
+from os.path import join, exists
+
+# Configs
+icon_dir = environ.get("CRI_BENCH_ICONS", "/tmp")
+
+
+class IconInfo(object):
+    def __init__(self, path):
+        self._path = path
+
+    def get_filename(self):
+        return self._path
+
+
+class IconTheme(object):
+    def set_custom_theme(self, name):
+        pass
+
+    def lookup_icon(self, name, size, flags):
+        path = join(icon_dir, "%s.png" % name)
+        return IconInfo(path) if exists(path) else None
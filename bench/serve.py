@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""CRI benchmark server
+
+Runs the real CRI server from serve-chroot with its files moved to a scratch directory.
+server_load.py starts it with the fake vncserver on the PATH and the fake apt and gtk
+modules on the PYTHONPATH, and sets it up with these environment variables:
+CRI_BENCH_PORT  the websocket port
+CRI_BENCH_APPS  the applications directory
+CRI_BENCH_DATA  where the config, state, catalog snapshot and logs go
+CRI_BENCH_WORKERS  how many worker processes to run
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from os.path import dirname, realpath, join
+from os import environ
+import sys
+
+sys.path.insert(0, join(dirname(dirname(realpath(__file__))), "serve-chroot"))
+data_dir = environ["CRI_BENCH_DATA"]
+
+# Before anything is logged
+import logger
+logger.LOGGER_CONSOLE = False
+logger.WRITER._path = join(data_dir, "logs")
+
+import apps
+import main
+from processes import ProcessTracker
+
+port = int(environ.get("CRI_BENCH_PORT", "3300"))
+apps.applications_dir = environ["CRI_BENCH_APPS"]
+apps.config_dir = data_dir
+apps.snapshot_file = join(data_dir, "catalog")
+apps.connection.set_target("127.0.0.1", port) # Always online
+main.server_port = port
+main.start_up = data_dir
+main.state_file = join(data_dir, "state")
+main.tracker = ProcessTracker(main.state_file)
+main.worker_processes = int(environ.get("CRI_BENCH_WORKERS", "1"))
+main.coordinator_socket = join(data_dir, "cri.sock")
+
+if __name__ == "__main__":
+    main.main()
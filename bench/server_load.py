@@ -0,0 +1,613 @@
+# -*- coding: utf-8 -*-
+"""CRI server load benchmark
+
+Starts the real CRI server (serve.py) with the fake vncserver, apt and gtk in this directory
+and a synthetic applications directory, then drives concurrent websocket clients through
+list, search, run, kill and install. It reports the latency percentiles of every operation,
+messages per second, how long the IOLoop was blocked and how much memory the server used,
+and saves everything as JSON so the results of two versions can be compared. With --workers
+above 1 the metrics and memory are summed over all the workers.
+With --encoding msgpack the clients talk MessagePack and every frame the server sends is checked
+for strings that were packed as bin (browsers decode those as byte arrays instead of text)
+
+Usage: python bench/server_load.py [--clients N] [--rounds N] [--compare old.json] ...
+(python bench/server_load.py --help lists every option)
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from __future__ import print_function
+from os.path import dirname, realpath, join, isdir
+from os import environ, makedirs, pathsep, listdir
+from shutil import rmtree
+from tempfile import mkdtemp
+from timeit import default_timer
+from datetime import datetime
+from json import dumps, loads
+from tornado import ioloop, gen, websocket, locks, queues, tcpclient, httpclient
+import argparse
+import subprocess
+import signal
+import struct
+import sys
+import re
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Configs
+bench_dir = dirname(realpath(__file__))
+results_dir = join(bench_dir, "results")
+start_timeout = 30 # Seconds the server gets to start listening
+stop_timeout = 10 # Seconds the server gets to shut down before it's killed
+op_timeout = 60 # Seconds an operation gets to finish
+sample_interval = 0.2 # Seconds between memory samples
+operations = ["list", "search", "run", "kill", "install"]
+search_words = ["editor", "browser", "player", "viewer", "terminal", "office", "game", "tools"]
+
+metric_line = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})? (\S+)$')
+worker_label = re.compile(r'worker="[^"]*",?')
+
+
+def make_tree(path, count):
+    """Write count desktop files (some in a sub directory) and an icon for each of them"""
+    apps = join(path, "applications")
+    icons = join(path, "icons")
+    for d in (apps, join(apps, "kde4"), icons):
+        makedirs(d)
+    for i in range(0, count):
+        folder = join(apps, "kde4") if i % 10 == 0 else apps
+        with open(join(folder, "bench%d.desktop" % i), "w") as f:
+            f.write("[Desktop Entry]\nType=Application\nName=Bench app %d\n"
+                    "Comment=A synthetic %s for benchmarking\nExec=sleep %d %%U\nIcon=bench%d\n"
+                    % (i, search_words[i % len(search_words)], 3600 + i, i))
+        with open(join(icons, "bench%d.png" % i), "wb") as f:
+            f.write(("icon %d" % i).encode("ascii"))
+    with open(join(icons, "exec.png"), "wb") as f:
+        f.write(b"default icon")
+    return apps, icons
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def summarize(values, errors=0):
+    return {
+        "count": len(values),
+        "errors": errors,
+        "mean": sum(values) / len(values) if len(values) > 0 else None,
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": max(values) if len(values) > 0 else None
+    }
+
+
+def parse_metrics(text):
+    """Read the Prometheus text from /metrics into {(name, labels): value}, summed over the workers"""
+    samples = {}
+    for line in text.splitlines():
+        match = metric_line.match(line)
+        if match is not None:
+            labels = worker_label.sub("", match.group(2) or "")
+            key = (match.group(1), "" if labels == "{}" else labels)
+            samples[key] = samples.get(key, 0) + float(match.group(3))
+    return samples
+
+
+def histogram_delta(before, after, name):
+    """Get (count, sum, {bucket bound: count}) observed between two scrapes of a histogram"""
+    def value(key):
+        return after.get(key, 0) - before.get(key, 0)
+    buckets = {}
+    for key in after:
+        if key[0] == name + "_bucket":
+            bound = re.search(r'le="([^"]+)"', key[1]).group(1)
+            buckets[float("inf") if bound == "+Inf" else float(bound)] = value(key)
+    return value((name + "_count", "")), value((name + "_sum", "")), buckets
+
+
+def bucket_percentile(count, buckets, p):
+    # Histograms only know which bucket a value fell in, report the bucket's upper bound
+    if count <= 0:
+        return None
+    for bound in sorted(buckets):
+        if buckets[bound] >= count * p / 100.0:
+            return bound
+    return None
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=bench_dir,
+                stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def find_bin(data, i=0):
+    """Walk the packed msgpack value at i by its type bytes, returns (end, whether it holds a bin)"""
+    b = bytearray(data[i:i + 1])[0]
+    if b <= 0x7f or b >= 0xe0 or b in (0xc0, 0xc2, 0xc3):
+        return i + 1, False
+    if 0xa0 <= b <= 0xbf:
+        return i + 1 + (b & 0x1f), False
+    if 0xc4 <= b <= 0xc6:
+        return i, True
+    if 0x80 <= b <= 0x9f:
+        count, i = (b & 0x0f) * (2 if b <= 0x8f else 1), i + 1
+    elif b in (0xdc, 0xdd, 0xde, 0xdf):
+        size = 2 if b in (0xdc, 0xde) else 4
+        count = struct.unpack(">H" if size == 2 else ">I", data[i + 1:i + 1 + size])[0]
+        count, i = count * (2 if b >= 0xde else 1), i + 1 + size
+    elif b in (0xd9, 0xda, 0xdb, 0xc7, 0xc8, 0xc9):
+        # str 8/16/32 and ext 8/16/32 (ext has a type byte after the length)
+        size = {0xd9: 1, 0xda: 2, 0xdb: 4, 0xc7: 1, 0xc8: 2, 0xc9: 4}[b]
+        length = struct.unpack({1: ">B", 2: ">H", 4: ">I"}[size], data[i + 1:i + 1 + size])[0]
+        return i + 1 + size + length + (1 if b <= 0xc9 else 0), False
+    else:
+        # Fixed size numbers and fixext
+        sizes = {0xca: 4, 0xcb: 8, 0xcc: 1, 0xcd: 2, 0xce: 4, 0xcf: 8, 0xd0: 1, 0xd1: 2, 0xd2: 4, 0xd3: 8,
+                0xd4: 2, 0xd5: 3, 0xd6: 5, 0xd7: 9, 0xd8: 17}
+        return i + 1 + sizes[b], False
+    for _ in range(0, count):
+        i, found = find_bin(data, i)
+        if found:
+            return i, True
+    return i, False
+
+
+class Stats(object):
+    def __init__(self):
+        self._latencies = dict((op, []) for op in operations)
+        self._errors = dict((op, 0) for op in operations)
+        self.messages = 0
+        self.message_bytes = 0
+
+    def observe(self, op, seconds):
+        if op is not None:
+            self._latencies[op].append(seconds)
+
+    def merge(self, op, count, seconds):
+        """Replace the last count latencies with one (the pages of a list are one list)"""
+        self._latencies[op][-count:] = [seconds]
+
+    def error(self, op):
+        if op is not None:
+            self._errors[op] += 1
+
+    def summary(self):
+        return dict((op, summarize(self._latencies[op], self._errors[op])) for op in operations
+                if len(self._latencies[op]) > 0 or self._errors[op] > 0)
+
+
+class Client(object):
+    """A websocket client that runs one operation at a time"""
+    def __init__(self, stats, encoding="json"):
+        self._stats = stats
+        self._encoding = encoding
+        self._messages = queues.Queue()
+        self._connection = None
+        self._next_id = 0
+
+    @gen.coroutine
+    def connect(self, port):
+        self._connection = yield websocket.websocket_connect("ws://127.0.0.1:%d/?encoding=%s" % (port,
+                self._encoding), on_message_callback=self._on_message)
+        status = yield self._messages.get(ioloop.IOLoop.current().time() + op_timeout)
+        if isinstance(status, Exception):
+            raise status
+        if status is None or status.get("encoding") != self._encoding:
+            raise IOError("The server didn't switch to %s (encodings: %s)" % (self._encoding,
+                    ", ".join(status.get("encodings", [])) if status is not None else "closed"))
+
+    def _on_message(self, message):
+        if message is not None:
+            self._stats.messages += 1
+            self._stats.message_bytes += len(message)
+            if isinstance(message, bytes):
+                if find_bin(message)[1]:
+                    message = IOError("The server packed strings as bin: %r" % message[:80])
+                else:
+                    message = msgpack.unpackb(message, raw=False)
+            else:
+                message = loads(message)
+        self._messages.put(message)
+
+    def _write(self, message):
+        if self._encoding == "msgpack":
+            self._connection.write_message(msgpack.packb(message, use_bin_type=str is not bytes), binary=True)
+        else:
+            self._connection.write_message(dumps(message))
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+
+    def new_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    @gen.coroutine
+    def request(self, op, message, done):
+        """Send a message and read until done(reply) is True, returns the reply (None on error)
+
+        The time it took is recorded under op unless op is None
+        """
+        start = default_timer()
+        deadline = ioloop.IOLoop.current().time() + op_timeout
+        self._write(message)
+        while True:
+            try:
+                reply = yield self._messages.get(deadline)
+            except gen.TimeoutError:
+                reply = {"exec": "error", "message": "Timed out", "id": message.get("id")}
+            if reply is None:
+                raise IOError("The server closed the connection")
+            if isinstance(reply, Exception):
+                raise reply
+            if reply["exec"] in ("error", "busy") and reply.get("id") == message.get("id"):
+                print("%s failed: %s" % (op, reply.get("message")), file=sys.stderr)
+                self._stats.error(op)
+                raise gen.Return(None)
+            if done(reply):
+                self._stats.observe(op, default_timer() - start)
+                raise gen.Return(reply)
+
+    @gen.coroutine
+    def list_all(self, page_size=500):
+        """List every page of the catalog, returns the apps"""
+        apps = []
+        page = 0
+        start = default_timer()
+        while True:
+            reply = yield self.request("list", {"exec": "list", "page": page, "page_size": page_size},
+                    lambda d: d["exec"] == "list")
+            if reply is None:
+                raise gen.Return(None)
+            apps += reply["apps"]
+            page += 1
+            if page >= reply["pages"]:
+                break
+        # One list is every page, not the last request
+        self._stats.merge("list", page, default_timer() - start)
+        raise gen.Return(apps)
+
+
+class Server(object):
+    def __init__(self, work_dir, apps_dir, icons_dir, args):
+        self._port = args.port
+        self._encoding = args.encoding
+        self._process = None
+        data_dir = join(work_dir, "data")
+        home = join(work_dir, "home")
+        for d in (data_dir, home):
+            if not isdir(d):
+                makedirs(d)
+        with open(join(data_dir, "hide.list"), "w") as f:
+            f.write("")
+        self._env = dict(environ)
+        self._env.update({
+            "PATH": join(bench_dir, "fakebin") + pathsep + environ.get("PATH", ""),
+            "PYTHONPATH": pathsep.join(filter(None, [join(bench_dir, "fakes"), environ.get("PYTHONPATH")])),
+            "HOME": home,
+            "CRI_BENCH_PORT": str(args.port),
+            "CRI_BENCH_APPS": apps_dir,
+            "CRI_BENCH_DATA": data_dir,
+            "CRI_BENCH_ICONS": icons_dir,
+            "CRI_BENCH_PACKAGES": str(args.packages),
+            "CRI_BENCH_CACHE_SECONDS": str(args.cache_seconds),
+            "CRI_BENCH_COMMIT_SECONDS": str(args.commit_seconds),
+            "CRI_BENCH_VNC_SECONDS": str(args.vnc_seconds),
+            "CRI_BENCH_WORKERS": str(args.workers)
+        })
+
+    def rss_kb(self):
+        # The server and the workers and coordinator it forked, not the displays they started
+        pids = [self._process.pid]
+        for entry in listdir("/proc"):
+            try:
+                with open("/proc/%s/stat" % entry, "r") as f:
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == self._process.pid:
+                        pids.append(int(entry))
+            except (IOError, OSError, ValueError, IndexError):
+                pass
+        total = None
+        for pid in pids:
+            try:
+                with open("/proc/%d/status" % pid, "r") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            total = (total or 0) + int(line.split()[1])
+            except (IOError, ValueError):
+                pass
+        return total
+
+    @gen.coroutine
+    def _listening(self, client):
+        try:
+            stream = yield client.connect("127.0.0.1", self._port)
+        except IOError:
+            raise gen.Return(False)
+        stream.close()
+        raise gen.Return(True)
+
+    @gen.coroutine
+    def start(self):
+        """Start the server, returns the seconds it took to accept connections"""
+        client = tcpclient.TCPClient()
+        listening = yield self._listening(client)
+        if listening:
+            raise IOError("Something is already listening on %d, is CRI running?" % self._port)
+        start = default_timer()
+        self._process = subprocess.Popen([sys.executable, join(bench_dir, "serve.py")], env=self._env)
+        deadline = start + start_timeout
+        while True:
+            listening = yield self._listening(client)
+            if listening:
+                break
+            if default_timer() > deadline or self._process.poll() is not None:
+                raise IOError("The server didn't start listening on %d" % self._port)
+            yield gen.sleep(0.01)
+        raise gen.Return(default_timer() - start)
+
+    @gen.coroutine
+    def scrape(self):
+        response = yield httpclient.AsyncHTTPClient().fetch("http://127.0.0.1:%d/metrics" % self._port)
+        raise gen.Return(parse_metrics(response.body.decode("utf-8")))
+
+    @gen.coroutine
+    def stop(self):
+        if self._process is None or self._process.poll() is not None:
+            return
+        self._process.send_signal(signal.SIGTERM)
+        deadline = default_timer() + stop_timeout
+        while self._process.poll() is None and default_timer() < deadline:
+            yield gen.sleep(0.05)
+        if self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+
+
+@gen.coroutine
+def measure_start(server, stats):
+    """Time until the server listens and until its catalog is listed, returns (times, apps)"""
+    start = default_timer()
+    listen = yield server.start()
+    client = Client(stats, server._encoding)
+    yield client.connect(server._port)
+    apps = yield client.list_all()
+    listed = default_timer() - start
+    client.close()
+    raise gen.Return(({"listen": listen, "list": listed}, apps))
+
+
+@gen.coroutine
+def run_client(i, args, ops, apps, stats, master_ready, finished):
+    client = Client(stats, args.encoding)
+    try:
+        yield client.connect(args.port)
+        if i == 0:
+            try:
+                yield client.request(None, {"exec": "set_master", "status": True}, lambda d: d["exec"] == "set_master")
+            finally:
+                master_ready.set()
+        else:
+            yield master_ready.wait()
+        yield run_rounds(client, i, args, ops, apps)
+    finally:
+        # The master keeps everyone's programs alive, nobody leaves until everyone is done
+        finished[0] -= 1
+        if finished[0] == 0:
+            finished[1].set()
+        yield finished[1].wait()
+        client.close()
+
+
+@gen.coroutine
+def run_rounds(client, i, args, ops, apps):
+    for r in range(0, args.rounds):
+        job = i * args.rounds + r
+        if "list" in ops:
+            yield client.list_all()
+        if "search" in ops:
+            search_id = client.new_id()
+            yield client.request("search", {"exec": "search", "search": search_words[job % len(search_words)],
+                    "id": search_id}, lambda d: d["exec"] == "search_done" and d.get("id") == search_id)
+        if "run" in ops:
+            name = apps[job % len(apps)]["exec"].strip()
+            loaded = yield client.request("run", {"exec": "run", "name": name},
+                    lambda d: d["exec"] == "load" and d.get("name") == name)
+            if loaded is not None and "kill" in ops:
+                yield client.request("kill", {"exec": "kill", "uuid": loaded["uuid"]}, lambda d: d["exec"] == "kill")
+        if "install" in ops:
+            install_id = client.new_id()
+            yield client.request("install", {"exec": "install", "install": "pkg%d" % job, "id": install_id},
+                    lambda d: d["exec"] == "install_done" and d.get("id") == install_id)
+
+
+@gen.coroutine
+def bench(args):
+    ops = [op for op in args.ops.split(",") if op in operations]
+    work_dir = mkdtemp(prefix="cri-load-")
+    stats = Stats()
+    memory = []
+    sampler = None
+    try:
+        apps_dir, icons_dir = make_tree(work_dir, args.apps)
+        server = Server(work_dir, apps_dir, icons_dir, args)
+
+        # A cold start reads every desktop file, a warm one has the catalog snapshot
+        print("Starting the server with %d apps and %d packages" % (args.apps, args.packages))
+        cold, apps = yield measure_start(server, Stats())
+        yield server.stop()
+        warm, apps = yield measure_start(server, Stats())
+        if apps is None or len(apps) == 0:
+            raise IOError("The server didn't list any apps")
+
+        sampler = ioloop.PeriodicCallback(lambda: memory.append(server.rss_kb()), sample_interval * 1000)
+        sampler.start()
+        memory.append(server.rss_kb())
+        before = yield server.scrape()
+
+        print("Running %d clients for %d rounds of %s" % (args.clients, args.rounds, ", ".join(ops)))
+        start = default_timer()
+        master_ready = locks.Event()
+        finished = [args.clients, locks.Event()]
+        yield [run_client(i, args, ops, apps, stats, master_ready, finished) for i in range(0, args.clients)]
+        duration = default_timer() - start
+
+        after = yield server.scrape()
+        memory.append(server.rss_kb())
+        sampler.stop()
+        yield server.stop()
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        if "server" in locals():
+            yield server.stop()
+        if args.keep:
+            print("Kept the scratch directory %s" % work_dir)
+        else:
+            rmtree(work_dir, ignore_errors=True)
+
+    count, total, buckets = histogram_delta(before, after, "cri_ioloop_lag_seconds")
+    memory = [m for m in memory if m is not None]
+    launch = {}
+    for phase in ("vncserver", "display_ready", "app", "total"):
+        n = after.get(("cri_launch_seconds_count", '{phase="%s"}' % phase), 0) - \
+                before.get(("cri_launch_seconds_count", '{phase="%s"}' % phase), 0)
+        s = after.get(("cri_launch_seconds_sum", '{phase="%s"}' % phase), 0) - \
+                before.get(("cri_launch_seconds_sum", '{phase="%s"}' % phase), 0)
+        if n > 0:
+            launch[phase] = s / n
+    raise gen.Return({
+        "label": args.label,
+        "time": datetime.now().isoformat(),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "settings": {
+            "clients": args.clients,
+            "rounds": args.rounds,
+            "apps": args.apps,
+            "packages": args.packages,
+            "ops": ops,
+            "cache_seconds": args.cache_seconds,
+            "commit_seconds": args.commit_seconds,
+            "vnc_seconds": args.vnc_seconds,
+            "workers": args.workers,
+            "encoding": args.encoding
+        },
+        "startup": {"cold": cold, "warm": warm},
+        "operations": stats.summary(),
+        "server_launch_mean": launch,
+        "messages": {
+            "count": stats.messages,
+            "bytes": stats.message_bytes,
+            "per_second": stats.messages / duration
+        },
+        "ioloop": {
+            "blocked_seconds": total,
+            "checks": count,
+            "p50": bucket_percentile(count, buckets, 50),
+            "p99": bucket_percentile(count, buckets, 99)
+        },
+        "memory": {
+            "start_kb": memory[0] if len(memory) > 0 else None,
+            "peak_kb": max(memory) if len(memory) > 0 else None,
+            "end_kb": memory[-1] if len(memory) > 0 else None
+        },
+        "duration": duration
+    })
+
+
+def report(results):
+    def ms(value):
+        return "%9s" % "-" if value is None else "%9.1f" % (value * 1000)
+    print("\nStartup      listen %s ms   list %s ms (cold)" % (ms(results["startup"]["cold"]["listen"]),
+            ms(results["startup"]["cold"]["list"])))
+    print("             listen %s ms   list %s ms (warm)" % (ms(results["startup"]["warm"]["listen"]),
+            ms(results["startup"]["warm"]["list"])))
+    print("\n%-10s %6s %6s %s %s %s %s %s" % ("operation", "count", "errors", "  mean ms", "   p50 ms",
+            "   p90 ms", "   p99 ms", "   max ms"))
+    for op in operations:
+        s = results["operations"].get(op)
+        if s is not None:
+            print("%-10s %6d %6d %s %s %s %s %s" % (op, s["count"], s["errors"], ms(s["mean"]), ms(s["p50"]),
+                    ms(s["p90"]), ms(s["p99"]), ms(s["max"])))
+    print("\nMessages     %d (%.1f/s, %d bytes)" % (results["messages"]["count"], results["messages"]["per_second"],
+            results["messages"]["bytes"]))
+    print("IOLoop       blocked %.3f s over %d checks (p50 <= %s ms, p99 <= %s ms)" % (results["ioloop"]["blocked_seconds"],
+            results["ioloop"]["checks"], ms(results["ioloop"]["p50"]).strip(), ms(results["ioloop"]["p99"]).strip()))
+    print("Memory       %s kB at start, %s kB peak, %s kB at the end" % (results["memory"]["start_kb"],
+            results["memory"]["peak_kb"], results["memory"]["end_kb"]))
+
+
+def flatten(results, prefix=""):
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, "%s%s." % (prefix, key)))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+
+def compare(old, new):
+    """Print how every number changed since an earlier run"""
+    old_values = flatten(dict((k, old[k]) for k in old if k != "settings"))
+    new_values = flatten(dict((k, new[k]) for k in new if k != "settings"))
+    print("\nCompared to %s (%s)" % (old.get("label") or old.get("commit"), old.get("time")))
+    if old.get("settings") != new.get("settings"):
+        print("The runs used different settings (%s vs %s)" % (dumps(old.get("settings")), dumps(new.get("settings"))))
+    for key in sorted(set(old_values) & set(new_values)):
+        before, after = old_values[key], new_values[key]
+        change = "" if before == 0 else "%+7.1f%%" % ((after - before) * 100.0 / before)
+        print("%-40s %14.4f -> %14.4f %s" % (key, before, after, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the CRI server with fake backends")
+    parser.add_argument("--clients", type=int, default=10, help="concurrent websocket clients")
+    parser.add_argument("--rounds", type=int, default=3, help="times every client runs the operations")
+    parser.add_argument("--ops", default=",".join(operations), help="comma separated operations to run")
+    parser.add_argument("--apps", type=int, default=500, help="desktop files in the applications directory")
+    parser.add_argument("--packages", type=int, default=2000, help="packages in the fake apt cache")
+    parser.add_argument("--cache-seconds", type=float, default=0, help="time the fake apt cache takes to open")
+    parser.add_argument("--commit-seconds", type=float, default=1, help="time a fake apt commit takes")
+    parser.add_argument("--vnc-seconds", type=float, default=0.2, help="time a fake display takes to start")
+    parser.add_argument("--workers", type=int, default=1, help="server worker processes")
+    parser.add_argument("--encoding", default="json", choices=["json", "msgpack"],
+            help="what the clients and the server talk")
+    parser.add_argument("--port", type=int, default=3300, help="the port the server listens on")
+    parser.add_argument("--label", default=None, help="a name for this run in the results")
+    parser.add_argument("--output", default=None, help="where to save the results (bench/results/<time>.json)")
+    parser.add_argument("--compare", default=None, help="results of an earlier run to compare against")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory (logs, state)")
+    args = parser.parse_args()
+    if args.encoding == "msgpack" and msgpack is None:
+        parser.error("--encoding msgpack needs the msgpack module")
+
+    results = ioloop.IOLoop.current().run_sync(lambda: bench(args))
+    report(results)
+    output = args.output
+    if output is None:
+        if not isdir(results_dir):
+            makedirs(results_dir)
+        output = join(results_dir, "%s.json" % datetime.now().strftime("%Y%m%d-%H%M%S"))
+    with open(output, "w") as f:
+        f.write(dumps(results, indent=2, sort_keys=True))
+    print("\nSaved the results to %s" % output)
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            compare(loads(f.read()), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,15 +8,23 @@ Developed By: David Smerkous and Eli Smith
 """
 
 from logger import Logger
-from os.path import dirname, realpath, isdir, exists, join, basename, splitext
-from os import makedirs, walk, remove
+from os.path import dirname, realpath, isdir, exists, join, basename, splitext, getmtime
+from os import makedirs, walk, remove, rename, getpid
 from apt import cache, package
-from apt.progress.base import AcquireProgress, InstallProgress
-import base64
-import mimetypes
-import socket
+from icons import store as icon_store
+from watcher import DirectoryWatcher
+from search import PackageIndex
+from connectivity import ConnectivityMonitor
+from metrics import Histogram
+from timeit import default_timer
+from tornado import gen, locks
+from distutils.spawn import find_executable
+import desktop
+from collections import OrderedDict
+from json import loads, dumps
+from time import time
+import threading as thread
 import fnmatch
-import gtk
 import re
 
 # Configs
@@ -26,83 +34,69 @@ config_dir = "/etc/cri/serve-chroot"
 remote_test_server = "8.8.8.8"
 remote_test_port = 53
 icon_theme = "Numix"
-theme = gtk.IconTheme()
-theme.set_custom_theme(icon_theme)
 icon_size = 256
-default_icon = theme.lookup_icon("exec", icon_size, 0) 
+search_limit = 50 # The most results a search sends back
+index_timeout = 30 # Seconds a search waits for the package index to be built
+cache_timeout = 60 # Seconds an install or delete waits for the package cache to open
+search_cache_size = 64 # Recent search results to keep
+snapshot_file = "/tmp/cri.catalog" # The catalog from the last run, so a restart can list apps right away
+snapshot_format = 1 # Bump when the snapshot layout changes
+load_chunk = 50 # Desktop files read between IOLoop turns on the first load
+app_locales = desktop.locale_names()
 
 # Global locked variables
 app_list = []
-cche = cache.Cache()
+app_entries = {} # desktop file path -> (mtime, application or None if it failed to load)
+app_listeners = []
+app_watcher = None
+catalog_epoch = "%x" % int(time() * 1000) # Made before the workers fork, so every worker of a run shares it
+catalog_version = 0 # Newest time (microseconds) among the files the catalog was read from
+catalog_start = None # The catalog version this process knows every change since
+app_versions = {} # app name -> catalog version it was added or last changed in
+removed_versions = {} # app name -> catalog version it was removed in
+hide_list = None
+hide_mtime = None
+catalog_ready = locks.Event() # Set once app_list holds the snapshot or a full scan
+snapshot_state = None # (directory mtimes, desktop file mtimes) the saved snapshot was made from
+theme = None # Loaded (along with gtk) the first time an icon is looked up
+default_icon = None
+theme_lock = thread.Lock()
+cche = None # Opened in the background by Package.open_cache
+cache_ready = thread.Event()
+package_index = PackageIndex()
+search_cache = OrderedDict() # (query, limit) -> package dicts, least recently used first
+search_cache_lock = thread.Lock()
+
+connection = ConnectivityMonitor(remote_test_server, remote_test_port)
+
+# Metrics
+catalog_seconds = Histogram("cri_catalog_seconds", "Time spent rescanning (scan) or updating (update) the application catalog", ["operation"])
+search_seconds = Histogram("cri_search_seconds", "Time spent answering package searches", ["source"])
+index_seconds = Histogram("cri_index_seconds", "Time spent building the package search index", buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+cache_seconds = Histogram("cri_cache_open_seconds", "Time spent opening the apt package cache", buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
 
 # Global functions 
 def check_internet():
-    try:
-        log.info("Checking for an internet connection...")
-        socket.setdefaulttimeout(1)
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((remote_test_server, remote_test_port))
-        log.info("Connected to the internet!")
-        return True
-    except:
-        pass
-    log.error("No internet connection!")
-    return False
-
-class CriFetchProgress(AcquireProgress):
-    def set_socket(self, websocket):
-        self._socket = websocket
-
-    def fail(self, item):
-        self._socket.send_dict({
-            "exec": "error",
-            "message": "Failed to install a resource! Make sure you're connected to the internet"
-        })
-
-    def pulse(self, owner):
-        self._socket.send_dict({
-            "exec": "aquire_status",
-            "count": self.current_items,
-            "total_count": self.total_items,
-            "bytes": self.fetched_bytes,
-            "total_bytes": self.total_bytes,
-            "bytes_second": self.current_cps
-        }, True)
-        return True
-
-class CriInstallProgress(InstallProgress):
-    def set_socket(self, websocket, flag="install"):
-        self._socket = websocket
-        self._flag = flag
-
-    def error(self, pkg, errormsg):
-        self._socket.send_dict({
-            "exec": "error",
-            "message": "Failed to %s %s (err: %s)" % (self._flag, pkg, errormsg)
-        })
-
-    def start_update(self):
-        log.info("Starting to %s package" % self._flag)
-        self._socket.send_dict({
-            "exec": "%s_start" % self._flag
-        }, True)
-
-    def finish_update(self):
-        log.info("Finished %s the package" % self._flag)
-        self._socket.send_dict({
-            "exec": "%s_finish" % self._flag
-        }, True)
-
-    def status_change(self, pkg, percent, status):
-        self._socket.send_dict({
-            "exec": "%s_status" % self._flag,
-            "package": pkg,
-            "percent": percent,
-            "status": status
-        }, True)
-
-# Define the progress objects
-f_progress = CriFetchProgress()
-i_progress = CriInstallProgress()
+    # Until the first probe comes back let apt find out for itself
+    return connection.is_online() is not False
+
+def lookup_icon(name):
+    """Get the icon for name from the theme, None when the theme doesn't have one"""
+    global theme, default_icon
+    with theme_lock:
+        if theme is None:
+            # Importing gtk and loading the theme is slow, only pay for it once an icon is needed
+            import gtk
+            loaded = gtk.IconTheme()
+            loaded.set_custom_theme(icon_theme)
+            default_icon = loaded.lookup_icon("exec", icon_size, 0)
+            theme = loaded
+        return theme.lookup_icon(name, icon_size, 0)
+
+def get_default_icon():
+    if theme is None:
+        lookup_icon("exec")
+    return default_icon
 
 class Package(object):
     def __init__(self, name):
@@ -111,6 +105,7 @@ class Package(object):
         self._comment = None
         self._icon_type = "png"
         self._icon_path = None
+        self._icon_hash = None
         self._version = None
         self._essential = False
         self._size = None
@@ -123,11 +118,12 @@ class Package(object):
         self._comment = c.summary
         
         # Get the full icon path
-        icon = theme.lookup_icon(self._name, icon_size, 0)
+        icon = lookup_icon(self._name)
         if icon is None:
             self._icon_type = None
-            icon = default_icon
+            icon = get_default_icon()
         self._icon_path = icon.get_filename()
+        self._icon_hash = icon_store.add(self._icon_path)
 
         self._version = c.version
         self._essential = pack.essential
@@ -136,18 +132,14 @@ class Package(object):
         self._upgradable = pack.is_upgradable
 
     def get_dict(self, load_icon=True):
-        icon_data = None
-        if load_icon and self._icon_path is not None:
-            icon_data = "data:%s;base64," % mimetypes.guess_type(self._icon_path)[0]
-            with open(self._icon_path, 'rb') as ld:
-                icon_data += base64.encodestring(ld.read()).replace("\n", "")
-        
+        icon_hash = self._icon_hash if load_icon else None
         return {
             "name": self._name,
             "full_name": self._full_name,
             "comment": self._comment,
             "icon_type": self._icon_type,
-            "icon": icon_data,
+            "icon": icon_store.get_url(icon_hash),
+            "icon_hash": icon_hash,
             "version": self._version,
             "essential": self._essential,
             "size": self._size,
@@ -156,137 +148,196 @@ class Package(object):
         }
 
     @staticmethod
-    def reload_cache(websocket):
+    def open_cache():
+        """Open the apt cache and index it, this runs on its own thread at start up"""
+        global cche
+        log.info("Opening the package cache...")
+        try:
+            with cache_seconds.time():
+                cche = cache.Cache()
+        except Exception as err:
+            log.error("Failed to open the package cache! (err: %s)" % str(err))
+            return
+        cache_ready.set()
+        log.info("Indexing the available packages...")
+        Package.build_index()
+        log.info("Done indexing %d packages" % package_index.size())
+
+    @staticmethod
+    def wait_cache(timeout=cache_timeout):
+        return cache_ready.wait(timeout)
+
+    @staticmethod
+    def reload_cache():
         log.info("Reloading cache")
         try:
             cche.open(None)
+            Package.build_index()
+            with search_cache_lock:
+                search_cache.clear()
         except Exception as err:
             log.error("Failed to reload cache %s" % str(err))
-            websocket.send_dict({
-                "exec": "error",
-                "message": "Failed to reload cache"
-            }, True)
+            return "Failed to reload cache"
         log.info("Done reloading cache")
+        return None
 
     @staticmethod
-    def search(name, websocket):
-        try:
-            if not check_internet():
-                return "No internet connection"
-            for p in cche.keys():
-                if name in p:
-                    if cche[p].candidate.downloadable:
-                        p_add = Package(p)
-                        p_add.load(cche[p])
-                        websocket(p_add.get_dict())
-            return None
-        except Exception as err:
-            log.error("Failed to search packages! (err: %s)" % str(err))
-            return str(err)
+    def build_index():
+        def entries():
+            for pack in cche:
+                c = pack.candidate
+                if c is not None and c.downloadable:
+                    yield (pack.name, pack.shortname, c.summary)
+        with index_seconds.time():
+            package_index.build(entries())
 
     @staticmethod
-    def install(name, websocket):
+    def search(name, websocket, limit=search_limit, cancelled=lambda: False):
         try:
             if not check_internet():
                 return "No internet connection"
-            
-            if name not in cche:
-                return "Package not found!"
-
-            # Mark the package for install
-            cche[name].mark_install(auto_fix=True, auto_inst=True, from_user=True)
-
-            if not cche[name].marked_install or cche[name].is_installed:
-                return "Package is already installed"
-
-
-            websocket.send_dict({
-                "exec": "aquire_start"
-            })
-
-            f_progress.set_socket(websocket)
-            i_progress.set_socket(websocket, "install")
-            cche.commit(f_progress, i_progress)
+            if not package_index.wait(index_timeout):
+                return "The package list is still loading"
+
+            # Recent searches are answered straight from the cache
+            start = default_timer()
+            key = (name.strip().lower(), limit)
+            with search_cache_lock:
+                results = search_cache.pop(key, None)
+                if results is not None:
+                    search_cache[key] = results
+            if results is not None:
+                for d in results:
+                    if cancelled():
+                        return None
+                    websocket(d)
+                search_seconds.observe(default_timer() - start, "cache")
+                return None
+
+            # Only the packages we send back get their details (and icons) loaded
+            results = []
+            for p in package_index.search(name, limit):
+                if cancelled():
+                    return None # Don't cache a search that was cut short
+                if p in cche:
+                    p_add = Package(p)
+                    p_add.load(cche[p])
+                    d = p_add.get_dict()
+                    results.append(d)
+                    websocket(d)
+            with search_cache_lock:
+                search_cache[key] = results
+                while len(search_cache) > search_cache_size:
+                    search_cache.popitem(last=False)
+            search_seconds.observe(default_timer() - start, "index")
             return None
         except Exception as err:
-            log.error("Failed to install package! (err: %s)" % str(err))
+            log.error("Failed to search packages! (err: %s)" % str(err))
             return str(err)
 
     @staticmethod
-    def delete(name, websocket, purge):
-        try:
-            if name not in cche:
-                return "Package not found!"
-
-            # Mark the package for install
-            cche[name].mark_delete(auto_fix=True, purge=purge)
+    def mark_install(name):
+        """Mark a package (and its dependencies) for the next commit, returns an error or None"""
+        if not check_internet():
+            return "No internet connection"
+        if not Package.wait_cache():
+            return "The package list is still loading"
+        if name not in cche:
+            return "Package not found!"
+        if cche[name].is_installed:
+            return "Package is already installed"
+        cche[name].mark_install(auto_fix=True, auto_inst=True, from_user=True)
+        if not cche[name].marked_install:
+            return "Package can't be installed"
+        return None
 
-            if not cche[name].marked_delete or not cche[name].is_installed:
-                return "Package is not installed"
+    @staticmethod
+    def mark_delete(name, purge):
+        if not Package.wait_cache():
+            return "The package list is still loading"
+        if name not in cche:
+            return "Package not found!"
+        if not cche[name].is_installed:
+            return "Package is not installed"
+        cche[name].mark_delete(auto_fix=True, purge=purge)
+        if not cche[name].marked_delete:
+            return "Package can't be removed"
+        return None
 
+    @staticmethod
+    def is_marked(name, action):
+        if action == "install":
+            return cche[name].marked_install
+        return cche[name].marked_delete
 
-            websocket.send_dict({
-                "exec": "aquire_start"
-            }, True)
+    @staticmethod
+    def is_broken():
+        return cche.broken_count > 0
 
-            f_progress.set_socket(websocket)
-            i_progress.set_socket(websocket, "delete")
-            cche.commit(f_progress, i_progress)
-            return None
-        except Exception as err:
-            log.error("Failed to install package! (err: %s)" % str(err))
-            return str(err)
+    @staticmethod
+    def clear_marks():
+        if cche is not None:
+            cche.clear()
 
+    @staticmethod
+    def commit(fetch_progress, install_progress):
+        """Install and remove everything that's marked, this holds the dpkg lock"""
+        cche.commit(fetch_progress, install_progress)
 
 
 class Application(object):
+    __slots__ = ("_name", "_full_name", "_icon_name", "_icon_path", "_icon_hash",
+            "_exec", "_comment", "_version")
+
     def __init__(self, name):
         self._name = name
         self._full_name = None
         self._icon_name = "exec"
         self._icon_path = None
+        self._icon_hash = None
         self._exec = None
         self._comment = None
         self._version = None
 
-    def _g_prop(self, c, to_get, default=None):
-        if ("%s=" % to_get) not in c:
-            return default
-        filtered = filter(None, re.findall(r"%s=(.*?)\n" % to_get, c, re.DOTALL))
-        if len(filtered) == 0:
-            return None
-        return filtered[0]
-    
     def load(self, desktop_file):
-        with open(desktop_file, 'r') as d:
-            dc = d.read()
-            self._full_name = self._g_prop(dc, "Name")
-            self._icon_name = self._g_prop(dc, "Icon", "exec")
-            self._exec = self._g_prop(dc, "Exec")
+        try:
+            entry = desktop.parse(desktop_file, app_locales)
+        except (IOError, OSError) as err:
+            log.error("Failed to read %s (err: %s)" % (desktop_file, str(err)))
+            return False
+        if entry is None or not entry.is_visible():
+            log.debug("Application %s isn't meant to be shown" % self._name)
+            return False
+        if entry.try_exec is not None and find_executable(entry.try_exec) is None:
+            log.debug("Application %s isn't installed (%s is missing)" % (self._name, entry.try_exec))
+            return False
+        self._full_name = entry.name
+        self._icon_name = entry.icon or "exec"
+        self._exec = entry.exec_line
+        if self._exec is None:
+            log.warning("Application %s doesn't have an exec!" % self._name)
+            self._exec = entry.try_exec
             if self._exec is None:
-                log.warning("Application %s doesn't have an exec!" % self._name)
-                self._exec = self._g_prop(dc, "TryExec")
-                if self._exec is None:
-                    log.error("Failed to load %s! There's no executable!")
-                    return False
-            self._comment = self._g_prop(dc, "Comment")
-            self._version = self._g_prop(dc, "Version")
-            return True
+                log.error("Failed to load %s! There's no executable!" % self._name)
+                return False
+        self._comment = entry.comment
+        self._version = entry.version
+        return True
 
     def fix(self):
         if self._full_name is None:
             self._full_name = self._name
 
         # Remove the optional command arguments
-        print(self._exec)
         self._exec = re.sub(r'%\w', '', self._exec)
         
         # Get the full icon path
-        icon = theme.lookup_icon(self._icon_name, icon_size, 0)
+        icon = lookup_icon(self._icon_name)
         if icon is None:
-            icon = default_icon
+            icon = get_default_icon()
         self._icon_path = icon.get_filename()
-        log.info("Found icon at %s (executable: %s)" % (self._icon_path, self._exec))
+        self._icon_hash = icon_store.add(self._icon_path)
+        log.debug("Found icon at %s (executable: %s)" % (self._icon_path, self._exec))
 
     def get_dict(self, load_icon=True):
         try:
@@ -295,16 +346,13 @@ class Application(object):
             log.error("Failed to load icon type %s (err: %s)" % (load_icon, str(err)))
             icon_type = None
 
-        icon_data = None
-        if load_icon and self._icon_path is not None:
-            icon_data = "data:%s;base64," % mimetypes.guess_type(self._icon_path)[0]
-            with open(self._icon_path, 'rb') as ld:
-                icon_data += base64.encodestring(ld.read()).replace("\n", "")
+        icon_hash = self._icon_hash if load_icon else None
         return {
             "name": self._name,
             "full_name": self._full_name,
             "icon_type": icon_type, 
-            "icon": icon_data,
+            "icon": icon_store.get_url(icon_hash),
+            "icon_hash": icon_hash,
             "exec": self._exec,
             "comment": self._comment,
             "version": self._version
@@ -313,35 +361,292 @@ class Application(object):
     def get_name(self):
         return self._full_name
 
+    def get_snapshot(self):
+        return [getattr(self, slot) for slot in Application.__slots__]
+
+    @staticmethod
+    def from_snapshot(values):
+        app = Application(values[0])
+        for slot, value in zip(Application.__slots__, values):
+            setattr(app, slot, value)
+        icon_store.add_known(app._icon_path, app._icon_hash)
+        return app
+
     @staticmethod
     def get_app_list():
         global app_list
         return app_list
 
     @staticmethod
-    def load_app_list():
-        global app_list
-        
+    def add_listener(listener):
+        app_listeners.append(listener)
+
+    @staticmethod
+    def _load_hide_list():
+        global hide_list, hide_mtime
+        path = "%s/hide.list" % config_dir
+        try:
+            mtime = getmtime(path)
+        except OSError:
+            mtime = None
+        if mtime == hide_mtime and hide_list is not None:
+            return False
+
         # Update the hide list
+        hide_mtime = mtime
         hide_list = []
         try:
-            with open("%s/hide.list" % config_dir, 'r') as hl:
+            with open(path, 'r') as hl:
                 hide_list = hl.read().split('\n')
         except Exception as err:
             log.error("Failed to load hide.list (err: %s)" % str(err))
-
-        # Check the applications by name
         log.info("Skipping applications %s" % str(hide_list))
-        d_files = [join(dirpath, f) for dirpath, dirnames, files in walk(applications_dir) for f in fnmatch.filter(files, "*.desktop")]
-        app_list = []
-        for d in d_files:
-            name = splitext(basename(d))[0]
-            if name in hide_list:
-                continue
-            log.info("Loading application %s" % name)
-            app = Application(name)
-            if app.load(d):
-                app.fix()
-                app_list.append(app)
-        app_list = sorted(app_list, key=lambda x: x.get_name())
-        log.info("Loaded a total of %d applications" % len(app_list))
+        return True
+
+    @staticmethod
+    def _load_entry(path):
+        try:
+            mtime = getmtime(path)
+        except OSError:
+            # The desktop file is gone
+            return app_entries.pop(path, None) is not None
+        known = app_entries.get(path)
+        if known is not None and known[0] == mtime:
+            return False
+        name = splitext(basename(path))[0]
+        log.debug("Loading application %s" % name)
+        app = Application(name)
+        if app.load(path):
+            app.fix()
+        else:
+            app = None
+        app_entries[path] = (mtime, app)
+        return True
+
+    @staticmethod
+    def _visible():
+        return dict((path, entry[1]) for path, entry in app_entries.items()
+                if entry[1] is not None and entry[1]._name not in hide_list)
+
+    @staticmethod
+    def _desktop_files():
+        return set(join(dirpath, f) for dirpath, dirnames, files in walk(applications_dir) for f in fnmatch.filter(files, "*.desktop"))
+
+    @staticmethod
+    def _directory_mtimes():
+        # Adding, removing or renaming a desktop file changes the mtime of its directory
+        mtimes = {}
+        for dirpath, dirnames, files in walk(applications_dir):
+            try:
+                mtimes[dirpath] = getmtime(dirpath)
+            except OSError:
+                pass
+        return mtimes
+
+    @staticmethod
+    def is_catalog_ready():
+        return catalog_ready.is_set()
+
+    @staticmethod
+    def wait_catalog():
+        """A future that's done once the catalog can be listed"""
+        return catalog_ready.wait()
+
+    @staticmethod
+    @gen.coroutine
+    def load_app_list():
+        """Fill the catalog at start up
+
+        A snapshot whose directories haven't changed is used as is, an out of date one is
+        listed right away and then checked file by file. Without a snapshot every desktop
+        file is read, a chunk at a time so the server keeps answering in the meantime
+        """
+        with catalog_seconds.time("snapshot"):
+            trusted = Application.load_snapshot()
+        if trusted:
+            log.info("Loaded %d applications from the catalog snapshot" % len(app_list))
+            return
+        start = default_timer()
+        mtimes = Application._directory_mtimes()
+        Application._load_hide_list()
+        before = Application._visible()
+        d_files = Application._desktop_files()
+        for path in [p for p in app_entries if p not in d_files]:
+            del app_entries[path]
+        d_files = list(d_files)
+        for i in range(0, len(d_files), load_chunk):
+            for path in d_files[i:i + load_chunk]:
+                Application._load_entry(path)
+            yield gen.moment
+        Application._publish(before, mtimes)
+        catalog_ready.set()
+        catalog_seconds.observe(default_timer() - start, "scan")
+
+    @staticmethod
+    def load_snapshot():
+        """Fill the catalog from the last run's snapshot, returns True when it's still up to date"""
+        global app_list, snapshot_state, catalog_version, catalog_start
+        if not exists(snapshot_file):
+            return False
+        try:
+            with open(snapshot_file, 'r') as f:
+                snapshot = loads(f.read())
+            if snapshot["format"] != snapshot_format or snapshot["directory"] != applications_dir or \
+                    snapshot["locales"] != list(app_locales) or snapshot["theme"] != [icon_theme, icon_size]:
+                log.info("The catalog snapshot was made with other settings, ignoring it")
+                return False
+            entries = dict((path, (mtime, None if values is None else Application.from_snapshot(values)))
+                    for path, mtime, values in snapshot["entries"])
+            mtimes = snapshot["directories"]
+        except (IOError, OSError, ValueError, KeyError, TypeError) as err:
+            log.error("Failed to read the catalog snapshot %s (err: %s)" % (snapshot_file, str(err)))
+            return False
+        app_entries.update(entries)
+        snapshot_state = (mtimes, Application._entry_mtimes())
+        Application._load_hide_list()
+        app_list = sorted(Application._visible().values(), key=lambda x: x.get_name())
+        catalog_version = catalog_start = Application._catalog_time(mtimes, snapshot_state[1])
+        catalog_ready.set()
+        return mtimes == Application._directory_mtimes()
+
+    @staticmethod
+    def _catalog_time(mtimes, entry_mtimes):
+        # Every change moves one of these forward: adding, removing or renaming a desktop file
+        # moves its directory's mtime, editing one moves its own and so does editing the hide list
+        times = list(mtimes.values()) + list(entry_mtimes.values()) + [hide_mtime or 0]
+        return int(max(times) * 1000000)
+
+    @staticmethod
+    def _entry_mtimes():
+        return dict((path, entry[0]) for path, entry in app_entries.items())
+
+    @staticmethod
+    def save_snapshot(mtimes):
+        global snapshot_state
+        snapshot = {
+            "format": snapshot_format,
+            "directory": applications_dir,
+            "locales": list(app_locales),
+            "theme": [icon_theme, icon_size],
+            "directories": mtimes,
+            "entries": [[path, mtime, None if app is None else app.get_snapshot()]
+                for path, (mtime, app) in app_entries.items()]
+        }
+        # Write a new file and swap it in so a crash (or another worker saving too) never leaves half a snapshot
+        temp = "%s.%d.tmp" % (snapshot_file, getpid())
+        try:
+            with open(temp, 'w') as f:
+                f.write(dumps(snapshot))
+            rename(temp, snapshot_file)
+            snapshot_state = (mtimes, Application._entry_mtimes())
+        except (IOError, OSError) as err:
+            log.error("Failed to save the catalog snapshot %s (err: %s)" % (snapshot_file, str(err)))
+
+    @staticmethod
+    def refresh_app_list(changed=None):
+        """Re-read only the desktop files that changed
+
+        changed is a set of paths that were touched, None rescans the directory and compares mtimes
+        """
+        with catalog_seconds.time("scan" if changed is None else "update"):
+            Application._refresh_app_list(changed)
+
+    @staticmethod
+    def _refresh_app_list(changed):
+        # The directories are looked at first so a change during the scan isn't missed by the snapshot
+        mtimes = Application._directory_mtimes()
+        before = Application._visible()
+        Application._load_hide_list()
+
+        # Check the applications by path
+        if changed is None:
+            d_files = Application._desktop_files()
+            for path in [p for p in app_entries if p not in d_files]:
+                del app_entries[path]
+            for path in d_files:
+                Application._load_entry(path)
+        else:
+            for path in changed:
+                if path.endswith(".desktop"):
+                    Application._load_entry(path)
+        Application._publish(before, mtimes)
+
+    @staticmethod
+    def _publish(before, mtimes):
+        """Update the app list and tell everyone what changed since before"""
+        global app_list, catalog_version, catalog_start
+        after = Application._visible()
+        events = []
+        for path, app in after.items():
+            if path not in before:
+                events.append({"exec": "app_added", "app": app.get_dict()})
+            elif before[path] is not app:
+                events.append({"exec": "app_changed", "app": app.get_dict()})
+        for path, app in before.items():
+            if path not in after:
+                events.append({"exec": "app_removed", "name": app._name})
+        # Most rescans (the fallback poll, after every apt batch) find nothing new
+        entry_mtimes = Application._entry_mtimes()
+        if snapshot_state != (mtimes, entry_mtimes):
+            Application.save_snapshot(mtimes)
+        catalog_version = Application._catalog_time(mtimes, entry_mtimes)
+        first = catalog_start is None
+        if first:
+            # There's nothing earlier to hand out changes since
+            catalog_start = catalog_version
+        if len(events) == 0:
+            log.debug("No applications changed (%d in the catalog)" % len(app_list))
+            return
+        app_list = sorted(after.values(), key=lambda x: x.get_name())
+        log.info("Loaded a total of %d applications (%d changes)" % (len(app_list), len(events)))
+
+        # Stamp everything that changed with the catalog version, apps of the first scan aren't changes
+        stamp = 0 if first else catalog_version
+        token = Application.get_catalog_token()
+        for event in events:
+            if event["exec"] == "app_removed":
+                name = event["name"]
+                app_versions.pop(name, None)
+                removed_versions[name] = stamp
+            else:
+                name = event["app"]["name"]
+                app_versions[name] = stamp
+                removed_versions.pop(name, None)
+            event["version"] = token
+        for event in events:
+            for listener in app_listeners:
+                listener(event)
+
+    @staticmethod
+    def get_catalog_token():
+        return "%s-%d" % (catalog_epoch, catalog_version)
+
+    @staticmethod
+    def get_catalog(since=None):
+        """Get (version token, apps, removed names, full) with only what changed since the given token
+
+        Versions are file times, so a token from any worker means the same here. Tokens from
+        another run of CRI, from before this worker started, from a worker that has seen changes
+        this one hasn't yet (or garbage) get the full catalog back. Timestamps are coarse, so apps
+        that changed at the token's own time are sent again
+        """
+        apps = app_list
+        since_version = None
+        try:
+            epoch, version = since.rsplit("-", 1)
+            if epoch == catalog_epoch and catalog_start <= int(version) <= catalog_version:
+                since_version = int(version)
+        except (AttributeError, ValueError):
+            pass
+        if since_version is None:
+            return Application.get_catalog_token(), apps, [], True
+        changed = [a for a in apps if app_versions.get(a._name, 0) >= since_version]
+        removed = [name for name, version in removed_versions.items() if version >= since_version]
+        return Application.get_catalog_token(), changed, removed, False
+
+    @staticmethod
+    def watch_app_list():
+        global app_watcher
+        if app_watcher is None:
+            app_watcher = DirectoryWatcher([applications_dir, config_dir], Application.refresh_app_list)
+            app_watcher.start()
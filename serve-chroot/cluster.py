@@ -0,0 +1,532 @@
+# -*- coding: utf-8 -*-
+"""CRI worker processes
+
+With worker_processes above 1 CRI forks that many workers that all accept connections on the
+same port, so list, search and icon traffic is spread over the cpus. A coordinator process owns
+what the workers have to share: the display slots, which worker runs which program, the apt
+transaction lock and whether a master connection exists anywhere. Workers reach it over a unix
+socket. Questions (a display slot, a program's port) are calls that wait for an answer, on the
+IOLoop they go over a stream of their own and give up after a timeout so a stalled coordinator
+never freezes a worker, only the apt thread blocks on them. Everything else (broadcasts,
+connection counts) goes over one event stream per worker that the coordinator also pushes on. The process that forked them all only supervises and starts dead workers again
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from logger import Logger, after_fork
+from ports import PortAllocator, CapacityError, Slot
+from tornado import gen, ioloop, locks
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.tcpserver import TCPServer
+from tornado.netutil import bind_unix_socket
+from tornado.concurrent import Future
+from tornado.platform.auto import set_close_exec
+from collections import deque
+from json import loads, dumps
+from os import fork, kill, waitpid, remove, _exit
+from os.path import exists
+from time import sleep, time
+import threading as thread
+import random
+import signal
+import socket
+import errno
+import sys
+
+# Configs
+coordinator_timeout = 10 # Seconds to wait for the coordinator to start listening
+restart_delay = 1 # Seconds to wait before starting a dead worker again
+max_line = 16 * 1024 * 1024 # The longest message allowed over the socket
+call_timeout = 5 # Seconds the IOLoop waits for the coordinator to answer a call
+scrape_timeout = 2 # Seconds the coordinator waits for the workers' metrics, slower ones are left out
+
+# Logs
+log = Logger("CLUSTER")
+
+
+def _line(message):
+    return (dumps(message) + "\n").encode("utf-8")
+
+
+class Coordinator(TCPServer):
+    def __init__(self, display_port, display_offset, size):
+        TCPServer.__init__(self, max_buffer_size=max_line)
+        self._allocator = PortAllocator(display_port, display_offset, size)
+        self._slots = {} # Slot index -> (worker, slot)
+        self._programs = {} # Program uuid -> (worker, rfb port)
+        self._workers = {} # Worker -> its event stream
+        self._connections = {} # Worker -> its open websocket connections
+        self._masters = set() # Workers with a master connection
+        self._apt_owner = None # The call stream holding the apt lock
+        self._apt_waiting = deque()
+        self._apt_version = 0 # Goes up after every commit so workers know their cache is stale
+        self._scrapes = {} # Scrape id -> (workers still to answer, their samples, future)
+        self._next_scrape = 0
+        self._calls = {
+            "allocate": self._allocate,
+            "release": self._release,
+            "lookup": self._lookup,
+            "kill": self._kill,
+            "profile": self._profile,
+            "metrics": self._metrics,
+            "apt_lock": self._apt_lock,
+            "apt_unlock": self._apt_unlock
+        }
+        self._events = {
+            "hello": self._hello,
+            "register": self._register,
+            "unregister": self._unregister,
+            "broadcast": self._broadcast,
+            "state": self._state,
+            "samples": self._samples
+        }
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        worker = None # Only set on event streams
+        try:
+            while True:
+                message = loads((yield stream.read_until(b"\n", max_bytes=max_line)).decode("utf-8"))
+                if "call" in message:
+                    try:
+                        result = yield gen.maybe_future(self._calls[message["call"]](stream, message["worker"],
+                            *message.get("args", [])))
+                        reply = {"result": result}
+                    except CapacityError as err:
+                        reply = {"error": str(err), "capacity": True}
+                    except Exception as err:
+                        log.error("Call %s failed (err: %s)" % (message["call"], str(err)))
+                        reply = {"error": str(err)}
+                    yield stream.write(_line(reply))
+                else:
+                    if message["event"] == "hello":
+                        worker = message["worker"]
+                        self._workers[worker] = stream
+                    self._events[message["event"]](message)
+        except StreamClosedError:
+            pass
+        finally:
+            self._closed(stream, worker)
+
+    def _push(self, worker, message):
+        stream = self._workers.get(worker)
+        if stream is None:
+            return
+        try:
+            stream.write(_line(message))
+        except StreamClosedError:
+            pass
+
+    def _push_all(self, message, skip=None):
+        for worker in list(self._workers):
+            if worker != skip:
+                self._push(worker, message)
+
+    def _allocate(self, stream, worker):
+        slot = self._allocator.allocate()
+        self._slots[slot.index] = (worker, slot)
+        return [slot.index, slot.display_num, slot.port]
+
+    def _release(self, stream, worker, index):
+        entry = self._slots.pop(index, None)
+        if entry is None:
+            return False
+        return self._allocator.release(entry[1])
+
+    def _lookup(self, stream, worker, uuid):
+        entry = self._programs.get(uuid)
+        return None if entry is None else entry[1]
+
+    def _relay(self, uuid, message):
+        # Programs are only changed by the worker that started them
+        entry = self._programs.get(uuid)
+        if entry is None:
+            return False
+        message["uuid"] = uuid
+        self._push(entry[0], message)
+        return True
+
+    def _kill(self, stream, worker, uuid):
+        return self._relay(uuid, {"event": "kill"})
+
+    def _profile(self, stream, worker, uuid, profile):
+        return self._relay(uuid, {"event": "profile", "profile": profile})
+
+    def _metrics(self, stream, worker):
+        # The scraped worker renders its own, every other one sends its samples here
+        waiting = set(w for w in self._workers if w != worker)
+        if len(waiting) == 0:
+            return []
+        self._next_scrape += 1
+        scrape = self._next_scrape
+        gathered = Future()
+        self._scrapes[scrape] = (waiting, [], gathered)
+        self._push_all({"event": "scrape", "id": scrape}, skip=worker)
+        ioloop.IOLoop.current().call_later(scrape_timeout, self._scraped, scrape)
+        return gathered
+
+    def _samples(self, message):
+        entry = self._scrapes.get(message["id"])
+        if entry is None:
+            return # Too late
+        entry[0].discard(message["worker"])
+        entry[1].append(message["samples"])
+        if len(entry[0]) == 0:
+            self._scraped(message["id"])
+
+    def _scraped(self, scrape):
+        entry = self._scrapes.pop(scrape, None)
+        if entry is not None:
+            if len(entry[0]) > 0:
+                log.warning("Workers %s didn't send their metrics in time" % ", ".join(str(w) for w in sorted(entry[0])))
+            entry[2].set_result(entry[1])
+
+    def _apt_lock(self, stream, worker):
+        if self._apt_owner is None:
+            self._apt_owner = stream
+            return self._apt_version
+        waiting = Future()
+        self._apt_waiting.append((stream, waiting))
+        return waiting
+
+    def _apt_unlock(self, stream, worker, committed):
+        if self._apt_owner is stream:
+            if committed:
+                self._apt_version += 1
+            self._next_apt()
+        return self._apt_version
+
+    def _next_apt(self):
+        self._apt_owner = None
+        while len(self._apt_waiting) > 0:
+            stream, waiting = self._apt_waiting.popleft()
+            if not stream.closed():
+                self._apt_owner = stream
+                waiting.set_result(self._apt_version)
+                return
+
+    def _hello(self, message):
+        log.info("Worker %d connected" % message["worker"])
+        self._push(message["worker"], {"event": "master", "present": len(self._masters) > 0})
+
+    def _register(self, message):
+        self._programs[message["uuid"]] = (message["worker"], message["port"])
+
+    def _unregister(self, message):
+        entry = self._programs.get(message["uuid"])
+        if entry is not None and entry[0] == message["worker"]:
+            del self._programs[message["uuid"]]
+
+    def _broadcast(self, message):
+        message["event"] = "broadcast"
+        self._push_all(message, skip=message["worker"])
+
+    def _state(self, message):
+        worker = message["worker"]
+        had_master = len(self._masters) > 0
+        self._connections[worker] = message["connections"]
+        if message["master"]:
+            self._masters.add(worker)
+        else:
+            self._masters.discard(worker)
+        has_master = len(self._masters) > 0
+        if has_master != had_master:
+            self._push_all({"event": "master", "present": has_master})
+        if sum(self._connections.values()) == 0 and not has_master:
+            if len(self._programs) > 0:
+                log.info("There are no more connections on any worker! Stopping all programs...")
+                self._push_all({"event": "idle"})
+        elif had_master and not has_master:
+            # Ask every connection on every worker if it wants to be the master
+            self._push_all({"event": "broadcast", "message": {"exec": "master"}})
+
+    def _closed(self, stream, worker):
+        if self._apt_owner is stream:
+            # It might have died halfway through a commit
+            self._apt_version += 1
+            self._next_apt()
+        if worker is None or self._workers.get(worker) is not stream:
+            return
+        log.warning("Lost worker %d, freeing its displays" % worker)
+        del self._workers[worker]
+        for index, entry in list(self._slots.items()):
+            if entry[0] == worker:
+                self._release(None, worker, index)
+        for uuid, entry in list(self._programs.items()):
+            if entry[0] == worker:
+                del self._programs[uuid]
+        self._state({"worker": worker, "connections": 0, "master": False})
+        del self._connections[worker]
+
+
+class CoordinatorClient(object):
+    def __init__(self, path, worker):
+        self._path = path
+        self._worker = worker
+        self._local = thread.local() # Every thread gets its own socket for blocking calls
+        self._stream = None
+        self._calls = None # The IOLoop's stream for calls
+        self._replies = deque() # Futures of the calls on it, the coordinator answers in order
+        self._ready = locks.Event() # Set once both streams are connected
+        self._pending = [] # Events sent before the stream connected
+        self._handlers = {}
+        self._master = False # Whether a master connection exists on any worker
+
+    def get_worker(self):
+        return self._worker
+
+    def has_master(self):
+        return self._master
+
+    def on(self, event, handler):
+        self._handlers[event] = handler
+
+    @staticmethod
+    def _socket():
+        # The displays and apps we start mustn't keep our end open after we die
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        set_close_exec(sock.fileno())
+        return sock
+
+    @staticmethod
+    def _result(reply):
+        if "error" in reply:
+            if reply.get("capacity"):
+                raise CapacityError(reply["error"])
+            raise IOError(reply["error"])
+        return reply["result"]
+
+    def call(self, name, *args):
+        """Ask the coordinator and wait for the answer, blocks so it's for threads besides the IOLoop"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            sock = self._socket()
+            sock.connect(self._path)
+            conn = self._local.conn = (sock, sock.makefile("rb"))
+        try:
+            conn[0].sendall(_line({"call": name, "worker": self._worker, "args": list(args)}))
+            reply = conn[1].readline()
+        except socket.error as err:
+            reply = None
+            log.error("Call %s failed (err: %s)" % (name, str(err)))
+        if not reply:
+            self._local.conn = None
+            conn[0].close()
+            raise IOError("Lost the coordinator")
+        return self._result(loads(reply.decode("utf-8")))
+
+    @gen.coroutine
+    def call_async(self, name, *args):
+        """Ask the coordinator on the IOLoop, raises IOError when it doesn't answer in time"""
+        deadline = ioloop.IOLoop.current().time() + call_timeout
+        try:
+            yield self._ready.wait(deadline)
+            self._calls.write(_line({"call": name, "worker": self._worker, "args": list(args)}))
+            reply = Future()
+            self._replies.append(reply)
+            reply = yield gen.with_timeout(deadline, reply, quiet_exceptions=IOError)
+        except gen.TimeoutError:
+            raise IOError("The coordinator didn't answer %s in time" % name)
+        except StreamClosedError:
+            raise IOError("Lost the coordinator")
+        raise gen.Return(self._result(reply))
+
+    @gen.coroutine
+    def connect(self):
+        calls = IOStream(self._socket(), max_buffer_size=max_line)
+        yield calls.connect(self._path)
+        self._calls = calls
+        self._read_replies()
+        stream = IOStream(self._socket(), max_buffer_size=max_line)
+        yield stream.connect(self._path)
+        self._stream = stream
+        self._ready.set()
+        self.send("hello")
+        for message in self._pending:
+            stream.write(_line(message))
+        self._pending = []
+        self._read()
+
+    def send(self, event, **values):
+        """Tell the coordinator something, nothing comes back (IOLoop only)"""
+        values["event"] = event
+        values["worker"] = self._worker
+        if self._stream is None:
+            self._pending.append(values)
+        elif not self._stream.closed():
+            self._stream.write(_line(values))
+
+    @gen.coroutine
+    def _read_replies(self):
+        try:
+            while True:
+                reply = yield self._calls.read_until(b"\n", max_bytes=max_line)
+                self._replies.popleft().set_result(loads(reply.decode("utf-8")))
+        except StreamClosedError:
+            while len(self._replies) > 0:
+                self._replies.popleft().set_exception(IOError("Lost the coordinator"))
+
+    @gen.coroutine
+    def _read(self):
+        try:
+            while True:
+                message = loads((yield self._stream.read_until(b"\n", max_bytes=max_line)).decode("utf-8"))
+                if message["event"] == "master":
+                    self._master = message["present"]
+                handler = self._handlers.get(message["event"])
+                if handler is not None:
+                    try:
+                        handler(message)
+                    except Exception as err:
+                        log.error("Handling %s failed (err: %s)" % (message["event"], str(err)))
+        except StreamClosedError:
+            log.error("Lost the coordinator!")
+            if "lost" in self._handlers:
+                self._handlers["lost"]({})
+
+
+class RemoteAllocator(object):
+    # Same as PortAllocator but the slots come from the coordinator, so workers never share one
+    def __init__(self, client):
+        self._client = client
+        self._used = set()
+
+    def get_used(self):
+        return len(self._used)
+
+    @gen.coroutine
+    def allocate(self):
+        try:
+            index, display_num, port = yield self._client.call_async("allocate")
+        except IOError as err:
+            raise CapacityError("Couldn't get a display (err: %s)" % str(err))
+        self._used.add(index)
+        raise gen.Return(Slot(index, display_num, port))
+
+    def release(self, slot):
+        """Hand a slot back, the coordinator is told in the background"""
+        if slot is None or slot.index not in self._used:
+            return False
+        self._used.remove(slot.index)
+        self._release(slot)
+        return True
+
+    @gen.coroutine
+    def _release(self, slot):
+        try:
+            yield self._client.call_async("release", slot.index)
+        except IOError as err:
+            log.error("Failed to hand back display :%d (err: %s)" % (slot.display_num, str(err)))
+
+
+class AptLock(object):
+    # Makes apt transactions on different workers take turns, only used from the apt thread
+    def __init__(self, client):
+        self._client = client
+        self._version = 0
+
+    def acquire(self):
+        """Wait for the lock, returns True when another worker changed packages since we last had it"""
+        version = self._client.call("apt_lock")
+        stale = version != self._version
+        self._version = version
+        return stale
+
+    def release(self, committed):
+        try:
+            self._version = self._client.call("apt_unlock", committed)
+        except IOError as err:
+            log.error("Failed to hand back the apt lock (err: %s)" % str(err))
+
+
+def run_coordinator(path, display_port, display_offset, size):
+    coordinator = Coordinator(display_port, display_offset, size)
+    coordinator.add_socket(bind_unix_socket(path))
+    loop = ioloop.IOLoop.current()
+    signal.signal(signal.SIGTERM, lambda s, f: loop.add_callback_from_signal(loop.stop))
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Stopped by the supervisor once the workers are gone
+    log.info("Coordinator listening on %s" % path)
+    loop.start()
+    remove(path)
+
+
+def fork_workers(count, path, display_port, display_offset, size):
+    """Start the coordinator and count workers, returns the worker number (0 to count - 1) in each worker
+
+    The calling process stays behind to supervise and never returns. It starts dead workers again,
+    stops the workers when it gets a SIGTERM or SIGINT and then the coordinator. No IOLoop may exist
+    yet, every process makes its own
+    """
+    children = {} # Pid -> worker number (None for the coordinator)
+    stopping = []
+
+    def spawn(worker):
+        pid = fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            random.seed()
+            after_fork("coordinator" if worker is None else "worker%d" % worker)
+            return True
+        children[pid] = worker
+        return False
+
+    def signal_all(workers):
+        for pid, worker in list(children.items()):
+            if (worker is not None) == workers:
+                try:
+                    kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+    def stop(sig, frame):
+        if not stopping:
+            log.info("Stopping the workers...")
+            stopping.append(sig)
+            signal_all(True)
+
+    if exists(path):
+        remove(path)
+    if spawn(None):
+        try:
+            run_coordinator(path, display_port, display_offset, size)
+        finally:
+            _exit(0)
+    deadline = time() + coordinator_timeout
+    while not exists(path):
+        if time() > deadline:
+            signal_all(False)
+            raise IOError("The coordinator didn't start")
+        sleep(0.01)
+    for worker in range(0, count):
+        if spawn(worker):
+            return worker
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    code = 0
+    while len(children) > 0:
+        try:
+            pid, status = waitpid(-1, 0)
+        except OSError as err:
+            if err.errno == errno.EINTR:
+                continue
+            raise
+        worker = children.pop(pid, -1)
+        if worker == -1:
+            continue
+        if worker is None:
+            if not stopping:
+                log.error("The coordinator stopped! Stopping the workers")
+                code = 1
+                stop(None, None)
+            continue
+        if stopping:
+            if not any(w is not None for w in children.values()):
+                signal_all(False) # Last worker is gone, the coordinator can go too
+            continue
+        log.warning("Worker %d stopped (status: %d), starting it again" % (worker, status))
+        sleep(restart_delay)
+        if spawn(worker):
+            return worker
+    sys.exit(code)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""CRI connectivity monitor
+
+This module keeps track of whether the machine can reach the internet. A probe connects
+to a known server on the IOLoop every so often (and more often, backing off, while we're
+offline) so anything that needs the internet can just read the cached answer
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from logger import Logger
+from probe import get_client, close_late, connect_errors
+from tornado import gen, ioloop
+
+# Configs
+probe_timeout = 1 # Seconds to wait for the probe connection
+online_interval = 30 # Seconds between probes while we're online
+offline_interval = 1 # Seconds before the first retry once we go offline
+offline_max_interval = 30 # The retries back off up to this many seconds
+
+# Logs
+log = Logger("NET")
+
+
+class ConnectivityMonitor(object):
+    def __init__(self, host, port):
+        self._host = host
+        self._port = port
+        self._online = None # None until the first probe finishes
+        self._listeners = []
+        self._running = False
+
+    def is_online(self):
+        return self._online
+
+    def set_target(self, host, port):
+        self._host = host
+        self._port = port
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            ioloop.IOLoop.current().add_callback(self._run)
+
+    def stop(self):
+        self._running = False
+
+    @gen.coroutine
+    def probe(self):
+        # Offline the connect often fails after the timeout, that's expected and shouldn't be logged
+        connecting = get_client().connect(self._host, self._port)
+        try:
+            stream = yield gen.with_timeout(ioloop.IOLoop.current().time() + probe_timeout,
+                    connecting, quiet_exceptions=connect_errors)
+            stream.close()
+            raise gen.Return(True)
+        except gen.TimeoutError:
+            close_late(connecting)
+            raise gen.Return(False)
+        except connect_errors:
+            raise gen.Return(False)
+
+    @gen.coroutine
+    def _run(self):
+        delay = offline_interval
+        while self._running:
+            online = yield self.probe()
+            if online != self._online:
+                if online:
+                    log.info("Connected to the internet!")
+                else:
+                    log.error("No internet connection!")
+                self._online = online
+                for listener in self._listeners:
+                    try:
+                        listener(online)
+                    except Exception as err:
+                        log.error("Failed to report connectivity (err: %s)" % str(err))
+            if online:
+                delay = offline_interval
+                yield gen.sleep(online_interval)
+            else:
+                yield gen.sleep(delay)
+                delay = min(delay * 2, offline_max_interval)
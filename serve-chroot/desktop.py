@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""CRI desktop file parser
+
+This module reads freedesktop .desktop files. The [Desktop Entry] group is cut out of the
+file once (actions and other groups are never looked at) and each key is pulled out of it
+with a precompiled search anchored to the start of a line, so GenericName never matches
+Name. Localized keys like Name[de] are picked according to the current locale
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from os import environ
+import re
+
+# Configs
+main_group = "[Desktop Entry]"
+escapes = {"s": " ", "n": "\n", "t": "\t", "r": "\r", "\\": "\\"}
+
+# Desktop entry key -> record attribute
+string_keys = {
+    "Name": "name",
+    "GenericName": "generic_name",
+    "Comment": "comment",
+    "Icon": "icon",
+    "Exec": "exec_line",
+    "TryExec": "try_exec",
+    "Version": "version",
+    "Type": "type"
+}
+localized_keys = ("Name", "GenericName", "Comment", "Icon")
+bool_keys = {
+    "NoDisplay": "no_display",
+    "Hidden": "hidden",
+    "Terminal": "terminal"
+}
+key_format = r"\n%s[ \t]*=[ \t]*([^\n]*)"
+
+
+def _searches(keys):
+    return [(attr, re.compile(key_format % re.escape(key)).search) for key, attr in keys.items()]
+
+
+string_searches = _searches(string_keys)
+bool_searches = _searches(bool_keys)
+locale_searches = {} # locale list -> searches for the localized keys, best locale first
+
+
+class DesktopEntry(object):
+    __slots__ = ("name", "generic_name", "comment", "icon", "exec_line", "try_exec",
+            "version", "type", "no_display", "hidden", "terminal")
+
+    def __init__(self):
+        self.name = None
+        self.generic_name = None
+        self.comment = None
+        self.icon = None
+        self.exec_line = None
+        self.try_exec = None
+        self.version = None
+        self.type = None
+        self.no_display = False
+        self.hidden = False
+        self.terminal = False
+
+    def is_visible(self):
+        return not (self.no_display or self.hidden) and self.type in (None, "Application")
+
+
+def locale_names(locale=None):
+    """List the locale keys to look for, best match first (lang_COUNTRY@MODIFIER ... lang)"""
+    if locale is None:
+        locale = environ.get("LC_ALL") or environ.get("LC_MESSAGES") or environ.get("LANG") or ""
+    base, _, modifier = locale.partition("@")
+    base = base.split(".")[0]
+    if base in ("", "C", "POSIX"):
+        return []
+    lang, _, country = base.partition("_")
+    names = []
+    if country and modifier:
+        names.append("%s_%s@%s" % (lang, country, modifier))
+    if country:
+        names.append("%s_%s" % (lang, country))
+    if modifier:
+        names.append("%s@%s" % (lang, modifier))
+    names.append(lang)
+    return names
+
+
+def _locale_searches(locales):
+    key = tuple(locales)
+    searches = locale_searches.get(key)
+    if searches is None:
+        searches = [(string_keys[k], re.compile(key_format % re.escape("%s[%s]" % (k, l))).search)
+                for l in locales for k in localized_keys]
+        locale_searches[key] = searches
+    return searches
+
+
+def unescape(value):
+    if "\\" not in value:
+        return value
+    parts = []
+    i = 0
+    while i < len(value):
+        c = value[i]
+        if c == "\\" and i + 1 < len(value):
+            parts.append(escapes.get(value[i + 1], value[i + 1]))
+            i += 2
+        else:
+            parts.append(c)
+            i += 1
+    return "".join(parts)
+
+
+def parse_text(text, locales):
+    # Only look at the [Desktop Entry] group, it ends where the next group starts
+    start = text.find(main_group)
+    if start == -1:
+        return None
+    start += len(main_group)
+    end = text.find("\n[", start)
+    group = text[start:] if end == -1 else text[start:end]
+
+    entry = DesktopEntry()
+    found = set()
+    if locales and "]" in group:
+        for attr, search in _locale_searches(locales):
+            if attr not in found:
+                match = search(group)
+                if match is not None:
+                    setattr(entry, attr, unescape(match.group(1).rstrip()))
+                    found.add(attr)
+    for attr, search in string_searches:
+        if attr not in found:
+            match = search(group)
+            if match is not None:
+                setattr(entry, attr, unescape(match.group(1).rstrip()))
+    for attr, search in bool_searches:
+        match = search(group)
+        if match is not None:
+            setattr(entry, attr, match.group(1).strip().lower() == "true")
+    return entry
+
+
+def parse(path, locales=None):
+    """Parse a desktop file into a DesktopEntry (None when it has no [Desktop Entry] group)"""
+    if locales is None:
+        locales = locale_names()
+    with open(path, 'r') as d:
+        return parse_text(d.read(), locales)
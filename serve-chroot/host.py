@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""CRI host resources
+
+This module reads how much memory the machine has left and how busy its cpus are so CRI
+can decide how many displays it can afford to run
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from os import getloadavg
+from multiprocessing import cpu_count
+
+# Configs
+meminfo_path = "/proc/meminfo"
+
+
+def read_meminfo():
+    info = {}
+    try:
+        with open(meminfo_path, 'r') as mi:
+            for line in mi:
+                key, _, value = line.partition(":")
+                info[key] = int(value.split()[0]) # Values are in kB
+    except (IOError, ValueError, IndexError):
+        pass
+    return info
+
+
+def mem_available_mb():
+    info = read_meminfo()
+    if "MemAvailable" in info:
+        return info["MemAvailable"] // 1024
+
+    # Older kernels don't report MemAvailable so estimate it
+    return (info.get("MemFree", 0) + info.get("Buffers", 0) + info.get("Cached", 0)) // 1024
+
+
+def load_per_cpu():
+    """The 1 minute load average divided by the number of cpus"""
+    try:
+        load = getloadavg()[0]
+    except OSError:
+        return 0.0
+    try:
+        cpus = cpu_count()
+    except NotImplementedError:
+        cpus = 1
+    return load / max(1, cpus)
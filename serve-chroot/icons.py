@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""CRI icon store
+
+This module keeps the application and package icons keyed by the hash of their contents.
+Messages only carry the hash (and the url to fetch it from), and the icon bytes are served
+over http with long lived caching so browsers only ever download each icon once
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from logger import Logger
+from tornado import web
+from collections import OrderedDict
+from os.path import getmtime
+import threading as thread
+import mimetypes
+import hashlib
+
+# Configs
+icon_cache_size = 512 # The most icons kept in memory at once
+icon_url = "/icons/%s"
+icon_max_age = 365 * 24 * 60 * 60 # Icons never change for a hash so let browsers keep them
+
+# Logs
+log = Logger("ICON")
+
+
+class IconStore(object):
+    def __init__(self, size):
+        self._size = size
+        self._paths = {} # hash -> icon path
+        self._hashes = {} # icon path -> (mtime, hash)
+        self._cache = OrderedDict() # hash -> (mime type, icon bytes) in least recently used order
+        self._lock = thread.Lock()
+
+    def _remember(self, icon_hash, icon):
+        self._cache[icon_hash] = icon
+        while len(self._cache) > self._size:
+            self._cache.popitem(last=False)
+
+    def add(self, path):
+        """Get the content hash of the icon at path (None if it can't be read)"""
+        if path is None:
+            return None
+        try:
+            mtime = getmtime(path)
+            with self._lock:
+                known = self._hashes.get(path)
+                if known is not None and known[0] == mtime:
+                    return known[1]
+            with open(path, 'rb') as ld:
+                data = ld.read()
+        except (IOError, OSError) as err:
+            log.error("Failed to read icon %s (err: %s)" % (path, str(err)))
+            return None
+        icon_hash = hashlib.sha1(data).hexdigest()
+        with self._lock:
+            self._hashes[path] = (mtime, icon_hash)
+            self._paths[icon_hash] = path
+            self._remember(icon_hash, (mimetypes.guess_type(path)[0], data))
+        return icon_hash
+
+    def add_known(self, path, icon_hash):
+        """Serve a hash that was worked out before (the catalog snapshot) without reading the icon"""
+        if path is None or icon_hash is None:
+            return
+        with self._lock:
+            self._paths[icon_hash] = path
+
+    def get(self, icon_hash):
+        """Get the (mime type, bytes) of an icon or None if the hash is unknown"""
+        with self._lock:
+            icon = self._cache.pop(icon_hash, None)
+            if icon is not None:
+                self._cache[icon_hash] = icon
+                return icon
+            path = self._paths.get(icon_hash)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as ld:
+                data = ld.read()
+        except (IOError, OSError) as err:
+            log.error("Failed to read icon %s (err: %s)" % (path, str(err)))
+            return None
+        if hashlib.sha1(data).hexdigest() != icon_hash:
+            # The file changed underneath us, it will get a new hash on the next catalog load
+            return None
+        icon = (mimetypes.guess_type(path)[0], data)
+        with self._lock:
+            self._remember(icon_hash, icon)
+        return icon
+
+    @staticmethod
+    def get_url(icon_hash):
+        if icon_hash is None:
+            return None
+        return icon_url % icon_hash
+
+
+store = IconStore(icon_cache_size)
+
+
+class IconHandler(web.RequestHandler):
+    def get(self, icon_hash):
+        etag = '"%s"' % icon_hash
+        self.set_header("Etag", etag)
+        self.set_header("Cache-Control", "public, max-age=%d, immutable" % icon_max_age)
+        self.set_header("Access-Control-Allow-Origin", "*")
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        icon = store.get(icon_hash)
+        if icon is None:
+            raise web.HTTPError(404)
+        self.set_header("Content-Type", icon[0] or "application/octet-stream")
+        self.write(icon[1])
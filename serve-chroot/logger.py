@@ -1,86 +1,212 @@
 # -*- coding: utf-8 -*-
 """CRI logger
 
-This module is designed to just handle logging. There's nothing more to it
-Just printing and logging to files
+This module is designed to just handle logging. Log calls only check the level of their
+namespace and put the message on a queue, a background thread does the formatting and
+the writing to the log file and stdout so logging never blocks a request. The log file
+is rotated when it gets too big or too old and old log files are deleted as it goes
 
 Developed By: David Smerkous and Eli Smith
 """
 
-from logging import getLogger, DEBUG, Formatter, FileHandler, StreamHandler
-from os.path import dirname, realpath, isdir, exists, join, basename
+from logging import getLogger, getLevelName, Handler, Formatter, DEBUG, INFO, WARNING, ERROR, CRITICAL
+from os.path import dirname, realpath, isdir, exists, join, getmtime
 from os import makedirs, walk, remove
-from time import strftime, strptime, mktime
-from datetime import datetime
+from time import strftime, localtime, time
+from json import dumps
 from sys import stdout
+import threading as thread
+import atexit
 import fnmatch
 
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
+
 # Define logging characteristics
-LOGGER_NAME = "CRI"
-LOGGER_LEVEL = DEBUG
+LOGGER_LEVEL = INFO # Level for namespaces that aren't in LOGGER_LEVELS
+LOGGER_LEVELS = {} # Namespace (CRI, APP, ...) -> level
+LOGGER_JSON = False # Write one JSON object per line instead of text
+LOGGER_CONSOLE = True # Also write to stdout
 LOGGER_STORE_DAYS = 5 # Maximum amount of days to store a log file before deleting it
+LOGGER_MAX_BYTES = 10 * 1024 * 1024 # Start a new log file once it's this big
+LOGGER_ROTATE_SECONDS = 24 * 60 * 60 # Start a new log file once it's this old
+LOGGER_QUEUE_SIZE = 10000 # Messages waiting to be written before new ones are dropped
+LOGGER_BATCH_SIZE = 256 # Messages written between flushes
 
-LOGGER_FORMAT = Formatter("%(asctime)s [%(levelname)-5.5s] %(message)s")
 LOGGER_FILE_PATH = "%s/logs" % dirname(realpath(__file__))
 LOGGER_FILE_DATE_FORMAT = "%d-%m-%y--%H-%M-%S"
-LOGGER_FILE_DATE = strftime(LOGGER_FILE_DATE_FORMAT)
-LOGGER_FILE_FORMAT = "%s/%s.log" % (LOGGER_FILE_PATH, LOGGER_FILE_DATE)
-
-if not isdir(LOGGER_FILE_PATH):
-    print("Creating new log location %s..." % LOGGER_FILE_PATH),
-    makedirs(LOGGER_FILE_PATH)
-    print("Done")
-
-LOG_FILES = [join(dirpath, f) for dirpath, dirnames, files in walk(LOGGER_FILE_PATH) for f in fnmatch.filter(files, '*.log')]
-
-print("Looking for old log files...")
-
-TODAY_NOW = datetime.now()
-DELETED_FILES = 0
-for l_file in LOG_FILES:
-    try:
-        c_date = datetime.fromtimestamp(mktime(strptime(basename(l_file).split(".")[0], LOGGER_FILE_DATE_FORMAT)))
-        days_old = (TODAY_NOW - c_date).days
-        if days_old > LOGGER_STORE_DAYS:
-            remove(l_file)
-            print("Deleted old file %s" % l_file)
-            DELETED_FILES += 1
-    except Exception as err:
-        print("Failed to delete log file %s (err: %s)" % (l_file, str(err)))
-
-print("Deleted a total of %d old log files" % DELETED_FILES)
-
-if not exists(LOGGER_FILE_FORMAT):
-    print("Creating new log file %s..." % LOGGER_FILE_FORMAT),
-    open(LOGGER_FILE_FORMAT, 'w').close()
-    print("Done")
-
-LOGGER_FILE_HANDLER = FileHandler(LOGGER_FILE_FORMAT)
-LOGGER_FILE_HANDLER.setFormatter(LOGGER_FORMAT)
-LOGGER_CONSOLE_HANDLER = StreamHandler(stdout)
-LOGGER_CONSOLE_HANDLER.setFormatter(LOGGER_FORMAT)
-LOGGER = getLogger(LOGGER_NAME)
-LOGGER.addHandler(LOGGER_FILE_HANDLER)
-LOGGER.addHandler(LOGGER_CONSOLE_HANDLER)
+
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNI", ERROR: "ERROR", CRITICAL: "CRITI"}
+
+
+def set_level(name_space, level):
+    LOGGER_LEVELS[name_space] = level
+
+
+def is_enabled(name_space, level):
+    return level >= LOGGER_LEVELS.get(name_space, LOGGER_LEVEL)
+
+
+class LogWriter(object):
+    def __init__(self, path, tag=None):
+        self._path = path
+        self._tag = tag # Added to the file names so processes don't share a log file
+        self._queue = Queue(LOGGER_QUEUE_SIZE)
+        self._dropped = 0
+        self._file = None
+        self._file_name = None
+        self._opened = 0
+        self._size = 0
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = thread.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=2):
+        """Write out whatever is still queued"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def get_path(self):
+        return self._path
+
+    def put(self, level, name_space, message):
+        try:
+            self._queue.put_nowait((time(), level, name_space, message))
+        except Full:
+            self._dropped += 1
+
+    def _format(self, record):
+        stamp, level, name_space, message = record
+        if LOGGER_JSON:
+            return dumps({
+                "time": stamp,
+                "level": getLevelName(level),
+                "namespace": name_space,
+                "message": message
+            }) + "\n"
+        return "%s,%03d [%-5.5s] |%s|: %s\n" % (strftime("%Y-%m-%d %H:%M:%S", localtime(stamp)),
+                int(stamp * 1000) % 1000, LEVEL_NAMES.get(level, str(level)), name_space, message)
+
+    def _open(self):
+        if not isdir(self._path):
+            makedirs(self._path)
+        stamp = strftime(LOGGER_FILE_DATE_FORMAT)
+        if self._tag is not None:
+            stamp = "%s-%s" % (stamp, self._tag)
+        name = join(self._path, "%s.log" % stamp)
+        count = 1
+        while exists(name):
+            name = join(self._path, "%s.%d.log" % (stamp, count))
+            count += 1
+        if self._file is not None:
+            self._file.close()
+        self._file = open(name, "a")
+        self._file_name = name
+        self._opened = time()
+        self._size = 0
+        self._clean()
+
+    def _clean(self):
+        # Old log files are found by when they were last written to
+        oldest = time() - LOGGER_STORE_DAYS * 24 * 60 * 60
+        for dirpath, dirnames, files in walk(self._path):
+            for f in fnmatch.filter(files, "*.log"):
+                l_file = join(dirpath, f)
+                try:
+                    if l_file != self._file_name and getmtime(l_file) < oldest:
+                        remove(l_file)
+                except OSError:
+                    pass
+
+    def _write(self, lines):
+        text = "".join(lines)
+        if self._file is None or self._size >= LOGGER_MAX_BYTES or time() - self._opened >= LOGGER_ROTATE_SECONDS:
+            self._open()
+        self._file.write(text)
+        self._file.flush()
+        self._size += len(text)
+        if LOGGER_CONSOLE:
+            stdout.write(text)
+            stdout.flush()
+
+    def _run(self):
+        running = True
+        while running:
+            records = [self._queue.get()]
+            try:
+                while len(records) < LOGGER_BATCH_SIZE:
+                    records.append(self._queue.get_nowait())
+            except Empty:
+                pass
+            if None in records:
+                running = False
+                records = [r for r in records if r is not None]
+            lines = [self._format(r) for r in records]
+            if self._dropped > 0:
+                dropped, self._dropped = self._dropped, 0
+                lines.append(self._format((time(), WARNING, "LOG", "Dropped %d log messages" % dropped)))
+            try:
+                self._write(lines)
+            except Exception:
+                pass # There's nowhere left to report this
+
+
+class QueueHandler(Handler):
+    """Sends logs from other libraries (tornado) through the writer"""
+    def emit(self, record):
+        try:
+            if is_enabled(record.name, record.levelno):
+                message = record.getMessage()
+                if record.exc_info:
+                    message = "%s\n%s" % (message, EXCEPTION_FORMAT.formatException(record.exc_info))
+                WRITER.put(record.levelno, record.name, message)
+        except Exception:
+            self.handleError(record)
+
+
+EXCEPTION_FORMAT = Formatter()
+WRITER = LogWriter(LOGGER_FILE_PATH)
+WRITER.start()
+atexit.register(WRITER.stop)
+
+ROOT_LOGGER = getLogger()
+ROOT_LOGGER.addHandler(QueueHandler())
+
+
+def after_fork(tag):
+    """Give a forked process its own writer and log file, the writer thread doesn't survive a fork"""
+    global WRITER
+    WRITER = LogWriter(WRITER.get_path(), tag)
+    WRITER.start()
+    atexit.register(WRITER.stop)
 
 
 class Logger(object):
-    def __init__(self, name_space, logger_level=LOGGER_LEVEL):
-        LOGGER.setLevel(logger_level)
-        LOGGER.debug("Starting logger!")
+    def __init__(self, name_space, logger_level=None):
         self._name_space = name_space
+        if logger_level is not None:
+            set_level(name_space, logger_level)
 
-    def __base_log(self, to_log):
-        return "|%s|: %s" % (self._name_space, str(to_log))
+    def __log(self, level, to_log):
+        if level >= LOGGER_LEVELS.get(self._name_space, LOGGER_LEVEL):
+            WRITER.put(level, self._name_space, str(to_log))
 
     def info(self, to_log):
-        LOGGER.info(self.__base_log(to_log))
+        self.__log(INFO, to_log)
 
     def debug(self, to_log):
-        LOGGER.debug(self.__base_log(to_log))
+        self.__log(DEBUG, to_log)
 
     def warning(self, to_log):
-        LOGGER.warning(self.__base_log(to_log))
+        self.__log(WARNING, to_log)
 
     def error(self, to_log):
-        LOGGER.error(self.__base_log(to_log))
+        self.__log(ERROR, to_log)
@@ -9,16 +9,37 @@ Developed By: David Smerkous and Eli Smith
 """
 
 from logger import Logger
-from apps import Application, Package
+from apps import Application, Package, search_limit, connection
+from ports import PortAllocator, CapacityError
+from pool import WarmPool
+from proxy import VNCProxy
+from icons import IconHandler
+from outbox import Outbox, encode, decode, is_binary, get_encodings
+from transactions import AptQueue
+from scheduler import LaunchScheduler, BusyError
+from processes import ProcessTracker, ProcessWatcher, terminate, terminate_now, read_cmdline
+from metrics import MetricsHandler, LoopMonitor, Counter, Gauge, Histogram, set_process_label, samples
+from cluster import CoordinatorClient, RemoteAllocator, AptLock, fork_workers
+from timeit import default_timer
+import probe
+import profiles
 from distutils.spawn import find_executable
-from tornado import ioloop, httpserver, web, websocket
+from tornado import ioloop, httpserver, web, websocket, process, gen, netutil
+from tornado.concurrent import Future
+from datetime import timedelta
 from random import randint
-from time import sleep
-from os import chmod
-from json import loads, dumps
+from os import chmod, environ, remove, rename, getpid
+from os.path import expanduser
+from glob import glob
 from uuid import uuid4
-import subprocess as sp
+from functools import partial
+from collections import deque
 import threading as thread
+import signal
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 
 # Configs
 server_port = 3300 # The starting port
@@ -26,189 +47,414 @@ display_port = 3310 # The starting display ports
 max_displays = 100 # The maximum amount of allowed displays
 display_offset = 10 # The display displacement amount (to not conflict with other programs)
 end_displays = display_port + max_displays
-proxy_ports = display_port + max_displays
-end_proxy_ports = proxy_ports + max_displays
 base_vnc = "vncserver"
-grep_vnc = "vnc"
+vnc_dir = expanduser("~/.vnc") # Where vncserver writes the pid files of its displays
 start_up = "/tmp"
+state_file = "/tmp/cri.state" # The pids of everything CRI started, to clean up after a crash
+vnc_start_timeout = 10 # Seconds to wait for vncserver to fork its display
+vnc_kill_timeout = 10 # Seconds to wait for vncserver -kill to stop a display
+ready_timeout = 10 # Seconds to wait for the display to accept connections
+search_workers = 2 # Threads that run searches, extra searches wait in line
+list_page_size = 500 # Applications sent per list message when the client doesn't ask for a size
+ws_compression = True # Offer permessage-deflate to clients that support it
+ws_compression_level = 6
+ws_mem_level = 5
+warm_pool_size = 0 # Idle displays to keep started ahead of time (0 disables the pool)
+warm_pool_display_mb = 96 # Estimated memory each idle display uses
+warm_pool_reserve_mb = 512 # Memory to always leave free on the host
+max_launching = 4 # Programs allowed to start their displays at the same time
+max_waiting = 32 # Launches allowed to wait in line before new ones get a busy response
+launch_mb = 128 # Estimated memory a new display and its app need
+launch_reserve_mb = 512 # Launches wait while less than this (plus launch_mb) is free
+max_load = 2.0 # Launches wait while the load average per cpu is higher than this
+launch_timeout = 60 # Seconds a launch waits in line before it gets a busy response
+watch_interval = 2 # Seconds between checks that the displays are still running
+lag_interval = 0.1 # Seconds between checks of how long the IOLoop was blocked
+ping_interval = 10 # Seconds between pings that measure each client's round trip time
+rtt_smoothing = 0.3 # Weight of the newest round trip in the smoothed one
+default_restart = "never" # Restart policy for apps that don't ask for one (never, on-failure, always)
+restart_policies = {} # Executable name -> restart policy
+max_restarts = 3 # Restarts allowed within restart_window before an app is given up on
+restart_window = 60 # Seconds
+worker_processes = 1 # Processes accepting connections on server_port (above 1 starts a coordinator too)
+coordinator_socket = "/tmp/cri.sock" # Where the workers reach the coordinator
+
+# Program states
+STARTING = "starting"
+READY = "ready"
+EXITED = "exited"
+FAILED = "failed"
 
 # Logs
 log = Logger("CRI")
 
 # Globally locked variables
+allocator = PortAllocator(display_port, display_offset, max_displays)
 programs = {}
 connections = set()
 master = None
-instances = 0
+search_jobs = Queue()
+tracker = ProcessTracker(state_file)
+cluster = None # The coordinator when running as one of several workers
+watcher = ProcessWatcher(watch_interval)
+
+# Metrics
+launch_seconds = Histogram("cri_launch_seconds", "Time spent in each phase of starting a program "
+        "(vncserver, display_ready, app, total time to load)", ["phase"])
+list_seconds = Histogram("cri_list_seconds", "Time spent building list pages")
+messages_total = Counter("cri_messages_total", "Websocket messages by direction and exec", ["direction", "exec"])
+message_bytes = Counter("cri_message_bytes_total", "Websocket message bytes by direction and exec", ["direction", "exec"])
+ioloop_lag = Histogram("cri_ioloop_lag_seconds", "How late IOLoop timers ran (time the loop was blocked)",
+        buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+Gauge("cri_programs", "Running programs", callback=lambda: len(programs))
+Gauge("cri_launches_waiting", "Launches waiting in line", callback=lambda: scheduler.waiting())
+Gauge("cri_launches_running", "Launches starting a display right now", callback=lambda: scheduler.launching())
+Gauge("cri_displays_allocated", "Display and port slots in use", callback=lambda: allocator.get_used())
+Gauge("cri_connections", "Open websocket connections", callback=lambda: len(connections))
 
 # Program instance handler
 class Program(object):
-    def __init__(self, name):
-        global available_displays
+    def __init__(self, slot, name=None):
         self._name = name
-        created = False
 
-        # Check for an available display port
-        for d in range(display_port, end_displays):
-            try:
-                is_in = False
-                for p in programs.values():
-                    if p.get_port() == d:
-                        is_in = True
-                        break
-                if not is_in:
-                    created = True
-                    self._port = d
-                    break
-            except:
-                pass
-        
-        if created:
-            # Check fo an available proxy port
-            for d in range(proxy_ports, end_proxy_ports):
-                try:
-                    is_in = False
-                    for p in programs.values():
-                        if p.get_proxy_port() == d:
-                            is_in = True
-                            break
-                    if not is_in:
-                        created = True
-                        self._proxy_port = d
-                        break
-                except:
-                    pass
-
-        # Log the unusable display error
-        if not created:
-            log.warning("Possibly ran out of usable displays")
-            log.error("Unknown usage at this point")
-            self._port = end_displays
-            self._proxy_port = end_proxy_ports
-        self._display_num = (self._port - display_port) + display_offset
+        # The display and vnc port are reserved together
+        self._slot = slot
+        self._port = self._slot.port
+        self._display_num = self._slot.display_num
         
         # Declare the blank subprocess
         self._proc = None
-        self._proxy_proc = None
+        self._app_proc = None
+        self._display_ready = False
+        self._state = STARTING
+        self._killed = False
+        self._starting = None # Resolves once start_display is done, kill waits for it
+        self._exit_listener = None
+        self._restart_policy = default_restart
+        self._restarts = deque() # When the last restarts happened
+        self._profile = profiles.default_profile
+        self._usage = profiles.Usage()
+
+    @staticmethod
+    @gen.coroutine
+    def create(name=None):
+        """A new program with a display slot of its own (raises CapacityError when they're all taken)"""
+        slot = yield gen.maybe_future(allocator.allocate())
+        raise gen.Return(Program(slot, name))
 
     def get_name(self):
         return self._name
 
+    def set_name(self, name):
+        self._name = name
+
     def get_port(self):
         return self._port
-    
-    def get_proxy_port(self):
-        return self._proxy_port
 
+    def is_display_ready(self):
+        return self._display_ready
+
+    def get_state(self):
+        return self._state
+
+    def get_profile(self):
+        return self._profile
+
+    @gen.coroutine
+    def set_profile(self, profile):
+        """Switch to another vnc profile, a running display is changed in place"""
+        if profile == self._profile:
+            raise gen.Return(True)
+        if self._display_ready:
+            switched = yield profiles.apply(self._display_num, profile)
+            if not switched:
+                raise gen.Return(False)
+            self._usage.switch(profile)
+        self._profile = profile
+        raise gen.Return(True)
+
+    def set_exit_listener(self, listener):
+        """listener(program, exit code) runs when the app or its display stops by itself"""
+        self._exit_listener = listener
+
+    def set_restart_policy(self, policy):
+        self._restart_policy = policy
+
+    def should_restart(self, code):
+        if self._restart_policy == "never" or (self._restart_policy == "on-failure" and code == 0):
+            return False
+        now = ioloop.IOLoop.current().time()
+        while len(self._restarts) > 0 and self._restarts[0] < now - restart_window:
+            self._restarts.popleft()
+        if len(self._restarts) >= max_restarts:
+            log.warning("%s restarted %d times in %d seconds, giving up" % (self._name,
+                len(self._restarts), restart_window))
+            return False
+        self._restarts.append(now)
+        return True
+
+    @gen.coroutine
     def run(self):
-        if self._proc is not None or self._proxy_proc:
+        if self._app_proc is not None:
             log.error("The program %s is already running!" % self._name)
+            raise gen.Return(False)
+        self._state = STARTING
+        if not self._display_ready:
+            started = yield self.start_display()
+            if self._killed:
+                raise gen.Return(False) # kill stops whatever the display got to start
+            if not started:
+                self._state = FAILED
+                raise gen.Return(False)
+        if self._killed:
+            raise gen.Return(False)
+        launched = self.launch()
+        self._state = READY if launched else FAILED
+        raise gen.Return(launched)
+
+    def _exited(self, state, code):
+        self._state = state
+        if self._exit_listener is not None:
+            self._exit_listener(self, code)
+
+    def _app_exited(self, code):
+        if self._killed or self._app_proc is None:
             return
-        Program.create_startup(self._name)
-        self._proc = sp.Popen([base_vnc, (":%d" % self._display_num),
-            "-name", ("'%s'" % self._name), "-AcceptCutText=1", 
-            "-SendCutText=1", "-localhost=1", "-SecurityTypes=None", 
-            "-rfbport", ("%d" % self._port), "-ZlibLevel=0",
-            "-xstartup", ("'%s'" % Program.start_up_name(self._name))]) 
-            #stdout=sp.PIPE, stderr=sp.PIPE)
-        log.info("Waiting for the program to start")
-        started = False
-        for i in range(0, 100):
-            if self._proc.poll() is not None:
-                if self._proc.returncode == 0:
-                    log.info("Program started!")
-                    started = True 
-                else:
-                    log.info("The program failed to start!")
-                break
-            sleep(0.1)
-        if not started:
-            log.error("Failed to start the program!")
+        log.info("%s exited on display :%d (code: %d)" % (self._name, self._display_num, code))
+        self._app_proc = None
+        tracker.forget(self._display_num, "app")
+        self._exited(EXITED if code == 0 else FAILED, code)
+
+    def _display_died(self):
+        if self._killed:
+            return
+        log.error("Display :%d stopped running!" % self._display_num)
+        self._proc = None
+        self._display_ready = False
+        self._usage.stop()
+        tracker.forget(self._display_num, "xvnc")
+        Program.clean_display(self._display_num)
+        if self._app_proc is not None:
+            # Nothing can draw without the display, don't leave the app behind
+            terminate([tracker.get_process(self._display_num, "app")])
+            self._app_proc = None
+            tracker.forget(self._display_num, "app")
+        self._exited(FAILED, None)
+
+    @gen.coroutine
+    def start_display(self):
+        if self._proc is not None:
+            log.error("The display :%d is already running!" % self._display_num)
+            raise gen.Return(False)
+        self._starting = Future()
+        try:
+            started = yield self._start_display()
+        finally:
+            starting, self._starting = self._starting, None
+            starting.set_result(None)
+        raise gen.Return(started)
+
+    @gen.coroutine
+    def _start_display(self):
+        start = default_timer()
+        try:
+            self._proc = process.Subprocess([base_vnc, (":%d" % self._display_num),
+                "-name", ("'%s'" % (self._name or "CRI")), "-AcceptCutText=1", 
+                "-SendCutText=1", "-localhost=1", "-SecurityTypes=None", 
+                "-rfbport", ("%d" % self._port)] + profiles.get_flags(self._profile) +
+                ["-xstartup", ("'%s'" % Program.start_up_name())])
+        except OSError as err:
+            log.error("Failed to run %s (err: %s)" % (base_vnc, str(err)))
+            raise gen.Return(False)
+        tracker.track(self._display_num, "vncserver", self._proc.pid)
+
+        # Wait for vncserver to fork the display without blocking the other connections
+        log.info("Waiting for display :%d to start" % self._display_num)
+        try:
+            rc = yield gen.with_timeout(timedelta(seconds=vnc_start_timeout),
+                    self._proc.wait_for_exit(raise_error=False))
+        except gen.TimeoutError:
+            log.error("Timed out waiting for display :%d to start!" % self._display_num)
+            raise gen.Return(False) # vncserver stays tracked so kill stops it
+        tracker.forget(self._display_num, "vncserver")
+        if rc != 0:
+            log.error("The display failed to start! (code: %d)" % rc)
+            raise gen.Return(False)
+        launch_seconds.observe(default_timer() - start, "vncserver")
+
+        # vncserver forks Xvnc and exits, the pid file is the only way to find it
+        pid = Program.read_display_pid(self._display_num)
+        if pid is not None:
+            tracker.track(self._display_num, "xvnc", pid)
+        if self._killed:
+            raise gen.Return(False)
+        if pid is None:
+            log.warning("Couldn't find the pid of display :%d" % self._display_num)
         else:
-            self._proxy_proc = sp.Popen(["websockify", "%d" % self._proxy_port, "localhost:%d" % self._port])
-            started = False
-            for i in range(0, 100):
-                proc = sp.Popen(["pgrep", "websockify"], stdout=sp.PIPE)
-                data = proc.communicate()[0]
-                rc = proc.returncode
-                if rc == 0:
-                    log.info("Proxy started!")
-                    started = True
-                    break
-                sleep(0.1)
-            if not started:
-                log.error("The proxy failed to start!")
-            log.info("Starting %s on port %d and proxied with websocket to port %d" % (self._name, self._port, self._proxy_port))
+            watcher.watch(self._display_num, pid, self._display_died)
+            self._usage.start(pid, self._profile)
+
+        # Make sure this display is the one answering on our rfb port
+        start = default_timer()
+        deadline = ioloop.IOLoop.current().time() + ready_timeout
+        ready = yield probe.wait_for_rfb(self._port, deadline)
+        if self._killed:
+            raise gen.Return(False)
+        if not ready:
+            log.error("The display :%d never answered on port %d!" % (self._display_num, self._port))
+            raise gen.Return(False)
+        launch_seconds.observe(default_timer() - start, "display_ready")
+        log.info("Display :%d started on port %d!" % (self._display_num, self._port))
+        self._display_ready = True
+        raise gen.Return(True)
+
+    def launch(self):
+        # Run the application inside the already running display
+        env = dict(environ)
+        env["DISPLAY"] = ":%d" % self._display_num
+        try:
+            with launch_seconds.time("app"):
+                self._app_proc = process.Subprocess(["/bin/sh", "-c", "exec %s" % self._name], env=env)
+        except OSError as err:
+            log.error("Failed to launch %s (err: %s)" % (self._name, str(err)))
+            return False
+        tracker.track(self._display_num, "app", self._app_proc.pid)
+        self._app_proc.set_exit_callback(self._app_exited)
+        log.info("Starting %s on display :%d" % (self._name, self._display_num))
+        return True
 
     def kill(self):
-        if self._proc is None and self._proxy_proc is None:
+        if self._killed:
+            return
+        if self._proc is None:
             log.error("The program %s is not running!" % self._name)
-        try:
-            log.info("Attempting to kill %s" % self._name)
-            proc = sp.Popen([base_vnc, "-kill", (":%d" % self._display_num)], stdout=sp.PIPE)
-            proc.wait()
-            log.info("Killed display :%d" % self._display_num)
-            try:
-                self._proc.kill()
-            except Exception as err:
-                log.warning("Couldn't clean up process via pid... %s" % str(err)) 
-            self._proxy_proc.kill()
-        except Exception as err:
-            log.error("Failed to kill %s (err: %s)" % (self._name, str(err)))
+        log.info("Attempting to kill %s" % self._name)
+        self._killed = True
+        if self._state in (STARTING, READY):
+            self._state = EXITED
+        watcher.unwatch(self._display_num)
+        self._usage.stop()
+        self._stop_display()
+
+    @gen.coroutine
+    def _stop_display(self):
+        display_num = self._display_num
+        if self._starting is not None:
+            # Only once it's done starting do we know every process the display started
+            yield self._starting
+
+        # The display stays tracked and its slot taken until it's really gone
+        yield terminate(tracker.get_processes(display_num))
+        if self._proc is not None and tracker.get_pid(display_num, "xvnc") is None:
+            # We never found the display's pid, let vncserver look for it before its pid file is cleaned up
+            finished = yield Program.vnc_kill(display_num)
+            pid = Program.read_display_pid(display_num)
+            if pid is not None:
+                tracker.track(display_num, "xvnc", pid)
+                yield terminate([tracker.get_process(display_num, "xvnc")])
+            elif not finished:
+                log.error("Display :%d might still be running, keeping its slot" % display_num)
+                return
+        log.info("Killed display :%d" % display_num)
+        tracker.untrack(display_num)
+        Program.clean_display(display_num)
+        self.release()
+
+    def release(self):
+        if allocator.release(self._slot):
+            log.info("Released display :%d (port %d)" % (self._display_num, self._port))
 
     @staticmethod
-    def start_up_name(name):
-        return "%s/%s.cri_startup" % (start_up, name)
+    def start_up_name():
+        return "%s/cri.xstartup" % start_up
 
     @staticmethod
-    def create_startup(name):
+    def create_startup():
+        # Every display shares the file, a new one is swapped in so no vncserver reads half of it
+        temp = "%s.%d.tmp" % (Program.start_up_name(), getpid())
         try:
-            log.info("Creating xstartup file... %s" % name)
-            f_write = open(Program.start_up_name(name), "w")
+            log.info("Creating xstartup file... %s" % Program.start_up_name())
+            f_write = open(temp, "w")
             f_write.writelines([
                 "#!/bin/sh\n",
                 "xrdb $HOME/.Xresources\n",
                 "xsetroot -solid grey\n",
                 "xsetroot -cursor_name left_ptr\n",
-                "i3 -c /etc/i3.conf &\n",
-                ("%s\n" % name)
+                "exec i3 -c /etc/i3.conf\n"
                 ])
             f_write.close()
-            chmod(Program.start_up_name(name), 777)
+            chmod(temp, 777)
+            rename(temp, Program.start_up_name())
             log.info("Finished creating startup file!")
         except:
             log.error("Failed to create the xstartup file!")
 
     @staticmethod
-    def kill_all():
-        t_inst = Program.get_instances()
-        if t_inst > 0:
-            for d in range(0, t_inst):
-                d_num = display_offset + d
-                proc = sp.Popen([base_vnc, "-kill", (":%d" % d_num)], stdout=sp.PIPE)
-                proc.wait()
-                log.info("Killing display :%d" % d_num)
-                if proc.returncode == 1:
-                    log.error("Failed to kill the display!")
-        proc = sp.Popen(["pkill", "-15", grep_vnc], stdout=sp.PIPE)
-        proc_proxy = sp.Popen(["pkill", "-15", "websockify"], stdout=sp.PIPE)
-        proc.poll()
-        proc_proxy.poll()
+    def read_display_pid(display_num):
+        for path in glob("%s/*:%d.pid" % (vnc_dir, display_num)):
+            try:
+                with open(path, "r") as f:
+                    return int(f.read().strip())
+            except (IOError, OSError, ValueError):
+                pass
+
+        # Xvnc holds the X lock file for as long as it runs, even when there's no pid file
+        try:
+            with open("/tmp/.X%d-lock" % display_num, "r") as f:
+                pid = int(f.read().strip())
+        except (IOError, OSError, ValueError):
+            return None
+        cmdline = read_cmdline(pid)
+        if cmdline is None or (":%d" % display_num) not in cmdline:
+            return None # A stale lock file, the pid belongs to something else by now
+        return pid
+
+    @staticmethod
+    @gen.coroutine
+    def vnc_kill(display_num):
+        """Ask vncserver to stop a display, returns False when it didn't finish in time"""
+        try:
+            proc = process.Subprocess([base_vnc, "-kill", (":%d" % display_num)])
+        except OSError as err:
+            log.error("Failed to kill display :%d (err: %s)" % (display_num, str(err)))
+            raise gen.Return(True)
+        try:
+            rc = yield gen.with_timeout(timedelta(seconds=vnc_kill_timeout),
+                    proc.wait_for_exit(raise_error=False))
+        except gen.TimeoutError:
+            log.error("Timed out waiting for vncserver to kill display :%d!" % display_num)
+            raise gen.Return(False)
+        if rc != 0:
+            log.warning("vncserver couldn't kill display :%d (code: %d)" % (display_num, rc))
+        raise gen.Return(True)
+
+    @staticmethod
+    def clean_display(display_num):
+        # A display that had to be killed leaves its lock files behind
+        for path in ["/tmp/.X%d-lock" % display_num, "/tmp/.X11-unix/X%d" % display_num] + \
+                glob("%s/*:%d.pid" % (vnc_dir, display_num)):
+            try:
+                remove(path)
+            except OSError:
+                pass
 
     @staticmethod
-    def get_instances():
-        global instances
-        proc = sp.Popen(["pgrep", grep_vnc], stdout=sp.PIPE)
-        data = proc.communicate()[0]
-        rc = proc.returncode
-        if rc == 1:
-            log.info("No instances are running!")
-            instances = 0
-        else:
-            log.info("Instance return %s" % data)
-            instances = len(data.split("\n")) - 1
-        log.info("Running instances %d" % instances)
-        return instances
+    def kill_all(trackers=None):
+        # Only what's in the state files, so from an earlier run on startup and ours on shutdown
+        for t in ([tracker] if trackers is None else trackers):
+            left = t.load()
+            if len(left) == 0:
+                log.info("No instances are running!")
+            else:
+                log.info("Killing displays %s" % ", ".join(":%d" % d for d in sorted(left)))
+                terminate_now([p for processes in left.values() for p in processes])
+                for display_num in left:
+                    Program.clean_display(display_num)
+            t.clear()
+
+
+scheduler = LaunchScheduler(max_launching, max_waiting, launch_mb, launch_reserve_mb, max_load, launch_timeout)
+pool = WarmPool(Program.create, scheduler, warm_pool_size, warm_pool_display_mb, warm_pool_reserve_mb)
 
 
 # Websocket handler
@@ -216,35 +462,84 @@ class CRI(websocket.WebSocketHandler):
     def check_origin(self, origin):
         return True
  
-    def send_dict(self, dictionary, to_all=False):
-        global connections
+    def get_compression_options(self):
+        if not ws_compression:
+            return None
+        return {"compression_level": ws_compression_level, "mem_level": ws_mem_level}
+
+    def send_dict(self, dictionary, to_all=False, key=None, low=False):
+        # Safe to call from any thread, the message is written on the IOLoop
+        if to_all:
+            broadcast(dictionary, key, low)
+            return
         try:
-            if to_all:
-                for c in connections:
-                    try:
-                        c.write_message(dumps(dictionary))
-                    except:
-                        log.error("Failed to write message %s to all clients" % dumps(dictionary))
-            else:
-                self.write_message(dumps(dictionary))
-        except:
-            log.error("Failed to write message %s" % dumps(dictionary))
+            encoding = self._encoding
+            message = encode(dictionary, encoding)
+            messages_total.inc("out", dictionary.get("exec"))
+            message_bytes.add(len(message), "out", dictionary.get("exec"))
+            self._outbox.send(message, key, low, is_binary(encoding))
+        except Exception as err:
+            log.error("Failed to write message %s (err: %s)" % (str(dictionary), str(err)))
+
+    def get_outbox(self):
+        return self._outbox
+
+    def get_encoding(self):
+        return self._encoding
+
+    def set_encoding(self, load):
+        encoding = load.get("encoding", "json")
+        if encoding not in get_encodings():
+            self.send_dict({"exec": "error", "message": "Unsupported encoding %s" % encoding})
+            return
+        log.info("Switching %s to %s" % (self.request.remote_ip, encoding))
+        self._encoding = encoding
+        self.send_dict({"exec": "encoding", "encoding": encoding})
 
     def open(self):
         global connections, master
         log.info("Connected with %s" % self.request.remote_ip)
         connections.add(self) # Add myself to the connection list
+        self._outbox = Outbox(self)
+        self._search_generation = 0
+        self._launches = set() # Launches still waiting in line
+        self._rtt = None # Smoothed round trip time to the client in seconds
+        self._ping_sent = None
+        self._pinger = ioloop.PeriodicCallback(self.__ping, ping_interval * 1000)
+        self._pinger.start()
+        self.__ping()
+        self._encoding = self.get_argument("encoding", "json")
+        if self._encoding not in get_encodings():
+            self._encoding = "json"
 
         # Respond with a positive status
-        self.send_dict({"exec": "status", "status": True})
+        self.send_dict({"exec": "status", "status": True, "encoding": self._encoding,
+            "encodings": get_encodings()})
+        if connection.is_online() is not None:
+            self.send_dict({"exec": "connectivity", "online": connection.is_online()})
+
+        report_state()
 
         # Check to see if this connection can be a master
-        if master is None:
+        if not has_master():
             self.send_dict({"exec": "master"})
 
+    def __ping(self):
+        self._ping_sent = ioloop.IOLoop.current().time()
+        self.ping(b"rtt")
+
+    def on_pong(self, data):
+        if self._ping_sent is None:
+            return
+        rtt = ioloop.IOLoop.current().time() - self._ping_sent
+        self._ping_sent = None
+        self._rtt = rtt if self._rtt is None else self._rtt * (1 - rtt_smoothing) + rtt * rtt_smoothing
+
+    @gen.coroutine
     def run_program(self, load):
         global programs, master
-        if master is None:
+        start = default_timer()
+        if not has_master():
             log.error("Trying to run program with no master connection!")
             self.send_dict({"exec": "error", "message": "No master connection (No connection that can make windows)!"})
             return
@@ -258,27 +553,118 @@ class CRI(websocket.WebSocketHandler):
             log.error("Couldn't find executable %s" % check_p)
             self.send_dict({"exec": "error", "message": "The executable %s doesn't exist or isn't in the PATH env variable" % check_p})
             return
+        if "profile" in load and not profiles.exists(load["profile"]):
+            self.send_dict({"exec": "error", "message": "Unknown profile %s" % load["profile"]})
+            return
+
+        # Wait for a turn, how many displays start at once depends on what the host can take
+        try:
+            turn = scheduler.acquire(load["name"], lambda position: self.send_dict({
+                "exec": "run_queued",
+                "name": load["name"],
+                "position": position
+            }))
+        except BusyError as err:
+            self.__busy(load["name"], err)
+            return
+        self._launches.add(turn)
+        try:
+            admitted = yield turn
+        except BusyError as err:
+            self.__busy(load["name"], err)
+            return
+        finally:
+            self._launches.discard(turn)
+        if not admitted:
+            return # The client left while it was waiting
+        try:
+            yield self.__launch(load, check_p, start)
+        finally:
+            scheduler.release()
+
+    def __busy(self, name, err):
+        log.warning("Turned away %s (%s)" % (name, str(err)))
+        self.send_dict({"exec": "busy", "name": name, "message": str(err)})
+
+    @gen.coroutine
+    def __launch(self, load, check_p, start):
+        global programs, master
+        if not has_master():
+            self.send_dict({"exec": "error", "message": "No master connection (No connection that can make windows)!"})
+            return
+
+        # Take an already started display when we have one
+        program = pool.get()
+        if program is None:
+            try:
+                program = yield Program.create(load["name"])
+            except CapacityError as err:
+                log.error(str(err))
+                self.send_dict({"exec": "error", "message": str(err)})
+                return
+        else:
+            program.set_name(load["name"])
+        profile = load.get("profile") or profiles.pick(self._rtt)
+        # A new display starts with the profile, a pooled one is switched while the app starts
+        switching = program.set_profile(profile)
+        if not program.is_display_ready():
+            yield switching
+        if not has_master():
+            # The master left while we got a display, nobody would stop this one
+            program.kill()
+            self.send_dict({"exec": "error", "message": "No master connection (No connection that can make windows)!"})
+            return
 
         n_id = str(uuid4())
-        programs[n_id] = Program(load["name"])
+        add_program(n_id, program)
+        program.set_restart_policy(load.get("restart", restart_policies.get(check_p, default_restart)))
+        program.set_exit_listener(partial(program_exited, n_id))
         self.send_dict({
             "exec": "run",
             "name": load["name"],
             "uuid": n_id,
-            "port": programs[n_id].get_proxy_port()
+            "port": server_port,
+            "path": "/vnc/%s" % n_id,
+            "profile": profile,
+            "settings": profiles.get_client_settings(profile)
         })
-        programs[n_id].run()
+        try:
+            started = yield program.run()
+        except Exception as err:
+            log.error("Failed to start %s (err: %s)" % (load["name"], str(err)))
+            started = False
+        if programs.get(n_id) is not program:
+            log.warning("Program %s was killed before it finished starting" % load["name"])
+            program.kill() # Whatever already started goes too (nothing happens when it's already killed)
+            return
+        if not started:
+            program.kill()
+            remove_program(n_id)
+            self.send_dict({"exec": "error", "message": "Failed to start %s" % load["name"]})
+            return
+        launch_seconds.observe(default_timer() - start, "total")
         self.send_dict({
             "exec": "load",
             "name": load["name"],
             "uuid": n_id
         })
+        switched = yield switching
+        if not switched and programs.get(n_id) is program:
+            # The viewer was told about the profile it asked for, it has to go back
+            self.send_dict({
+                "exec": "profile",
+                "uuid": n_id,
+                "status": False,
+                "profile": program.get_profile(),
+                "settings": profiles.get_client_settings(program.get_profile())
+            })
 
     def set_master(self, load):
         global master
         if load["status"]:
             log.info("Setting master to %s" % self.request.remote_ip)
             master = self
+            report_state()
         else:
             log.info("Master status declined by %s" % self.request.remote_ip)
             self.check_master()
@@ -293,109 +679,143 @@ class CRI(websocket.WebSocketHandler):
         log.info("Getting master information for %s" % self.request.remote_ip)
         self.send_dict({
             "exec": "get_master",
-            "status": (False if master is None else True)
+            "status": has_master()
         })
 
-    def __list_programs(self, apps):
-        for app in apps:
-            self.send_dict({
-                "exec": "list",
-                "app": app.get_dict()
-            })
+    @gen.coroutine
+    def switch_profile(self, load):
+        if not profiles.exists(load["profile"]):
+            self.send_dict({"exec": "error", "message": "Unknown profile %s" % load["profile"]})
+            return
+        if load["uuid"] in programs:
+            yield change_profile(load["uuid"], load["profile"])
+            return
+        # Another worker switches its own programs
+        try:
+            relayed = cluster is not None and (yield cluster.call_async("profile", load["uuid"], load["profile"]))
+        except IOError as err:
+            log.error("Failed to switch the profile (err: %s)" % str(err))
+            self.send_dict({"exec": "error", "message": "Failed to switch the profile"})
+            return
+        if not relayed:
+            self.send_dict({"exec": "error", "message": "Program doesn't exist"})
+
+    def list_profiles(self, load):
         self.send_dict({
-            "exec": "list_done"
+            "exec": "profiles",
+            "profiles": profiles.describe(),
+            "rtt": self._rtt,
+            "suggested": profiles.pick(self._rtt)
         })
 
+    def pool_status(self, load):
+        stats = pool.get_stats()
+        stats["exec"] = "pool"
+        self.send_dict(stats)
+
+    @gen.coroutine
     def list_programs(self, load):
-        app_list = Application.get_app_list()
-        thread.Thread(target=self.__list_programs, args=(app_list,)).start()
+        if not Application.is_catalog_ready():
+            yield Application.wait_catalog()
+        start = default_timer()
+        token, apps, removed, full = Application.get_catalog(load.get("since_version"))
+        page_size = max(1, int(load.get("page_size", list_page_size)))
+        page = max(0, int(load.get("page", 0)))
+        pages = max(1, (len(apps) + page_size - 1) // page_size)
+        icons = load.get("icons", True)
+
+        # The whole page goes out as one message
+        page_apps = [app.get_dict(icons) for app in apps[page * page_size:(page + 1) * page_size]]
+        list_seconds.observe(default_timer() - start)
+        self.send_dict({
+            "exec": "list",
+            "apps": page_apps,
+            "removed": removed if page == 0 else [],
+            "page": page,
+            "pages": pages,
+            "total": len(apps),
+            "full": full,
+            "version": token
+        })
+        if page >= pages - 1:
+            self.send_dict({
+                "exec": "list_done",
+                "version": token
+            })
 
-    def __search_packages(self, name):
+    def __search_packages(self, name, limit, search_id, generation):
+        # A newer search from this client replaces this one
+        cancelled = lambda: self._search_generation != generation
+        if cancelled():
+            return
         status = Package.search(name, lambda d: self.send_dict({
             "exec": "search",
+            "id": search_id,
             "package": d
-        }))
+        }, low=True), limit, cancelled)
 
-        if status is None:
+        if cancelled():
+            log.info("Search for %s was replaced" % name)
+        elif status is None:
             self.send_dict({
-                "exec": "search_done"
+                "exec": "search_done",
+                "id": search_id
             })
         else:
             self.send_dict({
                 "exec": "error",
+                "id": search_id,
                 "message": status
             })
 
     def search_packages(self, load):
         log.info("Searching for package %s" % load["search"])
-        thread.Thread(target=self.__search_packages, args=(load["search"],)).start()
-
-    def __install_package(self, name):
-        status = Package.install(name, self)
-        if status is not None:
-            self.send_dict({
-                "exec": "error",
-                "message": status
-            })
-        log.info("Loading the new app list")
-        Application.load_app_list()
-        Package.reload_cache(self)
+        try:
+            limit = max(1, min(int(load.get("limit", search_limit)), search_limit))
+        except (TypeError, ValueError):
+            self.send_dict({"exec": "error", "id": load.get("id"), "message": "The limit has to be a number"})
+            return
+        self._search_generation += 1
+        search_jobs.put(partial(self.__search_packages, load["search"], limit,
+            load.get("id"), self._search_generation))
 
     def install_package(self, load):
         log.info("Installing packages %s" % load["install"])
-        thread.Thread(target=self.__install_package, args=(load["install"],)).start()
-
-    def __delete_package(self, name, purge):
-        status = Package.delete(name, self, purge)
-        if status is not None:
-            self.send_dict({
-                "exec": "error",
-                "message": status
-            })
-        log.info("Loading the new app list")
-        Application.load_app_list()
-        Package.reload_cache(self)
+        apt_queue.submit("install", load["install"], self, load.get("id"))
 
     def delete_package(self, load):
         log.info("Deleting packages %s" % load["delete"])
-        thread.Thread(target=self.__delete_package, args=(load["delete"], load["purge"])).start()
+        apt_queue.submit("delete", load["delete"], self, load.get("id"), load.get("purge", False))
 
+    @gen.coroutine
     def kill_program(self, load):
         global programs
         status = True
         try:
             if load["uuid"] not in programs:
-                self.send_dict({"exec": "error", "message": "Program doesn't exist"})
-                return
-            log.info("Killing program %s" % programs[load["uuid"]].get_name())
-
-            # Kill the program
-            programs[load["uuid"]].kill()
-
-            # Delete the program element
-            del programs[load["uuid"]]
-
-            log.info("Killed the program!")
+                # It might belong to another worker, that one kills it
+                relayed = cluster is not None and (yield cluster.call_async("kill", load["uuid"]))
+                if not relayed:
+                    self.send_dict({"exec": "error", "message": "Program doesn't exist"})
+                    return
+            else:
+                stop_program(load["uuid"])
+                log.info("Killed the program!")
         except Exception as err:
             log.error("Failed to kill the program (err: %s)" % str(err))
+            status = False
 
         self.send_dict({"exec": "kill", "status": status})
 
     def check_master(self):
-        global programs, master
-        if master is None:
+        if not has_master():
             log.info("There are no more connections left! Killing all programs...")
-            for p in programs.values():
-                try:
-                    p.kill()
-                except Exception as err:
-                    log.error("Failed to kill program (err: %s)" % str(err))
-            programs = {}
-            log.info("Done")
+            stop_programs()
 
     def on_message(self, message):
         #try:
-        data = loads(message)
+        # Text frames are always JSON, binary ones use the negotiated encoding
+        data = decode(message, self._encoding if isinstance(message, bytes) else "json")
         execs = {
             "set_master": self.set_master,
             "get_master": self.get_master,
@@ -404,9 +824,18 @@ class CRI(websocket.WebSocketHandler):
             "list": self.list_programs,
             "search": self.search_packages,
             "install": self.install_package,
-            "delete": self.delete_package
+            "delete": self.delete_package,
+            "pool": self.pool_status,
+            "profile": self.switch_profile,
+            "profiles": self.list_profiles,
+            "encoding": self.set_encoding
         }
-        execs[data["exec"]](data)
+        # Clients pick the exec, only ours become labels so the metrics can't grow without bound
+        name = data.get("exec")
+        label = name if name in execs else "unknown"
+        messages_total.inc("in", label)
+        message_bytes.add(len(message), "in", label)
+        execs[name](data)
         #except Exception as err:
         #self.send_dict({"exec": "error", "message": str(err)})
  
@@ -420,8 +849,16 @@ class CRI(websocket.WebSocketHandler):
 
         # Remove this connection from the list before requesting another master connection
         connections.remove(self)
+        self._outbox.close()
+        self._pinger.stop()
+        for turn in list(self._launches):
+            scheduler.cancel(turn)
+        self._search_generation += 1 # Stop any search still running for us
 
-        if master is None and len(connections) == 0:
+        if cluster is not None:
+            # The coordinator knows about the other workers, it asks for a new master or stops the programs
+            report_state()
+        elif master is None and len(connections) == 0:
             self.check_master()
         elif master is None:
             # Request another master connection
@@ -430,24 +867,234 @@ class CRI(websocket.WebSocketHandler):
                 c.send_dict({"exec": "master"}) # Request if the other connections can be the master connection
         log.info("Disconnected with %s" % self.request.remote_ip)
 
+def search_worker():
+    while True:
+        job = search_jobs.get()
+        try:
+            job()
+        except Exception as err:
+            log.error("Search failed (err: %s)" % str(err))
+
+
+def broadcast(dictionary, key=None, low=False):
+    # Serialized once per encoding for every client on every worker, safe to call from any thread
+    ioloop.IOLoop.instance().add_callback(_broadcast, dictionary, encode(dictionary), key, low, True)
+
+
+def local_broadcast(dictionary, key=None, low=False):
+    # Only this worker's clients, for what every worker finds out by itself (the catalog, connectivity)
+    ioloop.IOLoop.instance().add_callback(_broadcast, dictionary, encode(dictionary), key, low)
+
+
+def _broadcast(dictionary, message, key, low, relay=False):
+    if relay and cluster is not None:
+        cluster.send("broadcast", message=dictionary, key=key, low=low)
+    messages = {"json": message}
+    for c in connections:
+        encoding = c.get_encoding()
+        if encoding not in messages:
+            messages[encoding] = encode(dictionary, encoding)
+        c.get_outbox().put(messages[encoding], key, low, is_binary(encoding))
+        messages_total.inc("out", dictionary.get("exec"))
+        message_bytes.add(len(messages[encoding]), "out", dictionary.get("exec"))
+
+
+apt_queue = AptQueue(broadcast)
+Gauge("cri_apt_queued_jobs", "Apt jobs waiting for the worker", callback=apt_queue.size)
+
+
+@gen.coroutine
+def program_exited(uuid, program, code):
+    name = program.get_name()
+    if programs.get(uuid) is not program:
+        return
+    if program.should_restart(code):
+        log.info("Restarting %s (code: %s)" % (name, str(code)))
+        broadcast({"exec": "restarting", "uuid": uuid, "name": name, "code": code})
+        started = yield program.run()
+        if programs.get(uuid) is not program:
+            return
+        if started:
+            broadcast({"exec": "load", "uuid": uuid, "name": name})
+            return
+        code = None
+
+    # Free the display and its ports right away
+    remove_program(uuid)
+    state = program.get_state()
+    program.kill()
+    broadcast({"exec": "exited", "uuid": uuid, "name": name, "code": code, "state": state})
+
+
+@gen.coroutine
+def change_profile(uuid, profile):
+    # Every viewer of the program has to change its quality and compression levels too
+    program = programs.get(uuid)
+    if program is None:
+        return
+    switched = yield program.set_profile(profile)
+    broadcast({
+        "exec": "profile",
+        "uuid": uuid,
+        "status": switched,
+        "profile": program.get_profile(),
+        "settings": profiles.get_client_settings(program.get_profile())
+    })
+
+
+@gen.coroutine
+def load_catalog():
+    yield Application.load_app_list()
+    Application.watch_app_list()
+
+
+@gen.coroutine
+def find_port(uuid):
+    program = programs.get(uuid)
+    if program is not None:
+        raise gen.Return(program.get_port())
+    if cluster is None:
+        raise gen.Return(None)
+    # The display might belong to another worker, it's on this host all the same
+    port = yield cluster.call_async("lookup", uuid)
+    raise gen.Return(port)
+
+
+@gen.coroutine
+def gather_metrics():
+    """What the other workers measured, so one scrape covers them all"""
+    if cluster is None:
+        raise gen.Return([])
+    try:
+        others = yield cluster.call_async("metrics")
+    except IOError as err:
+        log.error("Failed to gather the metrics of the other workers (err: %s)" % str(err))
+        others = []
+    raise gen.Return(others)
+
+
+def has_master():
+    """Whether any worker has a master connection"""
+    return master is not None or (cluster is not None and cluster.has_master())
+
+
+def report_state():
+    if cluster is not None:
+        cluster.send("state", connections=len(connections), master=master is not None)
+
+
+def add_program(uuid, program):
+    programs[uuid] = program
+    if cluster is not None:
+        cluster.send("register", uuid=uuid, port=program.get_port())
+
+
+def remove_program(uuid):
+    del programs[uuid]
+    if cluster is not None:
+        cluster.send("unregister", uuid=uuid)
+
+
+def stop_program(uuid):
+    if uuid not in programs:
+        return
+    log.info("Killing program %s" % programs[uuid].get_name())
+    programs[uuid].kill()
+    remove_program(uuid)
+
+
+def stop_programs():
+    for uuid in list(programs):
+        try:
+            stop_program(uuid)
+        except Exception as err:
+            log.error("Failed to kill program (err: %s)" % str(err))
+    log.info("Done")
+
+
+def start_worker():
+    """Fork the workers and the coordinator, everything after this runs once in every worker"""
+    global tracker, allocator, cluster
+    sockets = netutil.bind_sockets(server_port)
+    worker = fork_workers(worker_processes, coordinator_socket, display_port, display_offset, max_displays)
+    log.info("Worker %d started" % worker)
+    set_process_label("worker", worker)
+
+    # A worker that's started again cleans up after the one before it
+    tracker = ProcessTracker("%s.%d" % (state_file, worker))
+    Program.kill_all()
+    cluster = CoordinatorClient(coordinator_socket, worker)
+    allocator = RemoteAllocator(cluster)
+    apt_queue.set_apt_lock(AptLock(cluster))
+    cluster.on("broadcast", lambda m: _broadcast(m["message"], encode(m["message"]), m.get("key"), m.get("low", False)))
+    cluster.on("kill", lambda m: stop_program(m["uuid"]))
+    cluster.on("profile", lambda m: change_profile(m["uuid"], m["profile"]))
+    cluster.on("idle", lambda m: stop_programs())
+    cluster.on("scrape", lambda m: cluster.send("samples", id=m["id"], samples=samples()))
+    cluster.on("lost", lambda m: shutdown())
+    ioloop.IOLoop.instance().add_callback(cluster.connect)
+    return sockets
+
+
 def main():
     log.info("Starting CRI...")
     log.info("Developed by David Smerkous and Eli Smith")
 
+    # Only reads the state file, it just waits on processes an earlier run left behind
     log.info("Killing all current instances...")
-    Program.kill_all()
+    Program.kill_all([ProcessTracker(path) for path in [state_file] + sorted(glob(state_file + ".[0-9]*"))])
     log.info("Done")
+    Program.create_startup()
+    sockets = start_worker() if worker_processes > 1 else None
 
-    log.info("Loading all available apps...")
-    Application.load_app_list()
-
+    # Listen first, everything that takes a while starts in the background and requests wait on it
     log.info("Starting websocket server")
-    service = web.Application([(r'/', CRI),])
+    service = web.Application([
+        (r'/', CRI),
+        (r'/icons/([0-9a-f]+)', IconHandler),
+        (r'/metrics', MetricsHandler, dict(gather=gather_metrics)),
+        (r'/vnc/([0-9a-f\-]+)', VNCProxy, dict(lookup=find_port))
+    ])
     listenr = httpserver.HTTPServer(service)
-    listenr.listen(server_port)
+    if sockets is None:
+        listenr.listen(server_port)
+    else:
+        listenr.add_sockets(sockets)
+
+    log.info("Loading all available apps in the background...")
+    Application.add_listener(local_broadcast)
+    ioloop.IOLoop.instance().add_callback(load_catalog)
+
+    connection.add_listener(lambda online: local_broadcast({"exec": "connectivity", "online": online}, "connectivity"))
+    connection.start()
+
+    apt_queue.start()
+
+    cache_loader = thread.Thread(target=Package.open_cache)
+    cache_loader.daemon = True
+    cache_loader.start()
+    for i in range(0, search_workers):
+        worker = thread.Thread(target=search_worker)
+        worker.daemon = True
+        worker.start()
+
+    if pool.is_enabled():
+        log.info("Warming up %d displays" % warm_pool_size)
+        ioloop.IOLoop.instance().add_callback(pool.fill)
+    LoopMonitor(ioloop_lag, lag_interval).start()
+    signal.signal(signal.SIGTERM, lambda s, f: ioloop.IOLoop.instance().add_callback_from_signal(shutdown))
+    signal.signal(signal.SIGINT, lambda s, f: ioloop.IOLoop.instance().add_callback_from_signal(shutdown))
     ioloop.IOLoop.instance().start()
 
 
+def shutdown():
+    log.info("Shutting down...")
+    pool.drain()
+    Program.kill_all()
+    apt_queue.stop() # Before the coordinator and the module globals go away under it
+    ioloop.IOLoop.instance().stop()
+
+
 if __name__ == "__main__":
     try:
         main()
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""CRI metrics
+
+This module keeps counters, gauges and histograms in memory and serves them at /metrics
+in the Prometheus text format. Recording a value is a dictionary update under a lock so
+the instrumentation can stay on all the time, gauges that mirror existing state are only
+read when /metrics is scraped. With several worker processes every sample gets a worker label
+and the worker that's scraped adds what the others sent it, so the series stay continuous
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from tornado import web, ioloop, gen
+from timeit import default_timer
+from bisect import bisect_left
+import threading as thread
+
+# Configs
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Every metric in the order it was created
+registry = []
+process_labels = () # (name, value) pairs on every sample of this process
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Timer(object):
+    __slots__ = ("_histogram", "_labels", "_start")
+
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = default_timer()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(default_timer() - self._start, *self._labels)
+        return False
+
+
+class Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name, description, labels=()):
+        self._name = name
+        self._description = description
+        self._labels = tuple(labels)
+        self._values = {} # label values -> value
+        self._lock = thread.Lock()
+        registry.append(self)
+
+    def get_name(self):
+        return self._name
+
+    def _label_text(self, values, extra=()):
+        pairs = ["%s=\"%s\"" % (k, _escape(v)) for k, v in process_labels]
+        pairs += ["%s=\"%s\"" % (k, _escape(v)) for k, v in zip(self._labels, values)]
+        pairs += ["%s=\"%s\"" % (k, _escape(v)) for k, v in extra]
+        return "{%s}" % ",".join(pairs) if len(pairs) > 0 else ""
+
+    def _samples(self):
+        with self._lock:
+            return sorted(self._values.items())
+
+    def header(self):
+        return ["# HELP %s %s" % (self._name, self._description), "# TYPE %s %s" % (self._name, self.kind)]
+
+    def render(self):
+        lines = []
+        for values, value in self._samples():
+            lines.append("%s%s %s" % (self._name, self._label_text(values), _number(value)))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels):
+        self.add(1, *labels)
+
+    def add(self, amount, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self._values.get(labels, 0)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, description, labels=(), callback=None):
+        """A callback returning {label values: value} (or a number without labels) is read at scrape time"""
+        Metric.__init__(self, name, description, labels)
+        self._callback = callback
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def _samples(self):
+        if self._callback is None:
+            return Metric._samples(self)
+        values = self._callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return sorted(values.items())
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=default_buckets):
+        Metric.__init__(self, name, description, labels)
+        self._buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        i = bisect_left(self._buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self._buckets) + 1), 0.0, 0]
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, *labels):
+        """Observe how long a with block takes"""
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            samples = sorted((values, (list(e[0]), e[1], e[2])) for values, e in self._values.items())
+        for values, (counts, total, count) in samples:
+            cumulative = 0
+            for bound, n in zip(self._buckets + (float("inf"),), counts):
+                cumulative += n
+                lines.append("%s_bucket%s %d" % (self._name, self._label_text(values, [("le", _number(bound))]), cumulative))
+            lines.append("%s_sum%s %s" % (self._name, self._label_text(values), _number(total)))
+            lines.append("%s_count%s %d" % (self._name, self._label_text(values), count))
+        return lines
+
+
+class LoopMonitor(object):
+    """Observes how late the IOLoop runs a timer, which is how long something blocked it"""
+    def __init__(self, histogram, interval):
+        self._histogram = histogram
+        self._interval = interval
+        self._expected = None
+
+    def start(self):
+        loop = ioloop.IOLoop.current()
+        self._expected = loop.time() + self._interval
+        loop.call_at(self._expected, self._check)
+
+    def _check(self):
+        loop = ioloop.IOLoop.current()
+        now = loop.time()
+        self._histogram.observe(max(0.0, now - self._expected))
+        self._expected = now + self._interval
+        loop.call_at(self._expected, self._check)
+
+
+def set_process_label(name, value):
+    global process_labels
+    process_labels = ((name, value),)
+
+
+def samples():
+    """The sample lines of every metric by name, for another process to render"""
+    return dict((metric.get_name(), metric.render()) for metric in registry)
+
+
+def render(others=()):
+    """The Prometheus text of every metric, others are samples() of other processes to add in"""
+    lines = []
+    for metric in registry:
+        lines += metric.header()
+        lines += metric.render()
+        for other in others:
+            lines += other.get(metric.get_name(), [])
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(web.RequestHandler):
+    def initialize(self, gather=None):
+        self._gather = gather # Returns (a future of) the samples() of the other processes
+
+    @gen.coroutine
+    def get(self):
+        others = []
+        if self._gather is not None:
+            others = yield gen.maybe_future(self._gather())
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.set_header("Cache-Control", "no-cache")
+        self.write(render(others))
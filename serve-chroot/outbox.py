@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""CRI outbound message queue
+
+Every message to a client goes through that client's Outbox. Messages can be handed in
+from any thread, they're written one at a time on the IOLoop and the next write waits for
+the last one to be flushed. When a client falls behind, queued progress is merged with the
+newer state and low priority messages are dropped, and a client that still can't keep up
+is disconnected instead of growing the queue forever
+
+Messages are JSON text by default, clients can ask for MessagePack (sent as binary frames)
+when the msgpack module is installed
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from logger import Logger
+from collections import deque
+from tornado import gen, ioloop
+from tornado.iostream import StreamClosedError
+from tornado.websocket import WebSocketClosedError
+from json import dumps, loads
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Configs
+outbox_size = 256 # Queued messages before low priority ones are dropped
+outbox_limit = 4096 # Queued messages before the client is disconnected
+
+# Logs
+log = Logger("OUT")
+
+# Wire encodings, name -> (encode, decode, binary frames)
+encodings = {
+    "json": (dumps, loads, False)
+}
+if msgpack is not None:
+    # Browsers decode msgpack bin as a Uint8Array so text has to be packed as str. Python 2 str
+    # is bytes, use_bin_type would make every key and value of ours bin there
+    encodings["msgpack"] = (lambda d: msgpack.packb(d, use_bin_type=str is not bytes),
+            lambda m: msgpack.unpackb(m, raw=False), True)
+
+
+def get_encodings():
+    return sorted(encodings.keys())
+
+
+def encode(dictionary, encoding="json"):
+    return encodings[encoding][0](dictionary)
+
+
+def decode(message, encoding="json"):
+    return encodings[encoding][1](message)
+
+
+def is_binary(encoding):
+    return encodings[encoding][2]
+
+
+class Outbox(object):
+    def __init__(self, websocket, size=outbox_size, limit=outbox_limit):
+        self._websocket = websocket
+        self._size = size
+        self._limit = limit
+        self._messages = deque() # [message, key, low priority, binary]
+        self._keys = {} # merge key -> queued entry
+        self._writing = False
+        self._closed = False
+        self._dropped = 0
+
+    def get_dropped(self):
+        return self._dropped
+
+    def size(self):
+        return len(self._messages)
+
+    def send(self, message, key=None, low=False, binary=False):
+        """Queue a serialized message from any thread"""
+        ioloop.IOLoop.instance().add_callback(self.put, message, key, low, binary)
+
+    def put(self, message, key=None, low=False, binary=False):
+        """Queue a serialized message (IOLoop only)
+
+        A message with a key replaces a queued message with the same key (the latest
+        progress or state is all the client needs) and goes to the back of the queue, so it
+        never overtakes what was queued after the message it replaced. Low priority messages
+        without a key can be dropped when the client falls behind
+        """
+        if self._closed:
+            return
+        if key is not None:
+            stale = self._keys.pop(key, None)
+            if stale is not None:
+                # Only one entry per key is ever queued, so this removes exactly the stale one
+                self._messages.remove(stale)
+        entry = [message, key, low, binary]
+        self._messages.append(entry)
+        if key is not None:
+            self._keys[key] = entry
+        if len(self._messages) > self._size:
+            self._shed()
+        if not self._writing and not self._closed:
+            self._writing = True
+            self._drain()
+
+    def close(self):
+        self._closed = True
+        self._messages.clear()
+        self._keys.clear()
+
+    def _shed(self):
+        # Drop the oldest low priority messages first, merged ones only ever hold one per key
+        extra = len(self._messages) - self._size
+        kept = deque()
+        for entry in self._messages:
+            if extra > 0 and entry[2] and entry[1] is None:
+                extra -= 1
+                self._dropped += 1
+            else:
+                kept.append(entry)
+        self._messages = kept
+        if len(self._messages) > self._limit:
+            log.warning("Client %s is too slow, %d messages queued! Disconnecting" % (
+                self._websocket.request.remote_ip, len(self._messages)))
+            self.close()
+            self._websocket.close()
+
+    @gen.coroutine
+    def _drain(self):
+        try:
+            while len(self._messages) > 0 and not self._closed:
+                message, key, low, binary = self._messages.popleft()
+                if key is not None:
+                    del self._keys[key]
+                yield self._websocket.write_message(message, binary=binary)
+        except (WebSocketClosedError, StreamClosedError):
+            self.close()
+        finally:
+            self._writing = False
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""CRI warm display pool
+
+This module keeps a few fully started, idle displays (vnc and i3) ready so that a run
+request only has to exec the application inside one of them.
+The pool refills itself in the background and never grows past what the host memory allows.
+Every display it starts takes a low priority turn from the launch scheduler first, so refills
+count towards the launches running at once and never hold up a run request
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from logger import Logger
+from ports import CapacityError
+from scheduler import BusyError
+from tornado import gen, ioloop
+from collections import deque
+import host
+
+# Logs
+log = Logger("POOL")
+
+
+class WarmPool(object):
+    def __init__(self, factory, scheduler, size, display_mb, reserve_mb):
+        self._factory = factory # Makes a new program without a started display (a future)
+        self._scheduler = scheduler
+        self._size = size
+        self._display_mb = display_mb
+        self._reserve_mb = reserve_mb
+        self._idle = deque()
+        self._starting = 0
+        self._hits = 0
+        self._misses = 0
+
+    def is_enabled(self):
+        return self._size > 0
+
+    def get_stats(self):
+        return {
+            "size": self._size,
+            "idle": len(self._idle),
+            "starting": self._starting,
+            "hits": self._hits,
+            "misses": self._misses
+        }
+
+    def get(self):
+        """Hand out an idle display or None if the pool is empty (disabled pools always miss)"""
+        program = self._idle.popleft() if self._idle else None
+        if program is None:
+            self._misses += 1
+        else:
+            self._hits += 1
+        if self.is_enabled():
+            log.info("Warm pool %s (hits: %d, misses: %d)" % ("hit" if program else "miss", self._hits, self._misses))
+            ioloop.IOLoop.current().add_callback(self.fill)
+        return program
+
+    def _affordable(self):
+        # Each new display needs its share of memory on top of what the host keeps in reserve
+        return max(0, (host.mem_available_mb() - self._reserve_mb) // self._display_mb)
+
+    def fill(self):
+        missing = self._size - len(self._idle) - self._starting
+        if missing <= 0:
+            return
+        missing = min(missing, self._affordable() - self._starting)
+        if missing <= 0:
+            log.warning("Not enough free memory to grow the warm pool")
+            return
+        for i in range(0, missing):
+            self._starting += 1
+            self._warm()
+
+    @gen.coroutine
+    def _warm(self):
+        try:
+            admitted = yield self._scheduler.acquire("warm display", low=True)
+        except BusyError as err:
+            admitted = False
+            log.warning("Can't grow the warm pool (err: %s)" % str(err))
+        if not admitted or not self.is_enabled():
+            self._starting -= 1
+            if admitted:
+                self._scheduler.release()
+            return
+        try:
+            program = yield self._factory()
+        except CapacityError as err:
+            self._starting -= 1
+            self._scheduler.release()
+            log.warning("Can't grow the warm pool (err: %s)" % str(err))
+            return
+        try:
+            started = yield program.start_display()
+        except Exception as err:
+            log.error("Failed to warm a display (err: %s)" % str(err))
+            started = False
+        finally:
+            self._starting -= 1
+            self._scheduler.release()
+        if started and self.is_enabled():
+            program.set_exit_listener(self._died)
+            self._idle.append(program)
+            log.info("Warm pool has %d idle displays" % len(self._idle))
+        else:
+            program.kill()
+
+    def _died(self, program, code):
+        # An idle display stopped, free it and start another one
+        if program in self._idle:
+            self._idle.remove(program)
+            log.warning("An idle display stopped, replacing it")
+            program.kill()
+            ioloop.IOLoop.current().add_callback(self.fill)
+
+    def drain(self):
+        """Stop refilling and kill the idle displays, displays still starting are killed once they're up"""
+        self._size = 0
+        while self._idle:
+            self._idle.popleft().kill()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""CRI port allocator
+
+This module hands out the display numbers and vnc (rfb) ports used by each program.
+They are handed out and reclaimed together as one slot, in constant time
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from collections import deque
+
+
+class CapacityError(Exception):
+    pass
+
+
+class Slot(object):
+    __slots__ = ("index", "display_num", "port")
+
+    def __init__(self, index, display_num, port):
+        self.index = index
+        self.display_num = display_num
+        self.port = port
+
+
+class PortAllocator(object):
+    def __init__(self, display_port, display_offset, size):
+        self._display_port = display_port
+        self._display_offset = display_offset
+        self._size = size
+        self._free = deque(range(0, size)) # Lowest slots first so the display numbers stay small
+        self._used = set()
+
+    def get_size(self):
+        return self._size
+
+    def get_used(self):
+        return len(self._used)
+
+    def get_free(self):
+        return len(self._free)
+
+    def allocate(self):
+        if not self._free:
+            raise CapacityError("Capacity exhausted! All %d displays are in use" % self._size)
+        index = self._free.popleft()
+        self._used.add(index)
+        return Slot(index, self._display_offset + index, self._display_port + index)
+
+    def release(self, slot):
+        # Releasing twice (or releasing nothing) is harmless so callers can always clean up
+        if slot is None or slot.index not in self._used:
+            return False
+        self._used.remove(slot.index)
+        self._free.append(slot.index)
+        return True
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""CRI readiness probes
+
+This module checks whether a program's own vnc server is actually accepting connections
+and speaking RFB. Every probe is a non-blocking connect on the IOLoop that is retried with
+an exponential backoff until a deadline
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from tornado import gen, ioloop, tcpclient
+from tornado.iostream import StreamClosedError
+import socket
+
+# Configs
+probe_host = "127.0.0.1"
+probe_min_interval = 0.01 # Seconds to wait after the first failed attempt
+probe_max_interval = 0.5 # The backoff never waits longer than this between attempts
+rfb_banner = b"RFB "
+rfb_banner_size = 12 # "RFB xxx.yyy\n"
+connect_errors = (socket.error, IOError, StreamClosedError) # What a refused or dropped probe raises
+
+client = None
+
+
+def get_client():
+    """The shared TCP client, made on first use so it belongs to the IOLoop of the process using it"""
+    global client
+    if client is None:
+        client = tcpclient.TCPClient()
+    return client
+
+
+def close_late(connecting):
+    """Close the stream of a connect that only finishes after its timeout"""
+    def close(future):
+        if future.exception() is None:
+            future.result().close()
+    connecting.add_done_callback(close)
+
+
+@gen.coroutine
+def _attempt(port, handshake, timeout):
+    # A connect or read that fails after the timeout is expected, with_timeout shouldn't log it
+    connecting = get_client().connect(probe_host, port)
+    try:
+        stream = yield gen.with_timeout(timeout, connecting, quiet_exceptions=connect_errors)
+    except gen.TimeoutError:
+        close_late(connecting)
+        raise
+    try:
+        if handshake:
+            banner = yield gen.with_timeout(timeout, stream.read_bytes(rfb_banner_size),
+                    quiet_exceptions=connect_errors)
+            if not banner.startswith(rfb_banner):
+                raise IOError("Unexpected rfb banner %r" % banner)
+    finally:
+        stream.close()
+
+
+@gen.coroutine
+def wait_for(port, deadline, handshake=False):
+    """Retry connecting to the local port until it answers or the IOLoop deadline passes
+
+    With handshake set the server also has to send its RFB protocol version
+    Returns True once the port is ready and False when the deadline is hit
+    """
+    loop = ioloop.IOLoop.current()
+    delay = probe_min_interval
+    while True:
+        try:
+            yield _attempt(port, handshake, deadline)
+            raise gen.Return(True)
+        except connect_errors + (gen.TimeoutError,):
+            pass
+        if loop.time() + delay >= deadline:
+            raise gen.Return(False)
+        yield gen.sleep(delay)
+        delay = min(delay * 2, probe_max_interval)
+
+
+def wait_for_rfb(port, deadline):
+    return wait_for(port, deadline, True)
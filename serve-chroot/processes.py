@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""CRI process tracker
+
+This module remembers the pid of every display server and application CRI starts, by
+display number, in a small state file. That way only our own processes are ever killed,
+even after CRI crashed and was started again. Processes are stopped all at once with a
+SIGTERM, whatever is still running when the timeout runs out gets a SIGKILL, and a pid is
+only signalled while it still has the start time it was recorded with. Processes that aren't
+our children are watched by polling so their exit is still noticed. Our children are tornado
+Subprocesses and only tornado reaps them, or their exit callbacks would never run
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from logger import Logger
+from os import kill, rename, sysconf
+from os.path import exists
+from signal import SIGTERM, SIGKILL
+from tornado import ioloop
+from tornado.concurrent import Future
+from json import loads, dumps
+from time import sleep, time
+import errno
+
+# Configs
+kill_timeout = 3 # Seconds processes get to exit before they're killed
+poll_interval = 0.05 # Seconds between checks for processes that are still exiting
+clock_ticks = sysconf("SC_CLK_TCK") # Units of the cpu times in /proc/<pid>/stat
+
+# Logs
+log = Logger("PROC")
+
+
+def read_stat(pid):
+    """Get the (state, start time) of a process from /proc, None when it doesn't exist"""
+    try:
+        with open("/proc/%d/stat" % pid, "r") as f:
+            stat = f.read()
+    except (IOError, OSError):
+        return None
+    # The command name can contain spaces, the fields we want come after it
+    fields = stat[stat.rfind(")") + 2:].split()
+    return fields[0], fields[19]
+
+
+def read_usage(pid):
+    """Get the (cpu seconds, bytes written) of a process from /proc, None when it doesn't exist
+
+    The bytes written include sockets, for a display server that's mostly what it sent its viewers
+    """
+    try:
+        with open("/proc/%d/stat" % pid, "r") as f:
+            stat = f.read()
+        with open("/proc/%d/io" % pid, "r") as f:
+            io = f.read()
+    except (IOError, OSError):
+        return None
+    fields = stat[stat.rfind(")") + 2:].split()
+    written = 0
+    for line in io.splitlines():
+        if line.startswith("wchar:"):
+            written = int(line.split()[1])
+    return (int(fields[11]) + int(fields[12])) / float(clock_ticks), written
+
+
+def read_cmdline(pid):
+    """Get the arguments a process was started with, None when it doesn't exist"""
+    try:
+        with open("/proc/%d/cmdline" % pid, "r") as f:
+            return [arg for arg in f.read().split("\0") if arg]
+    except (IOError, OSError):
+        return None
+
+
+def start_time(pid):
+    stat = read_stat(pid)
+    return None if stat is None else stat[1]
+
+
+def is_alive(pid, started=None):
+    # An exited child stays a zombie until tornado reaps it, the state below tells
+    try:
+        kill(pid, 0)
+    except OSError as err:
+        if err.errno != errno.EPERM:
+            return False
+    stat = read_stat(pid)
+    if stat is None:
+        return exists("/proc/%d" % pid) or not exists("/proc")
+    state, start = stat
+    if state == "Z":
+        return False
+    # The pid was given to another process since we saw it
+    return started is None or start == started
+
+
+def _signal(processes, sig):
+    for pid, started in processes:
+        if not is_alive(pid, started):
+            continue # Gone, or the pid belongs to another process by now
+        try:
+            kill(pid, sig)
+        except OSError as err:
+            if err.errno != errno.ESRCH:
+                log.warning("Couldn't signal %d (err: %s)" % (pid, str(err)))
+
+
+def terminate(processes, timeout=kill_timeout, callback=None):
+    """Stop (pid, start time) processes without blocking the IOLoop
+
+    callback runs (and the returned future resolves) once they're all gone
+    """
+    loop = ioloop.IOLoop.current()
+    done = Future()
+    deadline = loop.time() + timeout
+    _signal(processes, SIGTERM)
+
+    def check(processes):
+        alive = [p for p in processes if is_alive(*p)]
+        if len(alive) > 0 and loop.time() < deadline:
+            loop.call_later(poll_interval, check, alive)
+            return
+        if len(alive) > 0:
+            log.warning("Killing %s, they didn't exit in time" % ", ".join(str(pid) for pid, started in alive))
+            _signal(alive, SIGKILL)
+        if callback is not None:
+            callback()
+        done.set_result(None)
+    check(processes)
+    return done
+
+
+def terminate_now(processes, timeout=kill_timeout):
+    """Stop (pid, start time) processes, blocks for at most timeout seconds"""
+    deadline = time() + timeout
+    _signal(processes, SIGTERM)
+    alive = [p for p in processes if is_alive(*p)]
+    while len(alive) > 0 and time() < deadline:
+        sleep(poll_interval)
+        alive = [p for p in alive if is_alive(*p)]
+    if len(alive) > 0:
+        log.warning("Killing %s, they didn't exit in time" % ", ".join(str(pid) for pid, started in alive))
+        _signal(alive, SIGKILL)
+
+
+class ProcessTracker(object):
+    def __init__(self, path):
+        self._path = path
+        self._displays = {} # display number -> {role: [pid, start time]}
+
+    def track(self, display_num, role, pid):
+        self._displays.setdefault(display_num, {})[role] = [pid, start_time(pid)]
+        self.save()
+
+    def untrack(self, display_num):
+        """Forget a display, returns the pids that were recorded for it"""
+        roles = self._displays.pop(display_num, {})
+        self.save()
+        return [pid for pid, started in roles.values()]
+
+    def clear(self):
+        self._displays = {}
+        self.save()
+
+    def forget(self, display_num, role):
+        """Stop tracking one process of a display after it exited by itself"""
+        roles = self._displays.get(display_num)
+        if roles is not None and roles.pop(role, None) is not None:
+            self.save()
+
+    def get_processes(self, display_num):
+        """The (pid, start time) of every process of a display"""
+        return [(pid, started) for pid, started in self._displays.get(display_num, {}).values()]
+
+    def get_pid(self, display_num, role):
+        entry = self._displays.get(display_num, {}).get(role)
+        return None if entry is None else entry[0]
+
+    def get_process(self, display_num, role):
+        entry = self._displays.get(display_num, {}).get(role)
+        return None if entry is None else tuple(entry)
+
+    def get_displays(self):
+        return list(self._displays.keys())
+
+    def save(self):
+        # Write a new file and swap it in so a crash never leaves half a state file
+        try:
+            with open(self._path + ".tmp", "w") as f:
+                f.write(dumps(dict((str(d), roles) for d, roles in self._displays.items())))
+            rename(self._path + ".tmp", self._path)
+        except (IOError, OSError) as err:
+            log.error("Failed to save the process state %s (err: %s)" % (self._path, str(err)))
+
+    def load(self):
+        """Read the state an earlier run left behind, returns {display: [(pid, start time) still running]}"""
+        if not exists(self._path):
+            return {}
+        try:
+            with open(self._path, "r") as f:
+                saved = loads(f.read())
+        except (IOError, OSError, ValueError) as err:
+            log.error("Failed to read the process state %s (err: %s)" % (self._path, str(err)))
+            return {}
+        left = {}
+        for display, roles in saved.items():
+            for pid, started in roles.values():
+                if is_alive(pid, started):
+                    left.setdefault(int(display), []).append((pid, started))
+        return left
+
+
+class ProcessWatcher(object):
+    """Polls processes we can't get exit callbacks for (vncserver daemonizes Xvnc)"""
+    def __init__(self, interval):
+        self._watched = {} # key -> (pid, start time, callback)
+        self._interval = interval
+        self._timer = None # Made on first use so it belongs to the IOLoop of the process using it
+
+    def watch(self, key, pid, callback):
+        self._watched[key] = (pid, start_time(pid), callback)
+        if self._timer is None:
+            self._timer = ioloop.PeriodicCallback(self._check, self._interval * 1000)
+        if not self._timer.is_running():
+            self._timer.start()
+
+    def unwatch(self, key):
+        self._watched.pop(key, None)
+        if len(self._watched) == 0 and self._timer is not None and self._timer.is_running():
+            self._timer.stop()
+
+    def _check(self):
+        for key, (pid, started, callback) in list(self._watched.items()):
+            if not is_alive(pid, started):
+                self.unwatch(key)
+                try:
+                    callback()
+                except Exception as err:
+                    log.error("Failed to handle the exit of %d (err: %s)" % (pid, str(err)))
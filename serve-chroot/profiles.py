@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""CRI vnc profiles
+
+A profile is a set of Xvnc settings that trades bandwidth against cpu. lan barely compresses
+and sends every frame for loopback and local networks, wan compresses hard and skips areas
+that didn't really change, low-cpu keeps the encoder cheap and the frame rate low for busy
+hosts. Clients pick one when they run a program or get one based on their measured round trip
+time and the host load. The viewer chooses the encodings itself so every profile also has the
+quality and compression levels noVNC should ask for. Switching a running program only changes
+the encoder settings of its Xvnc through vncconfig, the display and the app keep running.
+The cpu time and bytes written of every Xvnc are added up per profile to compare them
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from logger import Logger
+from metrics import Counter
+from processes import read_usage
+from tornado import gen, ioloop, process
+import host
+
+# Configs
+base_vncconfig = "vncconfig"
+default_profile = "lan" # Used until a client's round trip time was measured
+lan_rtt = 0.01 # Longest round trip (seconds) that still gets the lan profile
+low_cpu_load = 1.5 # Load average per cpu above which new programs get the low-cpu profile
+usage_interval = 5 # Seconds between samples of what the displays used
+profiles = {
+    "lan": {
+        "server": {"ZlibLevel": 0, "CompareFB": 0, "FrameRate": 60},
+        "client": {"quality": 9, "compression": 0}
+    },
+    "wan": {
+        "server": {"ZlibLevel": 6, "CompareFB": 1, "FrameRate": 30},
+        "client": {"quality": 5, "compression": 6}
+    },
+    "low-cpu": {
+        "server": {"ZlibLevel": 1, "CompareFB": 0, "FrameRate": 15},
+        "client": {"quality": 6, "compression": 1}
+    }
+}
+
+# Logs
+log = Logger("PROFILE")
+
+# Metrics
+cpu_seconds = Counter("cri_vnc_cpu_seconds_total", "Cpu time the displays used by profile", ["profile"])
+sent_bytes = Counter("cri_vnc_written_bytes_total", "Bytes the displays wrote (mostly to viewers) by profile",
+        ["profile"])
+profile_seconds = Counter("cri_vnc_profile_seconds_total", "Time the displays ran with each profile", ["profile"])
+
+
+def exists(name):
+    return name in profiles
+
+
+def get_flags(name):
+    """The Xvnc command line options of a profile"""
+    server = profiles[name]["server"]
+    return ["-%s=%s" % (key, server[key]) for key in sorted(server)]
+
+
+def get_client_settings(name):
+    return profiles[name]["client"]
+
+
+def pick(rtt):
+    """The profile for a client with this round trip time (None when it isn't known yet)"""
+    if host.load_per_cpu() > low_cpu_load:
+        return "low-cpu"
+    if rtt is None:
+        return default_profile
+    return "lan" if rtt <= lan_rtt else "wan"
+
+
+def describe():
+    """Every profile with its settings and what the displays used with it so far"""
+    sample()
+    described = {}
+    for name, profile in profiles.items():
+        seconds = profile_seconds.get(name)
+        described[name] = {
+            "server": profile["server"],
+            "client": profile["client"],
+            "seconds": seconds,
+            "cpu": cpu_seconds.get(name) / seconds if seconds > 0 else None, # Share of one cpu
+            "bytes_second": sent_bytes.get(name) / seconds if seconds > 0 else None
+        }
+    return described
+
+
+@gen.coroutine
+def apply(display_num, name):
+    """Switch a running display to a profile, returns whether vncconfig took every setting
+
+    The settings are independent, they're all set at once
+    """
+    server = profiles[name]["server"]
+    keys = sorted(server)
+    procs = []
+    for key in keys:
+        try:
+            procs.append(process.Subprocess([base_vncconfig, "-display", ":%d" % display_num,
+                "-set", "%s=%s" % (key, server[key])]))
+        except OSError as err:
+            log.error("Failed to run %s (err: %s)" % (base_vncconfig, str(err)))
+            break
+    codes = yield [proc.wait_for_exit(raise_error=False) for proc in procs]
+    if len(procs) < len(keys):
+        raise gen.Return(False)
+    for key, rc in zip(keys, codes):
+        if rc != 0:
+            log.error("Display :%d didn't take %s=%s (code: %d)" % (display_num, key, server[key], rc))
+            raise gen.Return(False)
+    log.info("Display :%d switched to the %s profile" % (display_num, name))
+    raise gen.Return(True)
+
+
+class Usage(object):
+    """Adds up what one display's Xvnc used under each of its profiles"""
+    def __init__(self):
+        self._pid = None
+        self._profile = None
+        self._last = None # (cpu seconds, bytes written, time) at the last sample
+
+    def start(self, pid, profile):
+        usage = read_usage(pid)
+        if usage is None:
+            return
+        self._pid = pid
+        self._profile = profile
+        self._last = usage + (ioloop.IOLoop.current().time(),)
+        _active.add(self)
+        _start_sampling()
+
+    def switch(self, profile):
+        # What was used up to now still counts for the old profile
+        self.sample()
+        self._profile = profile
+
+    def stop(self):
+        self.sample()
+        self._pid = None
+        _active.discard(self)
+
+    def sample(self):
+        if self._pid is None:
+            return
+        usage = read_usage(self._pid)
+        if usage is None:
+            return
+        now = ioloop.IOLoop.current().time()
+        cpu, written, then = self._last
+        cpu_seconds.add(max(0, usage[0] - cpu), self._profile)
+        sent_bytes.add(max(0, usage[1] - written), self._profile)
+        profile_seconds.add(now - then, self._profile)
+        self._last = usage + (now,)
+
+
+_active = set()
+_timer = None
+
+
+def _start_sampling():
+    # Made on first use so it belongs to the IOLoop of the process using it
+    global _timer
+    if _timer is None:
+        _timer = ioloop.PeriodicCallback(sample, usage_interval * 1000)
+        _timer.start()
+
+
+def sample():
+    for usage in list(_active):
+        usage.sample()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""CRI vnc proxy
+
+This module bridges a browser websocket to a program's local vnc (rfb) port inside the
+CRI tornado server itself, so no websockify process or extra port is needed per program.
+Each direction only reads more once the other side has taken the previous chunk
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from logger import Logger
+from tornado import gen, websocket
+from tornado.concurrent import Future
+from tornado.iostream import StreamClosedError
+from probe import get_client
+
+# Configs
+proxy_host = "127.0.0.1"
+proxy_chunk_size = 64 * 1024 # The most bytes read from the vnc server at once
+proxy_subprotocol = "binary" # The subprotocol noVNC asks websockify for
+
+# Logs
+log = Logger("VNC")
+
+
+class VNCProxy(websocket.WebSocketHandler):
+    def initialize(self, lookup):
+        self._lookup = lookup # Maps a program uuid to (a future of) its rfb port, None when it doesn't exist
+        self._stream = None
+        self._connected = Future()
+
+    def check_origin(self, origin):
+        return True
+
+    def select_subprotocol(self, subprotocols):
+        if proxy_subprotocol in subprotocols:
+            return proxy_subprotocol
+        return None
+
+    def open(self, uuid):
+        self._connect(uuid)
+
+    @gen.coroutine
+    def _connect(self, uuid):
+        try:
+            port = yield gen.maybe_future(self._lookup(uuid))
+        except IOError as err:
+            log.error("Failed to look up program %s (err: %s)" % (uuid, str(err)))
+            self._connected.set_result(None)
+            self.close(1011, "Program couldn't be looked up")
+            return
+        if port is None:
+            log.error("No program %s to proxy to" % uuid)
+            self._connected.set_result(None)
+            self.close(1011, "Program doesn't exist")
+            return
+        log.info("Proxying %s to rfb port %d" % (self.request.remote_ip, port))
+        try:
+            self._stream = yield get_client().connect(proxy_host, port)
+        except Exception as err:
+            log.error("Failed to reach rfb port %d (err: %s)" % (port, str(err)))
+            self._connected.set_result(None)
+            self.close(1011, "Display isn't reachable")
+            return
+        if self.ws_connection is None:
+            # The browser left while we were still connecting
+            self._stream.close()
+            return
+        self._stream.set_close_callback(self._on_stream_close)
+        self._connected.set_result(self._stream)
+        self._pump()
+
+    @gen.coroutine
+    def _pump(self):
+        # Hand each chunk over as is and wait for the browser to take it before reading again
+        try:
+            while True:
+                data = yield self._stream.read_bytes(proxy_chunk_size, partial=True)
+                yield self.write_message(data, binary=True)
+        except (StreamClosedError, websocket.WebSocketClosedError):
+            pass
+
+    @gen.coroutine
+    def on_message(self, message):
+        # Tornado waits on this coroutine before reading the next frame from the browser
+        stream = yield self._connected
+        if stream is None or stream.closed():
+            return
+        if not isinstance(message, bytes):
+            message = message.encode("latin-1")
+        try:
+            yield stream.write(message)
+        except StreamClosedError:
+            pass
+
+    def _on_stream_close(self):
+        log.info("The display closed the proxied connection")
+        self.close()
+
+    def on_close(self):
+        if self._stream is not None:
+            self._stream.close()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""CRI launch scheduler
+
+Every run request goes through the LaunchScheduler before it starts a display. Only a few
+launches run at once and the rest wait in line, being told their place as it changes. The
+next launch is only let in when the host has the free memory and the cpu time for it, and
+once the line is full (or the host is out of memory) new launches are turned away right
+away with a BusyError instead of piling up. Low priority launches (warm pool displays) wait
+in a line of their own and only start when no run request is waiting
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from logger import Logger
+from metrics import Counter, Histogram
+from collections import deque
+from tornado import ioloop
+from tornado.concurrent import Future
+import host
+
+# Configs
+admission_interval = 0.5 # Seconds between checks of the host while launches are held back
+
+# Logs
+log = Logger("SCHED")
+
+# Metrics
+launches_total = Counter("cri_launches_total", "Launch requests by how they left the scheduler", ["result"])
+wait_seconds = Histogram("cri_launch_wait_seconds", "Time launches waited in line before they started",
+        buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+
+
+class BusyError(Exception):
+    pass
+
+
+class Launch(object):
+    __slots__ = ("name", "notify", "future", "queued", "deadline")
+
+    def __init__(self, name, notify, queued, deadline):
+        self.name = name
+        self.notify = notify
+        self.future = Future()
+        self.queued = queued
+        self.deadline = deadline
+
+
+class LaunchScheduler(object):
+    def __init__(self, max_launching, max_waiting, launch_mb, reserve_mb, max_load, timeout):
+        self._max_launching = max_launching
+        self._max_waiting = max_waiting
+        self._launch_mb = launch_mb # Estimated memory a display and its app take
+        self._reserve_mb = reserve_mb # Memory to always leave free on the host
+        self._max_load = max_load # Highest load average per cpu to start another launch at
+        self._timeout = timeout
+        self._waiting = deque()
+        self._background = deque() # Low priority launches, only let in when nothing else waits
+        self._launching = 0
+        self._timer = None
+
+    def waiting(self):
+        return len(self._waiting)
+
+    def launching(self):
+        return self._launching
+
+    def get_stats(self):
+        return {
+            "launching": self._launching,
+            "waiting": len(self._waiting),
+            "background": len(self._background),
+            "max_launching": self._max_launching,
+            "max_waiting": self._max_waiting
+        }
+
+    def _free_mb(self):
+        # The launches that are still starting haven't used all of their memory yet
+        return host.mem_available_mb() - self._reserve_mb - self._launching * self._launch_mb
+
+    def _blocked(self):
+        """Why the next launch can't start yet, None when it can"""
+        if self._launching >= self._max_launching:
+            return "launching"
+        if self._free_mb() < self._launch_mb:
+            return "memory"
+        if self._launching > 0 and host.load_per_cpu() > self._max_load:
+            return "load"
+        return None
+
+    def acquire(self, name, notify=None, low=False):
+        """Get a future that's True once the launch may start, False when it was cancelled
+
+        notify(position) is called whenever the launch's place in line changes. A BusyError is
+        raised right away when the line is full or the host is out of memory, and through the
+        future when the launch waited longer than the timeout. Low priority launches don't
+        count towards the line and are never told their place
+        """
+        if not low and len(self._waiting) >= self._max_waiting:
+            launches_total.inc("busy")
+            raise BusyError("Too many programs are starting, try again in a moment")
+        if self._launching == 0 and self._free_mb() < self._launch_mb:
+            # Nothing that's starting will finish and hand memory back, waiting won't help
+            launches_total.inc("busy")
+            raise BusyError("There isn't enough free memory to start another program")
+        loop = ioloop.IOLoop.current()
+        launch = Launch(name, notify, loop.time(), loop.time() + self._timeout)
+        (self._background if low else self._waiting).append(launch)
+        if not self._admit() and notify is not None:
+            notify(len(self._waiting))
+        return launch.future
+
+    def release(self):
+        """A launch finished starting (or failed to), let the next one in"""
+        self._launching = max(0, self._launching - 1)
+        self._admit()
+
+    def cancel(self, future):
+        # The client left before its launch started
+        for line in (self._waiting, self._background):
+            for launch in line:
+                if launch.future is future:
+                    line.remove(launch)
+                    launches_total.inc("cancelled")
+                    launch.future.set_result(False)
+                    self._report_positions()
+                    return
+
+    def _admit(self):
+        admitted = False
+        now = ioloop.IOLoop.current().time()
+        while len(self._waiting) > 0 or len(self._background) > 0:
+            line = self._waiting if len(self._waiting) > 0 else self._background
+            if line[0].deadline <= now:
+                launch = line.popleft()
+                log.warning("Launch of %s waited too long, giving up" % launch.name)
+                launches_total.inc("timeout")
+                launch.future.set_exception(BusyError("Timed out waiting for the other programs to start"))
+                admitted = True
+                continue
+            reason = self._blocked()
+            if reason is not None:
+                log.debug("Holding back %d launches (%s)" % (len(self._waiting) + len(self._background), reason))
+                self._recheck()
+                break
+            launch = line.popleft()
+            self._launching += 1
+            launches_total.inc("admitted")
+            wait_seconds.observe(now - launch.queued)
+            launch.future.set_result(True)
+            admitted = True
+        if admitted:
+            self._report_positions()
+        return admitted
+
+    def _recheck(self):
+        # Memory and load change by themselves and waiting launches can time out, look again in a moment
+        if self._timer is None:
+            self._timer = ioloop.IOLoop.current().call_later(admission_interval, self._check)
+
+    def _check(self):
+        self._timer = None
+        self._admit()
+
+    def _report_positions(self):
+        for position, launch in enumerate(self._waiting):
+            if launch.notify is not None:
+                launch.notify(position + 1)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""CRI package search index
+
+This module indexes the names, short names and summaries of every downloadable package
+in the apt cache so a search doesn't have to walk the whole cache. Short queries use a
+sorted prefix index, longer ones a trigram index, and summaries are searched in one
+joined string. Results are ranked and only the names are returned, the caller loads the
+package details for the few results it actually sends
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from logger import Logger
+from bisect import bisect_left, bisect_right
+from timeit import default_timer
+import threading as thread
+
+# Configs
+trigram_size = 3
+
+# Ranks (lower is better)
+RANK_EXACT = 0
+RANK_PREFIX = 1
+RANK_NAME = 2
+RANK_SUMMARY = 3
+
+# Logs
+log = Logger("SRCH")
+
+
+def trigrams(text):
+    return set(text[i:i + trigram_size] for i in range(0, len(text) - trigram_size + 1))
+
+
+class _Index(object):
+    __slots__ = ("names", "keys", "sorted_keys", "sorted_ids", "grams", "summaries", "offsets")
+
+    def __init__(self, entries):
+        # entries is a list of (package name, short name, summary)
+        entries.sort(key=lambda e: e[0])
+        self.names = [e[0] for e in entries]
+        self.keys = [] # The lowercase text names are matched against (name and short name)
+        by_key = []
+        self.grams = {}
+        summaries = []
+        for i, (name, shortname, summary) in enumerate(entries):
+            key = name.lower()
+            short = (shortname or name).lower()
+            if short != key:
+                key = "%s %s" % (key, short)
+            self.keys.append(key)
+            by_key.append((name.lower(), i))
+            if short != name.lower():
+                by_key.append((short, i))
+            for gram in trigrams(key):
+                posting = self.grams.get(gram)
+                if posting is None:
+                    self.grams[gram] = [i]
+                elif posting[-1] != i:
+                    posting.append(i)
+            summaries.append((summary or "").lower().replace("\n", " "))
+        by_key.sort()
+        self.sorted_keys = [k for k, i in by_key]
+        self.sorted_ids = [i for k, i in by_key]
+
+        # Every summary in one string, offsets[i] is where summary i starts
+        self.offsets = []
+        position = 0
+        for summary in summaries:
+            self.offsets.append(position)
+            position += len(summary) + 1
+        self.summaries = "\n".join(summaries)
+
+
+class PackageIndex(object):
+    def __init__(self):
+        self._index = None
+        self._ready = thread.Event()
+
+    def is_ready(self):
+        return self._ready.is_set()
+
+    def wait(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def size(self):
+        index = self._index
+        return 0 if index is None else len(index.names)
+
+    def build(self, packages):
+        """Rebuild the index from (name, short name, summary) tuples and swap it in"""
+        start = default_timer()
+        index = _Index(list(packages))
+        self._index = index
+        self._ready.set()
+        log.info("Indexed %d packages in %.2f seconds" % (len(index.names), default_timer() - start))
+
+    def search(self, query, limit=None):
+        """Get the names of the best matching packages, best first"""
+        index = self._index
+        query = query.strip().lower()
+        if index is None or not query:
+            return []
+        ranked = {} # package id -> rank
+
+        # Names that start with the query (the sorted keys make this a range lookup)
+        lo = bisect_left(index.sorted_keys, query)
+        hi = bisect_right(index.sorted_keys, query + u"\uffff")
+        for k in range(lo, hi):
+            i = index.sorted_ids[k]
+            rank = RANK_EXACT if index.sorted_keys[k] == query else RANK_PREFIX
+            if rank < ranked.get(i, RANK_SUMMARY + 1):
+                ranked[i] = rank
+
+        # Names that contain the query anywhere (they can't beat a full page of prefix matches)
+        if limit is not None and len(ranked) >= limit:
+            candidates = []
+        elif len(query) >= trigram_size:
+            candidates = None
+            for gram in trigrams(query):
+                posting = index.grams.get(gram)
+                if posting is None:
+                    candidates = []
+                    break
+                if candidates is None or len(posting) < len(candidates):
+                    candidates = posting
+        else:
+            candidates = range(0, len(index.keys))
+        for i in candidates:
+            if i not in ranked and query in index.keys[i]:
+                ranked[i] = RANK_NAME
+
+        # Only look through the summaries when the names didn't fill the results
+        if limit is None or len(ranked) < limit:
+            summaries = index.summaries
+            position = summaries.find(query)
+            while position != -1:
+                i = bisect_right(index.offsets, position) - 1
+                if i not in ranked:
+                    ranked[i] = RANK_SUMMARY
+                # Skip to the next summary, one hit per package is enough
+                next_start = index.offsets[i + 1] if i + 1 < len(index.offsets) else len(summaries)
+                position = summaries.find(query, next_start)
+
+        names = index.names
+        results = sorted(ranked, key=lambda i: (ranked[i], len(names[i]), names[i]))
+        if limit is not None:
+            results = results[:limit]
+        return [names[i] for i in results]
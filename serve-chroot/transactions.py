@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""CRI apt transaction queue
+
+This module runs every package install and delete on one apt worker thread so two clients
+never race on the shared cache or the dpkg lock. Jobs that are waiting when the worker
+frees up are marked together and committed as one transaction, anything that would undo
+another job's marks is pushed to the next batch, and the catalog and package cache are
+refreshed once per batch instead of once per package
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from logger import Logger
+from apps import Application, Package
+from apt.progress.base import AcquireProgress, InstallProgress
+from metrics import Counter, Histogram
+from collections import deque, OrderedDict
+from tornado import ioloop
+import threading as thread
+
+# Configs
+max_batch = 16 # The most jobs committed in one transaction
+progress_rate = 5 # How many times a second progress is sent to the clients
+stop_timeout = 10 # Seconds shutdown waits for the apt worker to finish its transaction
+
+# Logs
+log = Logger("APT")
+
+# Metrics
+transaction_seconds = Histogram("cri_apt_transaction_seconds", "Time spent committing apt transactions",
+        buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800))
+jobs_total = Counter("cri_apt_jobs_total", "Finished apt jobs by action and result", ["action", "result"])
+
+
+class ProgressBroadcaster(object):
+    """Hands apt progress from the worker thread to the IOLoop
+
+    Progress updates only keep the latest state per key and are flushed at most rate times
+    a second, everything else (start, finish, errors, results) is always delivered and
+    sends whatever progress is still pending first so the order is kept
+    """
+    def __init__(self, broadcast, rate):
+        self._broadcast = broadcast
+        self._interval = 1.0 / rate
+        self._pending = OrderedDict() # key -> latest progress message
+        self._lock = thread.Lock()
+        self._scheduled = False
+        self._last_flush = 0
+
+    def update(self, key, dictionary):
+        with self._lock:
+            self._pending[key] = dictionary
+            if self._scheduled:
+                return
+            self._scheduled = True
+        ioloop.IOLoop.instance().add_callback(self._schedule)
+
+    def send(self, dictionary):
+        self._send(self._broadcast, dictionary)
+
+    def send_to(self, websocket, dictionary):
+        self._send(websocket.send_dict, dictionary)
+
+    def _send(self, send, dictionary):
+        # Only the progress from before this message goes out ahead of it
+        with self._lock:
+            pending = self._take()
+        ioloop.IOLoop.instance().add_callback(self._deliver, pending, send, dictionary)
+
+    def _take(self):
+        pending = list(self._pending.items())
+        self._pending.clear()
+        return pending
+
+    def _schedule(self):
+        loop = ioloop.IOLoop.current()
+        loop.call_at(max(loop.time(), self._last_flush + self._interval), self._flush)
+
+    def _flush(self):
+        with self._lock:
+            pending = self._take()
+            self._scheduled = False
+        self._deliver(pending)
+
+    def _deliver(self, pending, send=None, dictionary=None):
+        if len(pending) > 0:
+            self._last_flush = ioloop.IOLoop.current().time()
+            for key, progress in pending:
+                self._broadcast(progress, key)
+        if send is not None:
+            send(dictionary)
+
+
+class Job(object):
+    __slots__ = ("id", "action", "name", "purge", "websocket", "progress")
+
+    def __init__(self, job_id, action, name, websocket, progress, purge=False):
+        self.id = job_id
+        self.action = action
+        self.name = name
+        self.purge = purge
+        self.websocket = websocket
+        self.progress = progress
+
+    def send(self, dictionary):
+        dictionary["id"] = self.id
+        self.progress.send_to(self.websocket, dictionary)
+
+
+class CriFetchProgress(AcquireProgress):
+    def set_batch(self, batch, progress):
+        self._batch = batch
+        self._progress = progress
+
+    def fail(self, item):
+        for job in self._batch:
+            job.send({
+                "exec": "error",
+                "message": "Failed to install a resource! Make sure you're connected to the internet"
+            })
+
+    def pulse(self, owner):
+        self._progress.update("apt_aquire", {
+            "exec": "aquire_status",
+            "count": self.current_items,
+            "total_count": self.total_items,
+            "bytes": self.fetched_bytes,
+            "total_bytes": self.total_bytes,
+            "bytes_second": self.current_cps
+        })
+        return True
+
+
+class CriInstallProgress(InstallProgress):
+    def set_batch(self, batch, progress):
+        self._batch = batch
+        self._progress = progress
+        self._actions = set(job.action for job in batch)
+
+    def _find(self, pkg):
+        for job in self._batch:
+            if job.name == pkg:
+                return job
+        return None
+
+    def error(self, pkg, errormsg):
+        job = self._find(pkg)
+        flag = "install" if job is None else job.action
+        message = {
+            "exec": "error",
+            "message": "Failed to %s %s (err: %s)" % (flag, pkg, errormsg)
+        }
+        if job is None:
+            self._progress.send(message)
+        else:
+            job.send(message)
+
+    def start_update(self):
+        log.info("Starting to %s packages" % " and ".join(sorted(self._actions)))
+        for flag in sorted(self._actions):
+            self._progress.send({
+                "exec": "%s_start" % flag
+            })
+
+    def finish_update(self):
+        log.info("Finished %s packages" % " and ".join(sorted(self._actions)))
+        for flag in sorted(self._actions):
+            self._progress.send({
+                "exec": "%s_finish" % flag
+            })
+
+    def status_change(self, pkg, percent, status):
+        # Dependencies aren't anybody's job, they're reported as part of the batch
+        job = self._find(pkg)
+        self._progress.update("apt_status", {
+            "exec": "%s_status" % ("install" if job is None else job.action),
+            "package": pkg,
+            "percent": percent,
+            "status": status,
+            "id": None if job is None else job.id
+        })
+
+
+class AptQueue(object):
+    def __init__(self, broadcast):
+        self._progress = ProgressBroadcaster(broadcast, progress_rate)
+        self._jobs = deque()
+        self._lock = thread.Condition()
+        self._worker = None
+        self._stopping = False
+        self._apt_lock = None
+        self._fetch_progress = CriFetchProgress()
+        self._install_progress = CriInstallProgress()
+
+    def start(self):
+        if self._worker is None:
+            self._worker = thread.Thread(target=self._run)
+            self._worker.daemon = True
+            self._worker.start()
+
+    def stop(self, timeout=stop_timeout):
+        """Let the worker finish its transaction and wait for it to exit, queued jobs are dropped"""
+        with self._lock:
+            self._stopping = True
+            self._lock.notify()
+        if self._worker is not None:
+            self._worker.join(timeout)
+            if self._worker.is_alive():
+                log.warning("The apt worker is still busy, not waiting for it")
+
+    def set_apt_lock(self, apt_lock):
+        """Hold apt_lock around every transaction, it keeps worker processes from committing at once
+
+        apt_lock.acquire() returns True when packages changed since it was last held and the cache
+        has to be reloaded first, apt_lock.release(committed) hands it on
+        """
+        self._apt_lock = apt_lock
+
+    def size(self):
+        return len(self._jobs)
+
+    def submit(self, action, name, websocket, job_id=None, purge=False):
+        """Queue an install or delete, the websocket is told where the job is in line"""
+        job = Job(job_id, action, name, websocket, self._progress, purge)
+        with self._lock:
+            self._jobs.append(job)
+            position = len(self._jobs)
+            self._lock.notify()
+        log.info("Queued %s of %s at position %d" % (action, name, position))
+        websocket.send_dict({
+            "exec": "apt_queued",
+            "id": job_id,
+            "action": action,
+            "package": name,
+            "position": position
+        })
+        return job
+
+    def _take_batch(self):
+        with self._lock:
+            while len(self._jobs) == 0 and not self._stopping:
+                self._lock.wait()
+            if self._stopping:
+                return None
+            batch = []
+            while len(self._jobs) > 0 and len(batch) < max_batch:
+                batch.append(self._jobs.popleft())
+            return batch
+
+    def _defer(self, jobs):
+        # Conflicting jobs go back to the front of the line for the next transaction
+        with self._lock:
+            self._jobs.extendleft(reversed(jobs))
+
+    def _report_positions(self):
+        with self._lock:
+            waiting = list(self._jobs)
+        for position, job in enumerate(waiting):
+            job.send({
+                "exec": "apt_queued",
+                "action": job.action,
+                "package": job.name,
+                "position": position + 1
+            })
+
+    @staticmethod
+    def _mark(job):
+        if job.action == "install":
+            return Package.mark_install(job.name)
+        return Package.mark_delete(job.name, job.purge)
+
+    def _mark_batch(self, batch):
+        """Mark as many jobs as possible, returns (marked jobs, deferred jobs)"""
+        marked = []
+        deferred = []
+        for job in batch:
+            try:
+                status = self._mark(job)
+            except Exception as err:
+                status = str(err)
+            if status is not None:
+                job.send({"exec": "error", "message": status})
+                jobs_total.inc(job.action, "rejected")
+                self._remark(marked)
+                continue
+
+            # Resolving this job's dependencies mustn't undo what an earlier job wanted
+            if len(marked) > 0 and (Package.is_broken() or not all(
+                    Package.is_marked(j.name, j.action) for j in marked + [job])):
+                log.info("Deferring %s of %s to the next transaction" % (job.action, job.name))
+                deferred.append(job)
+                self._remark(marked)
+                continue
+            marked.append(job)
+        return marked, deferred
+
+    def _remark(self, jobs):
+        # Start over from a clean cache with only the jobs that were fine together
+        Package.clear_marks()
+        for job in jobs:
+            self._mark(job)
+
+    def _commit(self, batch):
+        for job in batch:
+            job.send({"exec": "aquire_start"})
+        log.info("Committing %d jobs (%s)" % (len(batch), ", ".join(
+            "%s %s" % (job.action, job.name) for job in batch)))
+        self._fetch_progress.set_batch(batch, self._progress)
+        self._install_progress.set_batch(batch, self._progress)
+        try:
+            with transaction_seconds.time():
+                Package.commit(self._fetch_progress, self._install_progress)
+        except Exception as err:
+            log.error("Failed to commit the transaction! (err: %s)" % str(err))
+            for job in batch:
+                job.send({"exec": "error", "message": str(err)})
+                jobs_total.inc(job.action, "failed")
+            return
+        for job in batch:
+            job.send({"exec": "%s_done" % job.action, "package": job.name})
+            jobs_total.inc(job.action, "done")
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return # Shutting down
+            committed = False
+            try:
+                if self._apt_lock is not None and self._apt_lock.acquire():
+                    log.info("Packages changed in another worker, reloading the cache")
+                    Package.reload_cache()
+                committed = self._transaction(batch)
+            except Exception as err:
+                if not self._stopping:
+                    log.error("Apt worker failed (err: %s)" % str(err))
+            finally:
+                if self._apt_lock is not None:
+                    self._apt_lock.release(committed)
+
+    def _transaction(self, batch):
+        """Mark and commit a batch, returns whether anything was committed"""
+        self._report_positions()
+        marked, deferred = self._mark_batch(batch)
+        if len(deferred) > 0:
+            self._defer(deferred)
+        if len(marked) == 0:
+            Package.clear_marks()
+            return False
+        self._commit(marked)
+
+        # One refresh for the whole transaction
+        log.info("Checking for changed apps")
+        ioloop.IOLoop.instance().add_callback(Application.refresh_app_list)
+        status = Package.reload_cache()
+        if status is not None:
+            self._progress.send({"exec": "error", "message": status})
+        return True
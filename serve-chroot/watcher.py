@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""CRI directory watcher
+
+This module tells CRI which files changed in a set of directories. It uses linux inotify
+on the IOLoop when it's available and falls back to asking for a full rescan on a timer.
+Changes are batched for a moment since package installs touch many files at once
+
+Developed By: David Smerkous and Eli Smith
+"""
+
+from logger import Logger
+from tornado import ioloop
+from ctypes.util import find_library
+from os.path import join, isdir
+from os import walk, read, close
+import struct
+import ctypes
+import errno
+
+# Configs
+watch_delay = 0.25 # Seconds to collect events before reporting them
+poll_interval = 5 # Seconds between rescans when inotify isn't available
+read_size = 64 * 1024
+
+# inotify constants (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+        IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+EVENT_HEADER = struct.Struct("iIII")
+
+# Logs
+log = Logger("WATCH")
+
+
+class DirectoryWatcher(object):
+    def __init__(self, directories, callback):
+        self._directories = directories
+        self._callback = callback # Called with a set of changed paths, or None to rescan everything
+        self._libc = None
+        self._fd = None
+        self._watches = {} # watch descriptor -> directory
+        self._pending = set()
+        self._rescan = False
+        self._timeout = None
+        self._poller = None
+
+    def start(self):
+        if not self._start_inotify():
+            log.warning("inotify isn't available, rescanning every %d seconds" % poll_interval)
+            self._poller = ioloop.PeriodicCallback(lambda: self._callback(None), poll_interval * 1000)
+            self._poller.start()
+
+    def stop(self):
+        if self._poller is not None:
+            self._poller.stop()
+        if self._fd is not None:
+            ioloop.IOLoop.current().remove_handler(self._fd)
+            close(self._fd)
+            self._fd = None
+
+    def _start_inotify(self):
+        try:
+            self._libc = ctypes.CDLL(find_library("c"), use_errno=True)
+            fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError) as err:
+            log.error("Failed to load inotify (err: %s)" % str(err))
+            return False
+        if fd < 0:
+            log.error("Failed to start inotify (errno: %d)" % ctypes.get_errno())
+            return False
+        self._fd = fd
+        for directory in self._directories:
+            self._add_tree(directory)
+        ioloop.IOLoop.current().add_handler(self._fd, self._on_events, ioloop.IOLoop.READ)
+        log.info("Watching %s" % ", ".join(self._directories))
+        return True
+
+    def _add_tree(self, directory):
+        if not isdir(directory):
+            return
+        for dirpath, dirnames, files in walk(directory):
+            path = dirpath if isinstance(dirpath, bytes) else dirpath.encode("utf-8")
+            wd = self._libc.inotify_add_watch(self._fd, path, WATCH_MASK)
+            if wd < 0:
+                log.error("Failed to watch %s (errno: %d)" % (dirpath, ctypes.get_errno()))
+                continue
+            self._watches[wd] = dirpath
+
+    def _on_events(self, fd, events):
+        try:
+            data = read(fd, read_size)
+        except OSError as err:
+            if err.errno not in (errno.EAGAIN, errno.EINTR):
+                log.error("Failed to read inotify events (err: %s)" % str(err))
+            return
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, size = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + size].rstrip(b"\0").decode("utf-8", "replace")
+            offset += size
+            self._on_event(wd, mask, name)
+        self._schedule()
+
+    def _on_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self._rescan = True
+            return
+        directory = self._watches.get(wd)
+        if mask & IN_IGNORED:
+            self._watches.pop(wd, None)
+            return
+        if directory is None:
+            return
+        if mask & IN_ISDIR:
+            # A whole directory came or went, watch any new one and rescan everything
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(join(directory, name))
+            self._rescan = True
+        elif name:
+            self._pending.add(join(directory, name))
+
+    def _schedule(self):
+        if self._timeout is None and (self._pending or self._rescan):
+            self._timeout = ioloop.IOLoop.current().call_later(watch_delay, self._flush)
+
+    def _flush(self):
+        self._timeout = None
+        changed = None if self._rescan else self._pending
+        self._pending = set()
+        self._rescan = False
+        try:
+            self._callback(changed)
+        except Exception as err:
+            log.error("Failed to handle changed files (err: %s)" % str(err))